@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for expensive results (feature sets, ...), below PA_DATA_DIR:
+    * DiskCache: results stored as pickle files, keyed by a hash of parameters
+      and fingerprints (size, modification time) of the source files they depend on
+    * Eviction of least recently used entries beyond max_entries / max_bytes
+    * cached: decorator caching a function's results by its call arguments
+    * data_fingerprint: hash of in-memory data (arrays, sparse matrices), for keys
+      of results computed from data rather than read from files
+
+Pickle is used for storage, as results may hold any object (column lists, sparse
+DataFrames, feature matrices), which Arrow-based formats do not store.
+
+@author: kpf
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pa_lib.const import PA_DATA_DIR
+from pa_lib.log import info
+from pa_lib.util import format_size
+
+
+########################################################################################
+def file_fingerprint(file_path) -> str:
+    """Identifies a file's version by path, size and modification time"""
+    path = Path(file_path).resolve()
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return f"{path}:missing"
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def data_fingerprint(*arrays) -> str:
+    """Identifies the contents of arrays (numpy arrays, sparse matrices, Series)"""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        if sparse.issparse(array):
+            array = array.tocsr()
+            parts = (array.data, array.indices, array.indptr)
+        else:
+            parts = (np.asarray(array),)
+        digest.update(repr(array.shape).encode("utf-8"))
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            digest.update(f"{part.dtype}:{part.shape}".encode("utf-8"))
+            digest.update(part.view("uint8"))
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Cache of results in directory dir_name (below PA_DATA_DIR, or absolute if it
+    starts with "/"). Each entry is one pickle file named by its key. Reading an
+    entry marks it as recently used. After each store, least recently used entries
+    are removed until at most max_entries entries and max_bytes bytes are left.
+    Several processes can share a cache: entries are replaced atomically, and
+    entries evicted by another process count as missing.
+    """
+
+    suffix = ".cache.pkl"
+
+    def __init__(self, dir_name, max_entries: int = 16, max_bytes: int = None):
+        dir_name = str(dir_name)
+        self.path = Path(dir_name) if dir_name[0] == "/" else Path(PA_DATA_DIR) / dir_name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(name: str, params: dict = None, sources=()) -> str:
+        """Hash of name, params (JSON-able or repr-able values) and source files"""
+        content = json.dumps(
+            {
+                "name": name,
+                "params": {} if params is None else params,
+                "sources": sorted(file_fingerprint(src) for src in sources),
+            },
+            sort_keys=True,
+            default=repr,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+    def _file(self, key: str) -> Path:
+        return self.path / f"{key}{self.suffix}"
+
+    def get(self, key: str, default=None):
+        """Cached result of key, or default (also if the entry cannot be unpickled)"""
+        cache_file = self._file(key)
+        try:
+            with open(cache_file, "rb") as file:
+                value = pickle.load(file)
+        except FileNotFoundError:
+            return default
+        except Exception as error:
+            # truncated file, or classes renamed / moved since it was stored
+            info(f"Cache entry {cache_file} unreadable ({error!r}), ignoring it")
+            return default
+        try:
+            os.utime(cache_file)  # mark as recently used
+        except FileNotFoundError:
+            pass  # evicted by another process meanwhile
+        info(f"Cache hit: {cache_file}")
+        return value
+
+    def put(self, key: str, value) -> None:
+        """Store value as entry key (atomically replacing it), then evict"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        cache_file = self._file(key)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        size = tmp_file.stat().st_size
+        tmp_file.replace(cache_file)
+        info(f"Cached to {cache_file} ({format_size(size)})")
+        self.evict()
+
+    def get_or_compute(self, key: str, compute):
+        """Cached result of key, or compute() it and store it"""
+        missing = object()
+        value = self.get(key, default=missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def entries(self) -> pd.DataFrame:
+        """
+        Cache entries (key, size, last use), most recently used first. Entries
+        removed meanwhile (e.g. evicted by another process) are left out
+        """
+        records = []
+        for f in self.path.glob(f"*{self.suffix}") if self.path.is_dir() else []:
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            records.append((f.name[: -len(self.suffix)], stat.st_size, stat.st_mtime))
+        return (
+            pd.DataFrame.from_records(records, columns=["key", "size", "last_used"])
+            .sort_values("last_used", ascending=False, ignore_index=True)
+            .assign(last_used=lambda df: pd.to_datetime(df["last_used"], unit="s"))
+        )
+
+    def evict(self) -> None:
+        """Remove least recently used entries beyond max_entries / max_bytes"""
+        entries = self.entries()
+        too_many = entries.index >= (
+            len(entries) if self.max_entries is None else self.max_entries
+        )
+        too_big = (
+            entries["size"].cumsum() > self.max_bytes
+            if self.max_bytes is not None
+            else False
+        )
+        for key in entries.loc[too_many | too_big, "key"]:
+            info(f"Evicting cache entry {key}")
+            self._file(key).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        for key in self.entries()["key"]:
+            self._file(key).unlink(missing_ok=True)
+
+
+########################################################################################
+def cached(cache: DiskCache, sources=None):
+    """
+    Decorator: cache func's results in cache, keyed by func's name, its call
+    arguments (defaults included) and the fingerprints of the files returned by
+    sources(). sources is called before every lookup, so it can also bring the
+    source files up to date first (e.g. by requesting the job producing them).
+    The decorated function takes an extra keyword argument use_cache (default True).
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, use_cache: bool = True, **kwargs):
+            if not use_cache:
+                return func(*args, **kwargs)
+            call = signature.bind(*args, **kwargs)
+            call.apply_defaults()
+            key = cache.key(
+                f"{func.__module__}.{func.__qualname__}",
+                params=dict(call.arguments),
+                sources=() if sources is None else sources(),
+            )
+            return cache.get_or_compute(key, lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+########################################################################################
+# TESTING CODE
+########################################################################################
+if __name__ == "__main__":
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as tmp_dir:
+        test_cache = DiskCache(tmp_dir, max_entries=2)
+        source_file = Path(tmp_dir) / "source.txt"
+        source_file.write_text("version 1")
+        calls = []
+
+        @cached(test_cache, sources=lambda: [source_file])
+        def slow_square(x, offset=0):
+            calls.append(x)
+            return pd.DataFrame({"x": [x * x + offset]})
+
+        assert slow_square(3).x[0] == 9 and slow_square(3).x[0] == 9
+        assert calls == [3]
+        source_file.write_text("version 2, changed")
+        slow_square(3)
+        assert calls == [3, 3]
+        slow_square(4)
+        slow_square(5)
+        print(test_cache.entries())
+        assert len(test_cache.entries()) == 2
+        slow_square(5, use_cache=False)
+        assert calls == [3, 3, 4, 5, 5]
+
+        # entry of a class that no longer exists: a miss, recomputed
+        test_cache._file("stale").write_bytes(b"cno_such_module\nGone\n.")
+        assert test_cache.get("stale") is None
+        assert test_cache.get_or_compute("stale", lambda: 42) == 42
+
+    values = np.arange(12.0).reshape(3, 4)
+    assert data_fingerprint(values) == data_fingerprint(sparse.csc_matrix(values).toarray())
+    assert data_fingerprint(values) != data_fingerprint(values.T)
+    assert data_fingerprint(sparse.csc_matrix(values)) == data_fingerprint(
+        sparse.csr_matrix(values)
+    )
@@ -5,36 +5,199 @@ Created on Wed Mar  6 15:33:01 2019
 Data frame related functions
 @author: kpf
 """
+import warnings
+
 import numpy as np
 import pandas as pd
+from pandas.api.extensions import take
 
+from pa_lib.period import IsoPeriodArray
 from pa_lib.type import dtFactor, dtKW, dtYear
 from pa_lib.util import format_size, flatten, flat_list
 
 
 ########################################################################################
-def desc_col(df, det=False):
+def _hll_nunique(hashes, precision=14):
+    """HyperLogLog estimate of the number of distinct values behind 64-bit hashes.
+       Standard error is about 1.04 / sqrt(2 ** precision), i.e. 0.8% by default."""
+    n_reg = 1 << precision
+    hashes = np.asarray(hashes, dtype="uint64")
+    if hashes.size == 0:
+        return 0
+    bucket = (hashes >> np.uint64(64 - precision)).astype("intp")
+    rest = (hashes << np.uint64(precision)).astype("float64")
+    # rank = position of the leftmost 1-bit in the remaining bits
+    max_rank = 64 - precision + 1
+    with np.errstate(divide="ignore"):
+        rank = np.clip(64 - np.floor(np.log2(rest)), 1, max_rank).astype("int8")
+    registers = np.zeros(n_reg, dtype="int8")
+    np.maximum.at(registers, bucket, rank)
+    alpha = 0.7213 / (1 + 1.079 / n_reg)
+    estimate = alpha * n_reg ** 2 / np.sum(np.exp2(-registers.astype("float64")))
+    empty = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * n_reg and empty > 0:
+        # small cardinalities: linear counting is more precise
+        estimate = n_reg * np.log(n_reg / empty)
+    return int(round(estimate))
+
+
+def _sorted_nunique(arr, n_valid):
+    """Count unique values per column of a 2D array, invalid values sorted to the end"""
+    n_rows = arr.shape[0]
+    if n_rows < 2:
+        return (n_valid > 0).astype("int64")
+    srt = np.sort(arr, axis=0)
+    changes = srt[1:] != srt[:-1]
+    in_valid = np.arange(n_rows - 1)[:, np.newaxis] < (n_valid - 1)[np.newaxis, :]
+    return (changes & in_valid).sum(axis=0) + (n_valid > 0)
+
+
+def _desc_array_group(df, positions, approx):
+    """Nulls, unique counts and range for columns sharing one numeric/datetime dtype"""
+    block = df.iloc[:, positions]
+    dtype = block.dtypes.iloc[0]
+    arr = block.to_numpy()
+    if dtype.kind == "M":
+        arr = arr.view("int64")
+        nulls = arr == np.iinfo("int64").min
+        arr = np.where(nulls, np.iinfo("int64").max, arr)  # sort NaT to the end
+    elif dtype.kind == "f":
+        nulls = np.isnan(arr)
+    else:
+        nulls = np.zeros(arr.shape, dtype="bool")
+    n_null = nulls.sum(axis=0)
+    n_valid = arr.shape[0] - n_null
+
+    if approx:
+        n_unique = [
+            _hll_nunique(pd.util.hash_array(arr[~nulls[:, j], j]))
+            for j in range(arr.shape[1])
+        ]
+    else:
+        n_unique = _sorted_nunique(arr, n_valid)
+
+    if arr.shape[0] > 0 and dtype.kind == "f":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+            col_min, col_max = np.nanmin(arr, axis=0), np.nanmax(arr, axis=0)
+    elif arr.shape[0] > 0:
+        col_min = arr.min(axis=0)
+        if dtype.kind == "M":
+            col_max = np.where(nulls, np.iinfo("int64").min, arr).max(axis=0)
+        else:
+            col_max = arr.max(axis=0)
+    else:
+        col_min = col_max = np.full(arr.shape[1], np.nan)
+    if dtype.kind == "M":
+        col_min, col_max = (
+            [pd.Timestamp(v) if n else pd.NaT for v, n in zip(vals.view(dtype), n_valid)]
+            for vals in (col_min, col_max)
+        )
+    return n_null, n_unique, col_min, col_max
+
+
+def _desc_category(col):
+    """Nulls, unique counts and range of a categorical, computed on its codes"""
+    codes = col.cat.codes.to_numpy()
+    valid_codes = codes[codes >= 0]
+    used = np.flatnonzero(np.bincount(valid_codes, minlength=len(col.cat.categories)))
+    if len(used) == 0:
+        return len(codes), 0, np.nan, np.nan
+    used_cats = col.cat.categories[used]
+    if col.cat.ordered:
+        col_min, col_max = used_cats[0], used_cats[-1]
+    else:
+        col_min, col_max = used_cats.min(), used_cats.max()
+    return len(codes) - len(valid_codes), len(used), col_min, col_max
+
+
+def _desc_other(col, sample_col, approx):
+    """Nulls, unique counts and range of any other column type (strings, objects)"""
+    valid = col.dropna()
+    if approx:
+        hashes = pd.util.hash_pandas_object(valid, index=False, categorize=False)
+        n_unique = _hll_nunique(hashes.to_numpy())
+    else:
+        n_unique = valid.nunique()
+    return (
+        len(col) - len(valid),
+        n_unique,
+        sample_col.min(skipna=True),
+        sample_col.max(skipna=True),
+    )
+
+
+def desc_col(df, det=False, sample=None, random_state=None):
+    """
+    Describe columns of a DataFrame: dtype, nulls/not-nulls, number of unique values.
+    With det=True, deep memory usage and value range are added.
+
+    Statistics are computed in one pass per dtype group (numeric and datetime columns
+    of the same dtype are processed together as one 2D array).
+    If sample (a number of rows) is given, null counts stay exact, unique counts are
+    HyperLogLog estimates over all rows, value range of object columns and memory
+    usage of object and string columns are taken from a random sample of that many
+    rows (memory extrapolated to all rows). Use this on wide frames
+    with millions of rows.
+
+    :param df: DataFrame to describe
+    :param det: add memory usage and value range?
+    :param sample: number of rows to sample, None (default) means exact statistics
+    :param random_state: seed for drawing the sample
+    :return: DataFrame with one row per column of df
+    """
+    n_rows = df.shape[0]
+    approx = sample is not None and sample < n_rows
+    sample_df = df.sample(n=sample, random_state=random_state) if approx else df
+
+    # group column positions by dtype
+    array_groups, other_positions = {}, []
+    for pos, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, np.dtype) and dtype.kind in "biufM":
+            array_groups.setdefault(dtype, []).append(pos)
+        else:
+            other_positions.append(pos)
+
+    stats = [None] * df.shape[1]
+    for positions in array_groups.values():
+        for pos, *col_stats in zip(
+            positions, *_desc_array_group(df, positions, approx)
+        ):
+            stats[pos] = col_stats
+    for pos in other_positions:
+        col = df.iloc[:, pos]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            stats[pos] = _desc_category(col)
+        else:
+            stats[pos] = _desc_other(col, sample_df.iloc[:, pos], approx)
+
+    result = pd.DataFrame(
+        {
+            "DTYPE": df.dtypes.to_list(),
+            "NULLS": [f"{n_null}/{n_rows - n_null}" for (n_null, *_) in stats],
+            "UNIQUE": [n_unique for (_, n_unique, *_) in stats],
+        },
+        index=df.columns,
+        dtype="object",
+    )
     if det:
-        return df.apply(
-            lambda col: pd.Series(
-                [
-                    col.dtype,
-                    f"{len(col) - col.count()}/{col.count()}",
-                    col.nunique(),
-                    format_size(col.memory_usage(deep=True)),
-                    f"[{col.min(skipna=True)},{col.max(skipna=True)}]",
-                ],
-                index="DTYPE NULLS UNIQUE MEM RANGE".split(),
-            ),
-            result_type="expand",
-        ).transpose()
-    return df.apply(
-        lambda col: pd.Series(
-            [col.dtype, f"{len(col) - col.count()}/{col.count()}", col.nunique()],
-            index="DTYPE NULLS UNIQUE".split(),
-        ),
-        result_type="expand",
-    ).transpose()
+        mem = df.memory_usage(deep=not approx, index=False).to_numpy()
+        if approx:
+            # deep memory of variable-width columns (object, string) is extrapolated
+            # from the sample, categories are exact (codes plus categories, cheap)
+            is_fixed = df.dtypes.map(
+                lambda dtype: isinstance(dtype, np.dtype) and dtype.kind in "biufcmM"
+            ).to_numpy(dtype=bool)
+            sample_mem = sample_df.memory_usage(deep=True, index=False).to_numpy()
+            mem = np.where(is_fixed, mem, sample_mem * n_rows / sample)
+            for pos in other_positions:
+                if isinstance(df.dtypes.iloc[pos], pd.CategoricalDtype):
+                    mem[pos] = df.iloc[:, pos].memory_usage(deep=True, index=False)
+        result = result.assign(
+            MEM=[format_size(nbytes) for nbytes in mem],
+            RANGE=[f"[{col_min},{col_max}]" for (*_, col_min, col_max) in stats],
+        )
+    return result
 
 
 def flatten_multi_index_cols(df, sep="_"):
@@ -200,6 +363,88 @@ def make_sumcurve(df, sum_col_name, crv_col_name, on, part_by):
     return df
 
 
+########################################################################################
+def _sorted_groups(df, by, order_by=None):
+    """Sort rows once by group (and order_by within groups).
+       Returns row positions in sorted order, their group codes (0..n_groups-1),
+       and the positions of each group's first row within the sorted order.
+       Rows with null group keys are dropped, as in groupby."""
+    codes = df.groupby(flat_list(by), sort=True, observed=True).ngroup().to_numpy()
+    codes = np.where(np.isnan(codes.astype("float")), -1, codes).astype("int64")
+    sort_df = pd.DataFrame({"_group_code": codes})
+    sort_cols = ["_group_code"]
+    if order_by is not None:
+        for col in flat_list(order_by):
+            sort_df[col] = df[col].to_numpy()
+            sort_cols.append(col)
+    order = sort_df.sort_values(sort_cols, kind="mergesort").index.to_numpy()
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    return order, sorted_codes, group_starts
+
+
+def _group_index(df, by, order, group_starts):
+    """Index of group keys, in the order of group codes"""
+    keys = df[flat_list(by)].iloc[order[group_starts]]
+    return pd.MultiIndex.from_frame(keys) if keys.shape[1] > 1 else pd.Index(keys.iloc[:, 0])
+
+
+def _nth_valid(df, by, cols, order_by, last):
+    order, sorted_codes, group_starts = _sorted_groups(df, by, order_by)
+    n_groups = len(group_starts)
+    if cols is None:
+        cols = [c for c in df.columns if c not in flat_list([by, order_by])]
+    result = {}
+    for col in flat_list(cols):
+        valid = np.flatnonzero(df[col].iloc[order].notna().to_numpy())
+        valid_codes = sorted_codes[valid]
+        if last:
+            is_pick = np.r_[valid_codes[1:] != valid_codes[:-1], True]
+        else:
+            is_pick = np.r_[True, valid_codes[1:] != valid_codes[:-1]]
+        row_pos = np.full(n_groups, -1)
+        row_pos[valid_codes[is_pick]] = order[valid[is_pick]]
+        result[col] = take(df[col].array, row_pos, allow_fill=True)
+    return pd.DataFrame(result, index=_group_index(df, by, order, group_starts))
+
+
+def last_valid(df, by, cols=None, order_by=None):
+    """Last not-null value of columns 'cols' per group of 'by' (after sorting by
+       'order_by' within groups). Like groupby().agg() with a "last not-null" function,
+       but all rows are sorted once and the values are picked at group boundaries.
+       Groups without any not-null value get a null.
+       'cols' defaults to all columns not in 'by' or 'order_by'."""
+    return _nth_valid(df, by, cols, order_by, last=True)
+
+
+def first_valid(df, by, cols=None, order_by=None):
+    """First not-null value of columns 'cols' per group of 'by' (after sorting by
+       'order_by' within groups). See last_valid()"""
+    return _nth_valid(df, by, cols, order_by, last=False)
+
+
+def collect_unique(df, by, col, sep=",", sort=False, order_by=None):
+    """String concatenation of the unique not-null values of column 'col' per group
+       of 'by', separated by 'sep'. Values are in order of first appearance
+       (after sorting by 'order_by' within groups), or sorted if sort=True.
+       Groups without any not-null value get an empty string."""
+    order, sorted_codes, group_starts = _sorted_groups(df, by, order_by)
+    values = pd.DataFrame({"code": sorted_codes, "value": df[col].iloc[order].array})
+    values = values.dropna().drop_duplicates()
+    if sort:
+        values = values.sort_values(["code", "value"], kind="mergesort")
+    collected = (
+        values.assign(value=values["value"].astype("str"))
+        .groupby("code", sort=True)["value"]
+        .agg(sep.join)
+        .reindex(range(len(group_starts)), fill_value="")
+    )
+    return pd.Series(
+        collected.to_numpy(), index=_group_index(df, by, order, group_starts), name=col
+    )
+
+
 ########################################################################################
 def make_isoyear(df, dt_col, yr_col="YEAR"):
     df.loc[:, yr_col] = df[dt_col].dt.strftime("%G").astype("int16")
@@ -241,10 +486,20 @@ def make_isoweek_rd(df, kw_col, round_by=()):
     return df
 
 
+def make_isoperiod(df, dt_col, period_col="PERIOD", round_by=2):
+    """Make a column of {round_by}-week periods out of a date column.
+       Uses the isoperiod type (pa_lib.period): stored as integer ordinals,
+       supports period arithmetic, differences and comparisons."""
+    return df.assign(
+        **{period_col: IsoPeriodArray.from_dates(df[dt_col], rd=round_by)}
+    )
+
+
 def make_period_diff(
     df, year_col_1, period_col_1, year_col_2, period_col_2, diff_col="diff", round_by=2
 ):
-    """Calculates difference (in periods) between two year/period column pairs"""
+    """Calculates difference (in periods) between two year/period column pairs.
+       On isoperiod columns (see make_isoperiod), simply subtract them."""
     return df.eval(
         f"{diff_col} = ({year_col_2} - {year_col_1}) * (52 // {round_by}) \
                                 + ({period_col_2} - {period_col_1})"
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+As-of queries over per-key event histories (bookings, CRM contacts, ...):
+    * EventIndex: events sorted by key and date, built once
+    * first / last event, event counts in date windows, per key, "as of" any date
+    * last / count per category (e.g. per customer and Kanal), as a wide table
+      or a sparse matrix
+
+Layout is CSR-style: the events of key k are the sorted dates[offsets[k]:offsets[k+1]].
+Keys and dates are combined into one sorted integer array (key code, date rank),
+so "events before date d" is a single vectorised searchsorted for all keys:
+O(keys · log events) per query, instead of filtering and regrouping all events.
+
+@author: kpf
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pa_lib.util import flat_list
+
+
+########################################################################################
+class EventIndex:
+    """
+    Index of the events in df, per key (column(s) by), sorted by date_col.
+    Events with a missing key or date are ignored.
+
+    All queries count events strictly before the view date and return values for
+    all keys (self.keys), aligned to them.
+    """
+
+    def __init__(self, df: pd.DataFrame, by, date_col: str):
+        self.by = flat_list(by)
+        events = df.dropna(subset=self.by + [date_col])
+        if len(self.by) == 1:
+            (codes, keys) = pd.factorize(events[self.by[0]], sort=True)
+            self.keys = pd.Index(np.asarray(keys), name=self.by[0])
+        else:
+            (codes, keys) = pd.MultiIndex.from_frame(events[self.by]).factorize(
+                sort=True
+            )
+            self.keys = pd.MultiIndex.from_tuples(keys, names=self.by)
+
+        dates = events[date_col].to_numpy(dtype="datetime64[ns]")
+        date_order = np.argsort(dates, kind="stable")
+        sorted_dates = dates[date_order]
+        is_new = np.r_[True, sorted_dates[1:] != sorted_dates[:-1]]
+        self.unique_dates = sorted_dates[is_new]
+        n_dates = len(self.unique_dates)
+        rank = np.empty(len(dates), dtype="int64")
+        rank[date_order] = np.cumsum(is_new) - 1
+
+        # sort by key, then date: one sort key for (key code, date rank)
+        order = date_order[np.argsort(codes[date_order], kind="stable")]
+        self._sort_key = codes[order].astype("int64") * n_dates + rank[order]
+        self.dates = dates[order]
+        self.offsets = np.searchsorted(
+            self._sort_key, np.arange(len(self.keys) + 1) * n_dates
+        )
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _end(self, view_date) -> np.ndarray:
+        """Per key: position after its last event before view_date"""
+        view_date = np.datetime64(pd.Timestamp(view_date).to_datetime64(), "ns")
+        rank = np.searchsorted(self.unique_dates, view_date, side="left")
+        key_start = np.arange(len(self.keys)) * len(self.unique_dates)
+        return np.searchsorted(self._sort_key, key_start + rank, side="left")
+
+    def _dates_at(self, positions, has_event) -> pd.Series:
+        values = self.dates[np.clip(positions, 0, max(len(self.dates) - 1, 0))]
+        return pd.Series(
+            np.where(has_event, values, np.datetime64("NaT")), index=self.keys
+        )
+
+    def count(self, view_date, since=None) -> pd.Series:
+        """Number of events in [since, view_date), all events before view_date if
+        since is None"""
+        start = self.offsets[:-1] if since is None else self._end(since)
+        return pd.Series(
+            np.maximum(self._end(view_date) - start, 0), index=self.keys, name="COUNT"
+        )
+
+    def first(self, view_date) -> pd.Series:
+        """Date of the first event before view_date (NaT if none)"""
+        start = self.offsets[:-1]
+        return self._dates_at(start, self._end(view_date) > start).rename("FIRST")
+
+    def last(self, view_date) -> pd.Series:
+        """Date of the last event before view_date (NaT if none)"""
+        end = self._end(view_date)
+        return self._dates_at(end - 1, end > self.offsets[:-1]).rename("LAST")
+
+    def as_of(self, view_date) -> pd.DataFrame:
+        """First and last event date and event count, for keys with events before
+        view_date"""
+        end = self._end(view_date)
+        (start, has_event) = (self.offsets[:-1], end > self.offsets[:-1])
+        result = pd.DataFrame(
+            {
+                "FIRST": self._dates_at(start, has_event),
+                "LAST": self._dates_at(end - 1, has_event),
+                "COUNT": end - start,
+            }
+        )
+        return result.loc[has_event]
+
+    def last_per(self, view_date, level) -> pd.DataFrame:
+        """Last event date before view_date, one column per value of key level
+        (e.g. per Kanal), for keys with events before view_date"""
+        last = self.last(view_date)
+        return last.loc[last.notna()].unstack(level)
+
+    def count_matrix(self, view_date, since=None):
+        """
+        Event count in [since, view_date) as sparse CSR matrix, for two-level keys:
+        rows are values of the first level (e.g. customers), columns of the second
+        (e.g. Branchen), both sorted, limited to those with events in that window.
+        Built directly from the key codes, without a dense intermediate.
+
+        :return: (matrix, row values, column values)
+        """
+        if len(self.by) != 2:
+            raise ValueError(f"count_matrix needs two key levels, got {self.by}")
+        count = self.count(view_date, since).to_numpy()
+        has_event = count > 0
+        (rows, cols) = (
+            np.asarray(level_codes)[has_event] for level_codes in self.keys.codes
+        )
+        (row_values, rows) = np.unique(rows, return_inverse=True)
+        (col_values, cols) = np.unique(cols, return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (count[has_event], (rows, cols)), shape=(len(row_values), len(col_values))
+        )
+        return (
+            matrix,
+            self.keys.levels[0][row_values],
+            self.keys.levels[1][col_values],
+        )
+
+    def count_per(self, view_date, level, since=None) -> pd.DataFrame:
+        """Event count in [since, view_date), one column per value of key level,
+        for keys with events in that window. Missing combinations are 0."""
+        count = self.count(view_date, since)
+        return count.loc[count > 0].unstack(level, fill_value=0)
+
+
+########################################################################################
+# TESTING CODE
+########################################################################################
+if __name__ == "__main__":
+    from time import perf_counter
+
+    rng = np.random.default_rng(0)
+    n_events = 2_000_000
+    events = pd.DataFrame(
+        {
+            "Endkunde_NR": rng.integers(100_000, 200_000, n_events),
+            "Kanal": rng.choice(["Besuch", "Telefon", "E-Mail"], n_events),
+            "Datum": pd.Timestamp("2010-01-01")
+            + pd.to_timedelta(rng.integers(0, 3650 * 86400, n_events), unit="s"),
+        }
+    )
+    view_date = pd.Timestamp("2018-06-01")
+
+    start = perf_counter()
+    idx = EventIndex(events, by="Endkunde_NR", date_col="Datum")
+    print(f"Build: {perf_counter() - start:.2f}s")
+    start = perf_counter()
+    as_of = idx.as_of(view_date)
+    print(f"as_of: {perf_counter() - start:.3f}s")
+    start = perf_counter()
+    past = events.loc[events.Datum < view_date]
+    ref = past.groupby("Endkunde_NR").Datum.agg(["min", "max", "count"])
+    print(f"groupby: {perf_counter() - start:.3f}s")
+    assert (as_of.FIRST == ref["min"]).all() and (as_of.LAST == ref["max"]).all()
+    assert (as_of.COUNT == ref["count"]).all()
+
+    kanal_idx = EventIndex(events, by=["Endkunde_NR", "Kanal"], date_col="Datum")
+    last_kanal = kanal_idx.last_per(view_date, level="Kanal")
+    ref_kanal = past.groupby(["Endkunde_NR", "Kanal"]).Datum.max().unstack("Kanal")
+    pd.testing.assert_frame_equal(last_kanal, ref_kanal.astype("datetime64[ns]"))
+    year_ago = view_date - pd.DateOffset(years=1)
+    window = kanal_idx.count_per(view_date, level="Kanal", since=year_ago)
+    print(window.head())
+    (matrix, customers, kanals) = kanal_idx.count_matrix(view_date, since=year_ago)
+    assert (matrix.toarray() == window.to_numpy()).all()
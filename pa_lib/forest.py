@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch scoring of fitted sklearn tree ensembles (RandomForestClassifier,
+ExtraTreesClassifier) from flat numpy arrays:
+    * ForestArrays: all trees padded to complete binary trees of the forest's
+      depth, stored level by level (split feature, threshold) plus the leaf class
+      probabilities, so a node's children are found by position, not by lookup
+    * predict_proba: all trees descend together, one level per vectorised step,
+      for batches of rows, optionally for blocks of rows in worker processes
+
+Padding nodes below an early leaf send every row left (threshold +inf) and
+repeat the leaf's probabilities at the bottom level. Thresholds are stored as the
+largest float32 not above sklearn's float64 threshold, so comparing float32 rows
+(as sklearn does) gives the same decisions as sklearn.
+
+A call has almost no overhead: a few rows score in well below a millisecond,
+where sklearn's predict_proba takes about 0.1s for a forest of 1000 trees. Large
+batches score about as fast as with sklearn (0.8x to 1.1x on one CPU).
+
+The complete layout has 2^max_depth leaves per tree: this is meant for depth
+limited forests (as in vkprog, max_depth 7 to 10), see MAX_DEPTH.
+
+@author: kpf
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+MAX_DEPTH = 16
+
+
+########################################################################################
+def _float32_at_most(values: np.ndarray) -> np.ndarray:
+    """Largest float32 values not above float64 values"""
+    rounded = values.astype("float32")
+    return np.where(rounded > values, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+
+
+class ForestArrays:
+    """
+    Fitted classification forest as complete binary trees of depth max_depth.
+    At level d, node i (0 <= i < 2^d) of tree t splits on feature[d][t, i] at
+    threshold[d][t, i]: rows with x <= threshold go to node 2i, others to 2i + 1
+    of level d + 1. proba[c][t, i] is the probability of class c at bottom node i.
+    """
+
+    def __init__(self, feature, threshold, proba, classes):
+        self.feature = feature
+        self.threshold = threshold
+        self.proba = proba
+        self.classes_ = classes
+
+    @classmethod
+    def from_model(cls, forest) -> "ForestArrays":
+        """Export a fitted sklearn forest classifier (single output)"""
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        max_depth = max(tree.max_depth for tree in trees)
+        if max_depth > MAX_DEPTH:
+            raise ValueError(
+                f"ForestArrays: trees of depth {max_depth} (maximum {MAX_DEPTH})"
+            )
+        offsets = np.r_[0, np.cumsum([tree.node_count for tree in trees])]
+
+        def concat(attribute, shift=False):
+            return np.concatenate(
+                [
+                    getattr(tree, attribute) + (start if shift else 0)
+                    for (tree, start) in zip(trees, offsets)
+                ]
+            )
+
+        left = concat("children_left", shift=True)
+        right = concat("children_right", shift=True)
+        is_leaf = concat("children_left") < 0
+        (split_feature, split_threshold) = (concat("feature"), concat("threshold"))
+        value = concat("value")[:, 0, :]
+        total = value.sum(axis=1, keepdims=True)
+        value = np.divide(value, total, out=np.zeros_like(value), where=total > 0)
+
+        (feature, threshold) = ([], [])
+        nodes = offsets[:-1, np.newaxis]  # tree × level nodes (sklearn node ids)
+        for _ in range(max_depth):
+            leaf = is_leaf[nodes]
+            feature.append(np.where(leaf, 0, split_feature[nodes]).astype("int32"))
+            threshold.append(
+                _float32_at_most(np.where(leaf, np.inf, split_threshold[nodes]))
+            )
+            children = np.stack(
+                [np.where(leaf, nodes, left[nodes]), np.where(leaf, nodes, right[nodes])],
+                axis=-1,
+            )
+            nodes = children.reshape(len(trees), -1)
+        proba = [np.ascontiguousarray(value[nodes, col]) for col in range(value.shape[1])]
+        return cls(feature, threshold, proba, np.asarray(forest.classes_))
+
+    @property
+    def n_trees(self) -> int:
+        return self.proba[0].shape[0]
+
+    @property
+    def max_depth(self) -> int:
+        return len(self.feature)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the arrays"""
+        return sum(proba.nbytes for proba in self.proba) + sum(
+            feature.nbytes + threshold.nbytes
+            for (feature, threshold) in zip(self.feature, self.threshold)
+        )
+
+    def leaves(self, X: np.ndarray) -> np.ndarray:
+        """
+        Bottom node of each row (dense float32 batch) in each tree: rows × trees,
+        as position in the (tree, node) flattened bottom level
+        """
+        (n_rows, n_features) = X.shape
+        values = X.ravel()
+        row_start = np.arange(n_rows, dtype="int64")[:, np.newaxis] * n_features
+        # position at level d: tree * 2^d + node, so children are at 2 * position (+ 1)
+        position = np.broadcast_to(
+            np.arange(self.n_trees, dtype="int64"), (n_rows, self.n_trees)
+        )
+        for (feature, threshold) in zip(self.feature, self.threshold):
+            x = values[row_start + feature.ravel()[position]]
+            position = 2 * position + (x > threshold.ravel()[position])
+        return position
+
+    def proba_sum(self, X, batch_size: int = 500) -> np.ndarray:
+        """Sum of all trees' class probabilities per row of X (dense or sparse)"""
+        result = np.zeros((X.shape[0], len(self.proba)))
+        for start in range(0, X.shape[0], batch_size):
+            rows = slice(start, start + batch_size)
+            batch = X[rows]
+            batch = batch.toarray() if sparse.issparse(batch) else np.asarray(batch)
+            leaves = self.leaves(np.ascontiguousarray(batch, dtype="float32"))
+            for (col, proba) in enumerate(self.proba):
+                result[rows, col] = proba.ravel()[leaves].sum(axis=1)
+        return result
+
+    def predict_proba(
+        self, X, batch_size: int = 500, n_jobs: int = 1, block_rows: int = 20_000
+    ) -> np.ndarray:
+        """
+        Class probabilities per row of X, as sklearn's predict_proba.
+        n_jobs > 1: blocks of block_rows rows are scored in n_jobs worker processes,
+        which receive the forest once; each block is sent to one worker only, with
+        at most 2 * n_jobs blocks in flight
+        """
+        if n_jobs == 1:
+            total = self.proba_sum(X, batch_size)
+        else:
+            total = np.empty((X.shape[0], len(self.proba)))
+            with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker, initargs=(self,)
+            ) as pool:
+                pending = deque()
+                for start in range(0, X.shape[0], block_rows):
+                    rows = slice(start, start + block_rows)
+                    pending.append((rows, pool.submit(_proba_sum, X[rows], batch_size)))
+                    if len(pending) >= 2 * n_jobs:
+                        (done, job) = pending.popleft()
+                        total[done] = job.result()
+                while pending:
+                    (done, job) = pending.popleft()
+                    total[done] = job.result()
+        return total / self.n_trees
+
+    def predict(self, X, batch_size: int = 500, n_jobs: int = 1) -> np.ndarray:
+        proba = self.predict_proba(X, batch_size, n_jobs)
+        return self.classes_[proba.argmax(axis=1)]
+
+
+# worker process state (n_jobs > 1), see _init_worker
+_worker = {}
+
+
+def _init_worker(arrays: ForestArrays) -> None:
+    _worker.update(arrays=arrays)
+
+
+def _proba_sum(X_block, batch_size: int) -> np.ndarray:
+    return _worker["arrays"].proba_sum(X_block, batch_size)
+
+
+########################################################################################
+# TESTING CODE
+########################################################################################
+if __name__ == "__main__":
+    import pickle
+    from time import perf_counter
+
+    from sklearn.datasets import make_classification
+    from sklearn.ensemble import RandomForestClassifier
+
+    from pa_lib.util import format_size
+
+    (X, y) = make_classification(
+        n_samples=20_000, n_features=150, n_informative=30, random_state=42
+    )
+    forest = RandomForestClassifier(
+        n_estimators=500, max_depth=10, n_jobs=-1, random_state=42
+    ).fit(X[:10_000], y[:10_000])
+    X_score = X[10_000:]
+
+    start = perf_counter()
+    arrays = ForestArrays.from_model(forest)
+    print(f"Export: {perf_counter() - start:.2f}s")
+    print(
+        f"Memory: arrays {format_size(arrays.nbytes)},"
+        f" pickled sklearn forest {format_size(len(pickle.dumps(forest)))}"
+    )
+
+    forest.set_params(n_jobs=1)
+    start = perf_counter()
+    sk_proba = forest.predict_proba(X_score)
+    sk_time = perf_counter() - start
+    for n_jobs in (1, 2):
+        start = perf_counter()
+        proba = arrays.predict_proba(X_score, n_jobs=n_jobs)
+        arr_time = perf_counter() - start
+        print(
+            f"sklearn (1 job): {sk_time:.2f}s, arrays ({n_jobs} jobs): {arr_time:.2f}s"
+            f" => speed-up {sk_time / arr_time:.1f}x"
+        )
+        assert np.allclose(proba, sk_proba)
+    start = perf_counter()
+    for row in range(100):
+        forest.predict_proba(X_score[row : row + 1])
+    sk_time = perf_counter() - start
+    start = perf_counter()
+    for row in range(100):
+        arrays.predict_proba(X_score[row : row + 1])
+    arr_time = perf_counter() - start
+    print(f"100 single rows: sklearn {sk_time:.2f}s, arrays {arr_time:.2f}s")
+    assert (arrays.predict(sparse.csr_matrix(X_score)) == forest.predict(X_score)).all()
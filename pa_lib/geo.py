@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Matching of addresses to geographic units (Verkaufsgebiete, Gemeinden, regions):
+    * Normalised place name keys
+    * GeoIndex: lookup tables with precedence rules, built once from reference data,
+      resolving any number of addresses in one pass of vectorised hash lookups
+    * Ready-made indexes for Verkaufsgebiete (plz_data) and Gemeinden (Raumgliederungen)
+
+@author: kpf
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from pa_lib.data import collect_unique
+from pa_lib.util import flat_list
+
+
+########################################################################################
+def name_key(names: pd.Series) -> pd.Series:
+    """Normalised key for place names: case-folded, whitespace collapsed and trimmed"""
+    return (
+        names.astype("object")
+        .where(names.notna())
+        .str.casefold()
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def first_word_key(names: pd.Series) -> pd.Series:
+    """Normalised key of the first word of place names"""
+    return name_key(names).str.split(n=1).str[0]
+
+
+########################################################################################
+@dataclass
+class GeoRule:
+    """One lookup rule of a GeoIndex: reference table indexed by its key columns"""
+
+    name: str
+    on: List[str]  # key columns in the data to resolve
+    normalise: Dict[str, Callable]  # key column -> normalising function
+    table: pd.DataFrame  # indexed by key values, value columns and CNT
+
+    def keys(self, df: pd.DataFrame) -> pd.Index:
+        key_df = pd.DataFrame(
+            {
+                col: self.normalise.get(col, lambda s: s)(df[col]).to_numpy()
+                for col in self.on
+            }
+        )
+        if len(self.on) == 1:
+            return pd.Index(key_df.iloc[:, 0])
+        return pd.MultiIndex.from_frame(key_df)
+
+
+class GeoIndex:
+    """
+    Resolves addresses to values (e.g. Verkaufsgebiet code) by several lookup rules.
+
+    Each rule maps key columns (PLZ, normalised names, ...) to the values of all
+    reference rows with that key. If several reference rows share a key, their unique
+    values are collected as a comma-separated string (collect=True), or the first
+    value is taken (collect=False). CNT counts the reference rows with complete values per key.
+    Rules are tried in the order they were added. With count_precedence=True,
+    keys with fewer reference rows win first, then rule order decides.
+    """
+
+    def __init__(self, value_cols, count_precedence: bool = False, collect: bool = True):
+        self.value_cols = flat_list(value_cols)
+        self.count_precedence = count_precedence
+        self.collect = collect
+        self.rules: List[GeoRule] = []
+
+    def add_rule(self, name, ref, on, ref_on=None, normalise=None):
+        """
+        Add a lookup rule, built from a reference table
+
+        :param name: rule name, reported in column GEO_RULE of resolve()
+        :param ref: reference table containing key and value columns
+        :param on: key column(s) of the data to resolve
+        :param ref_on: corresponding key column(s) of ref, defaults to on
+        :param normalise: dict {key column in on: function}, applied to both sides
+        :return: self, to allow chaining
+        """
+        on = flat_list(on)
+        ref_on = on if ref_on is None else flat_list(ref_on)
+        normalise = {} if normalise is None else normalise
+        ref_keys = pd.DataFrame(
+            {
+                col: normalise.get(col, lambda s: s)(ref[ref_col]).to_numpy()
+                for col, ref_col in zip(on, ref_on)
+            }
+        )
+        ref_data = pd.concat(
+            [ref_keys, ref[self.value_cols].reset_index(drop=True)], axis="columns"
+        ).dropna(subset=on)
+        if self.collect:
+            values = pd.concat(
+                [collect_unique(ref_data, by=on, col=col) for col in self.value_cols],
+                axis="columns",
+            )
+            has_value = (values != "").any(axis="columns")
+        else:
+            values = ref_data.groupby(on, sort=True)[self.value_cols].first()
+            has_value = values.notna().any(axis="columns")
+        # keys without any value do not count as a match
+        counts = ref_data[self.value_cols].notna().all(axis="columns").groupby(
+            [ref_data[col] for col in on], sort=True
+        ).sum()
+        table = values.assign(CNT=counts).loc[has_value]
+        self.rules.append(GeoRule(name=name, on=on, normalise=normalise, table=table))
+        return self
+
+    def resolve(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Resolve all rows of df in one pass: look up every rule, pick the best match
+
+        :param df: data containing the key columns of all rules
+        :return: DataFrame (index of df) with value columns, GEO_RULE and GEO_CNT.
+                 Unmatched rows are null.
+        """
+        n_rules = len(self.rules)
+        priority = np.full((df.shape[0], n_rules), np.inf)
+        positions = np.full((df.shape[0], n_rules), -1)
+        for nr, rule in enumerate(self.rules):
+            pos = rule.table.index.get_indexer(rule.keys(df))
+            found = pos >= 0
+            positions[:, nr] = pos
+            priority[found, nr] = nr
+            if self.count_precedence:
+                priority[found, nr] += rule.table["CNT"].to_numpy()[pos[found]] * n_rules
+
+        best = priority.argmin(axis=1)
+        matched = np.isfinite(priority[np.arange(df.shape[0]), best])
+        result = pd.DataFrame(
+            {
+                col: np.full(df.shape[0], np.nan, dtype="object")
+                for col in self.value_cols + ["GEO_RULE", "GEO_CNT"]
+            },
+            index=df.index,
+        )
+        for nr, rule in enumerate(self.rules):
+            rows = matched & (best == nr)
+            picked = rule.table.iloc[positions[rows, nr]]
+            result.loc[rows, self.value_cols] = picked[self.value_cols].to_numpy()
+            result.loc[rows, "GEO_CNT"] = picked["CNT"].to_numpy()
+            result.loc[rows, "GEO_RULE"] = rule.name
+        return result.infer_objects()
+
+    def match_rates(self, resolved: pd.DataFrame) -> pd.DataFrame:
+        """Number and share of rows matched by each rule (and unmatched) in resolve()"""
+        rules = [rule.name for rule in self.rules] + ["(unmatched)"]
+        counts = (
+            resolved["GEO_RULE"].fillna("(unmatched)").value_counts().reindex(rules)
+        )
+        counts = counts.fillna(0).astype("int64")
+        return pd.DataFrame({"COUNT": counts, "SHARE": counts / max(counts.sum(), 1)})
+
+
+########################################################################################
+def vkgeb_index(plz_data: pd.DataFrame) -> GeoIndex:
+    """
+    Index resolving (PLZ, GEMEINDE) to VERKAUFS_GEBIETS_CODE and VB_VKGEB.
+    Customer town names are matched against plz_data's FRAKTION and ORT.
+    Precedence: keys with fewer plz_data rows first, then FRAKTION, PLZ, ORT.
+    """
+    return (
+        GeoIndex(["VERKAUFS_GEBIETS_CODE", "VB_VKGEB"], count_precedence=True)
+        .add_rule(
+            "FRAKTION",
+            plz_data,
+            on="GEMEINDE",
+            ref_on="FRAKTION",
+            normalise={"GEMEINDE": name_key},
+        )
+        .add_rule("PLZ", plz_data, on="PLZ")
+        .add_rule(
+            "ORT", plz_data, on="GEMEINDE", ref_on="ORT", normalise={"GEMEINDE": name_key}
+        )
+    )
+
+
+def gdenr_index(
+    plz_names: pd.DataFrame, plz: pd.DataFrame, names: pd.DataFrame
+) -> GeoIndex:
+    """
+    Index resolving (PLZ, GEMEINDE) to the BFS Gemeinde number GDENR.
+    Precedence: PLZ and town name, PLZ, town name, first word of town name.
+    Ambiguous keys (e.g. first words shared by several Gemeinden) take the first GDENR.
+    """
+    return (
+        GeoIndex("GDENR", collect=False)
+        .add_rule(
+            "PLZ_GEMEINDE",
+            plz_names,
+            on=["PLZ", "GEMEINDE"],
+            normalise={"GEMEINDE": name_key},
+        )
+        .add_rule("PLZ", plz, on="PLZ")
+        .add_rule("GEMEINDE", names, on="GEMEINDE", normalise={"GEMEINDE": name_key})
+        .add_rule(
+            "FIRST_WORD", names, on="GEMEINDE", normalise={"GEMEINDE": first_word_key}
+        )
+    )
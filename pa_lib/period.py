@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ISO week and rounded booking period type for pandas:
+    * IsoPeriod: scalar (year, period) of ISO weeks (rd=1) or periods of rd weeks
+    * IsoPeriodDtype / IsoPeriodArray: pandas extension type, stored as int32 ordinals
+    * iso_period_range: consecutive periods between two limits
+    * Series accessor ".iso" (year, period, ordinal, to_dates, round)
+
+Ordinals make period arithmetic integer arithmetic:
+    * ISO weeks (rd=1) are counted from ISO week 1970-01, so differences are true
+      week counts, also across 53-week years
+    * Periods of rd weeks (rd in 2, 4, 13, 26) are counted as year * (52 // rd) + index.
+      Week 53 belongs to the last complete period of its year (as in iso_week_rd),
+      so one year is always 52 // rd periods.
+A period is displayed by its first week: the 2-week periods of a year are 1, 3, ..., 51.
+
+@author: kpf
+"""
+import operator
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import (
+    ExtensionArray,
+    ExtensionDtype,
+    register_extension_dtype,
+    take,
+)
+from pandas.api.types import is_integer, is_list_like
+
+_NA = np.iinfo("int32").min  # ordinal marking missing values
+
+
+########################################################################################
+# VECTORISED CALENDAR ARITHMETIC
+########################################################################################
+def _check_rd(rd: int) -> int:
+    if rd != 1 and (rd < 1 or 52 % rd != 0):
+        raise ValueError(f"Period length must be 1 or divide 52 weeks, got {rd}")
+    return rd
+
+
+def _week_ordinal_from_days(days: np.ndarray) -> np.ndarray:
+    """Days since 1970-01-01 (a Thursday) to ISO week ordinals (week 1970-01 is 0)"""
+    return (days + 3) // 7
+
+
+def _iso_from_week_ordinal(week_ordinal: np.ndarray) -> tuple:
+    """ISO week ordinals to (ISO year, ISO week). The Thursday decides the ISO year."""
+    thursday = (week_ordinal.astype("int64") * 7).astype("datetime64[D]")
+    year_start = thursday.astype("datetime64[Y]")
+    week = (thursday - year_start.astype("datetime64[D]")).astype("int64") // 7 + 1
+    return year_start.astype("int64") + 1970, week
+
+
+def _week_ordinal_from_iso(year: np.ndarray, week: np.ndarray) -> np.ndarray:
+    """(ISO year, ISO week) to ISO week ordinals. January 4th is always in week 1."""
+    year_start = (np.asarray(year, dtype="int64") - 1970).astype("datetime64[Y]")
+    jan_4 = year_start.astype("datetime64[D]").astype("int64") + 3
+    return _week_ordinal_from_days(jan_4) + np.asarray(week, dtype="int64") - 1
+
+
+def _ordinal_from_iso(year, week, rd: int) -> np.ndarray:
+    """(ISO year, ISO week) to ordinals of rd-week periods"""
+    if rd == 1:
+        return _week_ordinal_from_iso(year, week)
+    per_year = 52 // rd
+    index = np.minimum((np.asarray(week, dtype="int64") - 1) // rd, per_year - 1)
+    return np.asarray(year, dtype="int64") * per_year + index
+
+
+def _iso_from_ordinal(ordinal: np.ndarray, rd: int) -> tuple:
+    """Ordinals of rd-week periods to (ISO year, first ISO week of period)"""
+    ordinal = np.asarray(ordinal, dtype="int64")
+    if rd == 1:
+        return _iso_from_week_ordinal(ordinal)
+    (year, index) = np.divmod(ordinal, 52 // rd)
+    return year, index * rd + 1
+
+
+def _ordinal_from_dates(dates, rd: int) -> np.ndarray:
+    """Any date-like values to ordinals of rd-week periods, NaT becomes _NA"""
+    dates = pd.to_datetime(pd.Series(dates)).to_numpy().astype("datetime64[D]")
+    missing = np.isnat(dates)
+    days = np.where(missing, 0, dates.astype("int64"))
+    week_ordinal = _week_ordinal_from_days(days)
+    if rd == 1:
+        ordinal = week_ordinal
+    else:
+        ordinal = _ordinal_from_iso(*_iso_from_week_ordinal(week_ordinal), rd=rd)
+    return np.where(missing, _NA, ordinal).astype("int32")
+
+
+def _dates_from_ordinal(ordinal: np.ndarray, rd: int, day: int = 1) -> np.ndarray:
+    """Ordinals to datetime64 of weekday 'day' (1 = Monday) in the first week of period"""
+    missing = np.asarray(ordinal) == _NA
+    ordinal = np.where(missing, 0, ordinal)
+    week_ordinal = (
+        ordinal if rd == 1 else _week_ordinal_from_iso(*_iso_from_ordinal(ordinal, rd))
+    )
+    days = week_ordinal.astype("int64") * 7 - 3 + (day - 1)
+    dates = days.astype("datetime64[D]").astype("datetime64[ns]")
+    dates[missing] = np.datetime64("NaT")
+    return dates
+
+
+########################################################################################
+# SCALAR TYPE
+########################################################################################
+@dataclass(frozen=True, order=True)
+class IsoPeriod:
+    """
+    One ISO week (rd=1) or one period of rd weeks, given as (ISO year, first week).
+    Any week number is rounded to its period, week 53 to the last complete period.
+    Adding/subtracting integers moves by whole periods, subtracting two periods
+    returns their difference in periods.
+    """
+
+    year: int
+    period: int
+    rd: int = 2
+
+    def __post_init__(self):
+        _check_rd(self.rd)
+        (year, period) = _iso_from_ordinal(
+            _ordinal_from_iso(self.year, self.period, self.rd), self.rd
+        )
+        object.__setattr__(self, "year", int(year))
+        object.__setattr__(self, "period", int(period))
+
+    @classmethod
+    def from_ordinal(cls, ordinal: int, rd: int = 2) -> "IsoPeriod":
+        (year, period) = _iso_from_ordinal(ordinal, _check_rd(rd))
+        return cls(int(year), int(period), rd)
+
+    @classmethod
+    def from_date(cls, date, rd: int = 2) -> "IsoPeriod":
+        return cls.from_ordinal(_ordinal_from_dates([date], _check_rd(rd))[0], rd)
+
+    @classmethod
+    def from_yyyykw(cls, yyyykw: int, rd: int = 2) -> "IsoPeriod":
+        """From the YYYYKW encoding (year * 100 + week)"""
+        return cls(yyyykw // 100, yyyykw % 100, rd)
+
+    @property
+    def ordinal(self) -> int:
+        return int(_ordinal_from_iso(self.year, self.period, self.rd))
+
+    @property
+    def yyyykw(self) -> int:
+        return self.year * 100 + self.period
+
+    def to_date(self, day: int = 1) -> pd.Timestamp:
+        """Weekday 'day' (1 = Monday) of the period's first week"""
+        return pd.Timestamp(_dates_from_ordinal(np.array([self.ordinal]), self.rd, day)[0])
+
+    def round(self, rd: int) -> "IsoPeriod":
+        """Same period start, rounded to periods of rd weeks"""
+        return IsoPeriod(self.year, self.period, rd)
+
+    def __add__(self, other):
+        if not is_integer(other):
+            return NotImplemented
+        return IsoPeriod.from_ordinal(self.ordinal + int(other), self.rd)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, IsoPeriod):
+            if other.rd != self.rd:
+                raise TypeError(f"Period lengths differ: {self.rd} vs. {other.rd}")
+            return self.ordinal - other.ordinal
+        if not is_integer(other):
+            return NotImplemented
+        return IsoPeriod.from_ordinal(self.ordinal - int(other), self.rd)
+
+    def __str__(self):
+        return f"{self.year}-{self.period:02d}"
+
+
+########################################################################################
+# PANDAS EXTENSION TYPE
+########################################################################################
+@register_extension_dtype
+class IsoPeriodDtype(ExtensionDtype):
+    """pandas dtype of IsoPeriod values, named 'isoperiod[rd]'"""
+
+    type = IsoPeriod
+    kind = "O"
+    _metadata = ("rd",)
+
+    def __init__(self, rd: int = 2):
+        self.rd = _check_rd(int(rd))
+
+    @property
+    def name(self) -> str:
+        return f"isoperiod[{self.rd}]"
+
+    @property
+    def periods_per_year(self):
+        """Number of periods in one year, None for ISO weeks (52 or 53)"""
+        return None if self.rd == 1 else 52 // self.rd
+
+    @classmethod
+    def construct_from_string(cls, string):
+        if not isinstance(string, str):
+            raise TypeError(f"Expected a string, got {type(string)}")
+        if string == "isoperiod":
+            return cls()
+        if string.startswith("isoperiod[") and string.endswith("]"):
+            try:
+                return cls(int(string[len("isoperiod[") : -1]))
+            except ValueError:
+                pass
+        raise TypeError(f"Cannot construct a 'IsoPeriodDtype' from '{string}'")
+
+    @classmethod
+    def construct_array_type(cls):
+        return IsoPeriodArray
+
+
+class IsoPeriodArray(ExtensionArray):
+    """
+    Array of IsoPeriod values, stored as int32 ordinals.
+    Supports +/- integers, differences between periods (as nullable integers)
+    and comparisons, all computed on the ordinals.
+    """
+
+    __array_priority__ = 1000  # let numpy arrays defer to our operators
+
+    def __init__(self, ordinals, rd: int = 2, copy: bool = False):
+        self._ordinals = np.asarray(ordinals, dtype="int32")
+        if copy:
+            self._ordinals = self._ordinals.copy()
+        self._dtype = IsoPeriodDtype(rd)
+
+    # Constructors ######################################################################
+    @classmethod
+    def from_dates(cls, dates, rd: int = 2) -> "IsoPeriodArray":
+        """Periods containing each date, NaT becomes missing"""
+        return cls(_ordinal_from_dates(dates, _check_rd(rd)), rd)
+
+    @classmethod
+    def from_year_period(cls, year, period, rd: int = 2) -> "IsoPeriodArray":
+        """From ISO years and week numbers (rounded to periods), NaNs become missing"""
+        year = pd.Series(year, dtype="float64").to_numpy()
+        period = pd.Series(period, dtype="float64").to_numpy()
+        missing = np.isnan(year) | np.isnan(period)
+        ordinal = _ordinal_from_iso(
+            np.where(missing, 1970, year), np.where(missing, 1, period), _check_rd(rd)
+        )
+        return cls(np.where(missing, _NA, ordinal), rd)
+
+    @classmethod
+    def from_yyyykw(cls, yyyykw, rd: int = 2) -> "IsoPeriodArray":
+        """From the YYYYKW encoding (year * 100 + week)"""
+        yyyykw = pd.Series(yyyykw, dtype="float64")
+        return cls.from_year_period(yyyykw // 100, yyyykw % 100, rd)
+
+    @classmethod
+    def _from_sequence(cls, scalars, dtype=None, copy=False):
+        if isinstance(dtype, str):
+            dtype = IsoPeriodDtype.construct_from_string(dtype)
+        if isinstance(scalars, IsoPeriodArray):
+            return scalars.round(dtype.rd) if dtype is not None else scalars.copy()
+        scalars = list(scalars)
+        if dtype is None:
+            rd = next((s.rd for s in scalars if isinstance(s, IsoPeriod)), 2)
+        else:
+            rd = dtype.rd
+        return cls([_scalar_ordinal(s, rd) for s in scalars], rd)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls(values, original.rd)
+
+    # Attributes ########################################################################
+    @property
+    def dtype(self) -> IsoPeriodDtype:
+        return self._dtype
+
+    @property
+    def rd(self) -> int:
+        return self._dtype.rd
+
+    @property
+    def nbytes(self) -> int:
+        return self._ordinals.nbytes
+
+    @property
+    def ordinals(self) -> np.ndarray:
+        """Ordinals as int64 array, -2**31 for missing values"""
+        return self._ordinals.astype("int64")
+
+    @property
+    def year(self) -> pd.arrays.IntegerArray:
+        return self._masked(_iso_from_ordinal(self._valid_ordinals(), self.rd)[0])
+
+    @property
+    def period(self) -> pd.arrays.IntegerArray:
+        """First ISO week of each period"""
+        return self._masked(_iso_from_ordinal(self._valid_ordinals(), self.rd)[1])
+
+    def _valid_ordinals(self) -> np.ndarray:
+        return np.where(self.isna(), 0, self._ordinals)
+
+    def _masked(self, values) -> pd.arrays.IntegerArray:
+        missing = self.isna()
+        return pd.arrays.IntegerArray(
+            np.where(missing, 0, values).astype("int32"), missing
+        )
+
+    def to_dates(self, day: int = 1) -> np.ndarray:
+        """datetime64 of weekday 'day' (1 = Monday) in the first week of each period"""
+        return _dates_from_ordinal(self._ordinals, self.rd, day)
+
+    def round(self, rd: int) -> "IsoPeriodArray":
+        """Same period starts, rounded to periods of rd weeks"""
+        if rd == self.rd:
+            return self.copy()
+        (year, week) = _iso_from_ordinal(self._valid_ordinals(), self.rd)
+        ordinal = _ordinal_from_iso(year, week, _check_rd(rd))
+        return IsoPeriodArray(np.where(self.isna(), _NA, ordinal), rd)
+
+    # ExtensionArray interface ##########################################################
+    def __len__(self) -> int:
+        return len(self._ordinals)
+
+    def __getitem__(self, item):
+        if is_integer(item):
+            ordinal = self._ordinals[item]
+            if ordinal == _NA:
+                return self.dtype.na_value
+            return IsoPeriod.from_ordinal(ordinal, self.rd)
+        item = pd.api.indexers.check_array_indexer(self, item)
+        return IsoPeriodArray(self._ordinals[item], self.rd)
+
+    def __setitem__(self, key, value):
+        if is_list_like(value) and not isinstance(value, IsoPeriod):
+            value = self._ordinals_of(value)
+        else:
+            value = _scalar_ordinal(value, self.rd)
+        self._ordinals[key] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype="object")
+
+    def isna(self) -> np.ndarray:
+        return self._ordinals == _NA
+
+    def copy(self) -> "IsoPeriodArray":
+        return IsoPeriodArray(self._ordinals, self.rd, copy=True)
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        fill = _NA if fill_value is None else _scalar_ordinal(fill_value, self.rd)
+        ordinals = take(
+            self._ordinals, indices, allow_fill=allow_fill, fill_value=fill
+        )
+        return IsoPeriodArray(ordinals, self.rd)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        rds = {array.rd for array in to_concat}
+        if len(rds) > 1:
+            raise TypeError(f"Cannot concatenate periods of different lengths {rds}")
+        return cls(np.concatenate([array._ordinals for array in to_concat]), rds.pop())
+
+    def _values_for_factorize(self):
+        return self._ordinals, _NA
+
+    def _values_for_argsort(self):
+        return self._ordinals
+
+    def _formatter(self, boxed=False):
+        return str
+
+    def _reduce(self, name, skipna=True, **kwargs):
+        if name not in ("min", "max"):
+            raise TypeError(f"Cannot perform reduction '{name}' with isoperiod dtype")
+        valid = self._ordinals[~self.isna()]
+        if len(valid) == 0 or (not skipna and self.isna().any()):
+            return self.dtype.na_value
+        return IsoPeriod.from_ordinal(getattr(valid, name)(), self.rd)
+
+    def astype(self, dtype, copy=True):
+        if isinstance(dtype, str) and dtype.startswith("isoperiod"):
+            dtype = IsoPeriodDtype.construct_from_string(dtype)
+        if isinstance(dtype, IsoPeriodDtype):
+            return self.round(dtype.rd)
+        return super().astype(dtype, copy=copy)
+
+    # Arithmetic and comparisons on ordinals ############################################
+    def _ordinals_of(self, other) -> np.ndarray:
+        """Ordinals of a scalar or sequence, checking the period length"""
+        if isinstance(other, IsoPeriodArray):
+            if other.rd != self.rd:
+                raise TypeError(f"Period lengths differ: {self.rd} vs. {other.rd}")
+            return other._ordinals
+        if is_list_like(other) and not isinstance(other, IsoPeriod):
+            return IsoPeriodArray._from_sequence(other, IsoPeriodDtype(self.rd))._ordinals
+        if isinstance(other, IsoPeriod) and other.rd != self.rd:
+            raise TypeError(f"Period lengths differ: {self.rd} vs. {other.rd}")
+        return np.int32(_scalar_ordinal(other, self.rd))
+
+    def __add__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        steps = np.asarray(other)
+        if steps.dtype.kind not in "iu":
+            return NotImplemented
+        moved = self._ordinals.astype("int64") + steps
+        return IsoPeriodArray(np.where(self.isna(), _NA, moved), self.rd)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if isinstance(other, (IsoPeriod, IsoPeriodArray)):
+            other_ordinals = self._ordinals_of(other)
+            missing = self.isna() | (other_ordinals == _NA)
+            diff = self._ordinals.astype("int64") - other_ordinals
+            return pd.arrays.IntegerArray(
+                np.where(missing, 0, diff).astype("int32"), missing
+            )
+        steps = np.asarray(other)
+        if steps.dtype.kind not in "iu":
+            return NotImplemented
+        return self + (-steps)
+
+    def _compare(self, other, op):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        other_ordinals = self._ordinals_of(other)
+        result = op(self._ordinals, other_ordinals)
+        missing = self.isna() | (other_ordinals == _NA)
+        result[missing] = op is operator.ne
+        return result
+
+    def __eq__(self, other):
+        return self._compare(other, operator.eq)
+
+    def __ne__(self, other):
+        return self._compare(other, operator.ne)
+
+    def __lt__(self, other):
+        return self._compare(other, operator.lt)
+
+    def __le__(self, other):
+        return self._compare(other, operator.le)
+
+    def __gt__(self, other):
+        return self._compare(other, operator.gt)
+
+    def __ge__(self, other):
+        return self._compare(other, operator.ge)
+
+
+def _scalar_ordinal(value, rd: int) -> int:
+    """Ordinal of an IsoPeriod (rounded to rd if needed), a date, or a missing value"""
+    if isinstance(value, IsoPeriod):
+        return value.ordinal if value.rd == rd else value.round(rd).ordinal
+    if value is None or value is pd.NaT or (np.ndim(value) == 0 and pd.isna(value)):
+        return _NA
+    if isinstance(value, (str, pd.Timestamp, np.datetime64)) or hasattr(value, "year"):
+        return int(_ordinal_from_dates([value], rd)[0])
+    raise TypeError(f"Cannot convert {value!r} to an IsoPeriod")
+
+
+########################################################################################
+def iso_period_range(start, end, rd: int = 2) -> IsoPeriodArray:
+    """
+    All periods from start to end (both included)
+
+    :param start: first period, as IsoPeriod or date
+    :param end: last period, as IsoPeriod or date
+    :param rd: period length in weeks
+    :return: consecutive periods
+    """
+    first = _scalar_ordinal(start, _check_rd(rd))
+    last = _scalar_ordinal(end, rd)
+    return IsoPeriodArray(np.arange(first, last + 1), rd)
+
+
+########################################################################################
+@pd.api.extensions.register_series_accessor("iso")
+class IsoPeriodAccessor:
+    """Series accessor for isoperiod columns: series.iso.year, series.iso.period, ..."""
+
+    def __init__(self, series: pd.Series):
+        if not isinstance(series.dtype, IsoPeriodDtype):
+            raise AttributeError("The .iso accessor needs an isoperiod series")
+        self._series = series
+        self._array = series.array
+
+    def _wrap(self, values) -> pd.Series:
+        return pd.Series(values, index=self._series.index, name=self._series.name)
+
+    @property
+    def year(self) -> pd.Series:
+        return self._wrap(self._array.year)
+
+    @property
+    def period(self) -> pd.Series:
+        return self._wrap(self._array.period)
+
+    @property
+    def ordinal(self) -> pd.Series:
+        return self._wrap(self._array.ordinals)
+
+    def to_dates(self, day: int = 1) -> pd.Series:
+        return self._wrap(self._array.to_dates(day))
+
+    def round(self, rd: int) -> pd.Series:
+        return self._wrap(self._array.round(rd))
+
+
+###############################################################################
+# TESTING CODE
+###############################################################################
+if __name__ == "__main__":
+    days = pd.Series(pd.date_range("2015-12-20", "2021-01-10"))
+    weeks = pd.Series(IsoPeriodArray.from_dates(days, rd=1))
+    periods = pd.Series(IsoPeriodArray.from_dates(days, rd=2))
+    iso = days.dt.isocalendar()
+    print("ISO weeks correct:", (weeks.iso.year.eq(iso.year) & weeks.iso.period.eq(iso.week)).all())
+    print("Weeks 53 in 2015, 2020:", periods[iso.week == 53].unique())
+    print(periods.iloc[::30].to_frame("period").assign(date=periods.iso.to_dates()).head())
+    print("Periods 2020-01 to 2016-51:", IsoPeriod(2020, 1) - IsoPeriod(2016, 51))
+    print(iso_period_range(IsoPeriod(2019, 47), IsoPeriod(2020, 5)))
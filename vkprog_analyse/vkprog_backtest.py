@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Backtest and hyperparameter sweep
+# Judges model settings (n_estimators, max_depth, k features, imbalance strategy) on
+# several historical reference weeks, instead of one random 75/25 split: per week,
+# a model trained on the training snapshot (year_train) is validated out of time, on
+# the customers and outcomes at the reference date itself (year_score).
+#
+# Every (setting, week) is one job in a process pool on this machine. The feature
+# matrices of each week are built once, written as .npy files (to /dev/shm where
+# available, i.e. shared memory) and memory-mapped by the jobs, so workers share
+# one copy instead of receiving their own.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import ParameterGrid
+
+from pa_lib.file import project_dir, store_csv
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_dataprep_booking import check_odd_kw
+from vkprog_analyse.vkprog_feature_builder import FeatureBuilder
+from vkprog_analyse.vkprog_feature_scaling import FeatureScaler
+from vkprog_analyse.vkprog_feature_selection import mutual_info_scores, top_k_mask
+from vkprog_analyse.vkprog_imbalance import balance
+from vkprog_analyse.vkprog_model_validation import ValidationPredictions
+
+################################################################################
+# # Shared feature matrices
+################################################################################
+
+
+def _store_arrays(path: Path, X, y) -> None:
+    """Write model matrix X (dense or CSR) and target y as .npy files in path"""
+    path.mkdir(parents=True)
+    if sparse.issparse(X):
+        X = X.tocsr()
+        for part in ("data", "indices", "indptr"):
+            np.save(path / f"X_{part}.npy", getattr(X, part))
+        np.save(path / "X_shape.npy", np.array(X.shape))
+    else:
+        np.save(path / "X.npy", X)
+    np.save(path / "y.npy", np.asarray(y))
+
+
+def _load_arrays(path: Path):
+    """Memory-mapped X and y of _store_arrays"""
+    y = np.load(path / "y.npy", mmap_mode="r")
+    if (path / "X.npy").exists():
+        return np.load(path / "X.npy", mmap_mode="r"), y
+    X = sparse.csr_matrix(
+        tuple(
+            np.load(path / f"X_{part}.npy", mmap_mode="r")
+            for part in ("data", "indices", "indptr")
+        ),
+        shape=tuple(np.load(path / "X_shape.npy")),
+        copy=False,
+    )
+    return X, y
+
+
+def week_name(day: int, month: int, year_score: int, year_train: int) -> str:
+    return f"{year_score}-{month:02}-{day:02}/{year_train}"
+
+
+def prepare_weeks(weeks, data_dir: Path, year_span: int = 4, sales_filter: bool = True):
+    """
+    Build, scale and store the training and validation matrices of each reference
+    week (day, month, year_score, year_train) below data_dir, in a layout of its own.
+    Raises ValueError for dates in even calendar weeks: their KW_2 target period
+    starts the week before, which the date features already see (target leakage)
+    """
+    for (day, month, year_score, _) in weeks:
+        check_odd_kw(dt.date(year_score, month, day), "prepare_weeks")
+    builder = FeatureBuilder(year_span, sales_filter).prepare()
+    for week in weeks:
+        with time_log(f"preparing week {week_name(*week)}"):
+            (training_matrix, training_target, _) = builder.train_scoring(*week)
+            (day, month, year_score, _) = week
+            (validation_matrix, validation_target) = builder.training_matrix(
+                day, month, year_score, year_score, training_matrix.layout
+            )
+            scaler = FeatureScaler().fit(training_matrix)
+            scaler.transform(training_matrix)
+            scaler.transform(validation_matrix)
+            week_dir = data_dir / week_name(*week).replace("/", "_")
+            _store_arrays(week_dir / "train", training_matrix.matrix(), training_target)
+            _store_arrays(
+                week_dir / "validation", validation_matrix.matrix(), validation_target
+            )
+
+
+################################################################################
+# # Jobs
+################################################################################
+
+
+def _run_job(week_dir: Path, setting: dict, mi_subsample, random_state: int) -> dict:
+    """Train and validate one setting on one week (in a worker process)"""
+    (X_train, y_train) = _load_arrays(week_dir / "train")
+    (X_valid, y_valid) = _load_arrays(week_dir / "validation")
+    timings = {}
+
+    start = perf_counter()
+    (X_balanced, y_balanced, imbalance_params) = balance(
+        setting["imbalance_strategy"], X_train, y_train, random_state=random_state
+    )
+    timings["balance_time"] = perf_counter() - start
+
+    ## MI scores are cached by data: jobs of the same (week, imbalance strategy) reuse
+    ## them, unless running at the same time
+    start = perf_counter()
+    scores = mutual_info_scores(
+        X_balanced, y_balanced, n_jobs=1, subsample=mi_subsample
+    )
+    mask = top_k_mask(scores, min(setting["k"], len(scores)))
+    timings["selection_time"] = perf_counter() - start
+
+    start = perf_counter()
+    forest = RandomForestClassifier(
+        n_estimators=setting["n_estimators"],
+        max_depth=setting["max_depth"],
+        random_state=random_state,
+        n_jobs=1,
+        **imbalance_params,
+    ).fit(X_balanced[:, mask], y_balanced)
+    timings["fit_time"] = perf_counter() - start
+
+    start = perf_counter()
+    validation = ValidationPredictions(forest, X_valid[:, mask], y_valid)
+    result = {
+        "avg_precision": validation.average_precision(),
+        "auc": validation.auc(),
+        "accuracy": validation.accuracy(),
+    }
+    timings["validation_time"] = perf_counter() - start
+    return {
+        **setting,
+        "n_training": X_balanced.shape[0],
+        "n_validation": X_valid.shape[0],
+        **result,
+        **timings,
+    }
+
+
+def backtest(
+    weeks,
+    grid: dict,
+    year_span: int = 4,
+    sales_filter: bool = True,
+    mi_subsample=None,
+    max_workers: int = None,
+    random_state: int = 42,
+) -> pd.DataFrame:
+    """
+    Validate all settings of grid (dict of lists: n_estimators, max_depth, k,
+    imbalance_strategy) on all reference weeks (day, month, year_score, year_train).
+    Returns one row per (setting, week): validation scores and timings (seconds)
+    """
+    settings = list(ParameterGrid(grid))
+    shm = Path("/dev/shm")  # shared memory, if available
+    with TemporaryDirectory(
+        prefix="vkprog_backtest_", dir=shm if shm.is_dir() else None
+    ) as tmp:
+        data_dir = Path(tmp)
+        prepare_weeks(weeks, data_dir, year_span, sales_filter)
+        info(f"Backtest: {len(settings)} settings x {len(weeks)} weeks")
+        results = []
+        with time_log("running backtest jobs"):
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                jobs = {
+                    pool.submit(
+                        _run_job,
+                        data_dir / week_name(*week).replace("/", "_"),
+                        setting,
+                        mi_subsample,
+                        random_state,
+                    ): week_name(*week)
+                    for week in weeks
+                    for setting in settings
+                }
+                for job in as_completed(jobs):
+                    results.append({"week": jobs[job], **job.result()})
+                    info(f"Finished job {len(results)} of {len(jobs)}")
+    return pd.DataFrame.from_records(results).sort_values(
+        ["week", *sorted(grid)], ignore_index=True
+    )
+
+
+def summary(results: pd.DataFrame) -> pd.DataFrame:
+    """Scores and fit time per setting, averaged over weeks, best first"""
+    settings = [
+        col
+        for col in ("imbalance_strategy", "k", "max_depth", "n_estimators")
+        if col in results.columns
+    ]
+    return (
+        results.groupby(settings)[["avg_precision", "auc", "fit_time"]]
+        .agg(["mean", "std"])
+        .sort_values(("avg_precision", "mean"), ascending=False)
+    )
+
+
+################################################################################
+if __name__ == "__main__":
+    info("vkprog_backtest.py: START")
+
+    # Reference weeks (day, month, year_score, year_train), with known outcomes:
+    # Mondays of odd calendar weeks only
+    weeks = [
+        (3, 6, 2019, 2018),
+        (26, 8, 2019, 2018),
+        (2, 12, 2019, 2018),
+        (24, 2, 2020, 2019),
+    ]
+    grid = {
+        "n_estimators": [500, 2000],
+        "max_depth": [7, 10],
+        "k": [100, 150],
+        "imbalance_strategy": ["smote", "class_weight", "undersample"],
+    }
+
+    results = backtest(weeks, grid, year_span=4, sales_filter=True)
+    with project_dir("vkprog/backtest"):
+        store_csv(results, "vkprog_backtest.csv")
+    info(f"Backtest summary:\n{summary(results)}")
+
+    info("vkprog_backtest.py: END")
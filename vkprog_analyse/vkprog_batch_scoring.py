@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Chunked batch scoring
+# Scores customers in blocks of rows: each block's model input is built, scored and
+# written on its own, into a preallocated probability array and (optionally) appended
+# to an output file. Memory used on top of the feature matrix and the result depends
+# on the block size, not on the number of customers. Blocks can be scored in
+# parallel worker processes.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+
+from pa_lib.file import get_project_dir
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_feature_matrix import FeatureMatrix
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
+
+################################################################################
+# # Row blocks
+################################################################################
+
+
+def matrix_rows(X, rows: slice):
+    """Rows of a model matrix (array or CSR)"""
+    return X[rows]
+
+
+def feature_rows(features: FeatureMatrix, feature_mask, rows):
+    """Selected model input of rows (slice or index array) of a scaled FeatureMatrix"""
+    return features.matrix(rows=rows)[:, feature_mask]
+
+
+# worker process state (n_jobs > 1), see _init_worker
+_worker = {}
+
+
+def _init_worker(model) -> None:
+    _worker.update(model=model)
+
+
+def _score_block(X_block) -> np.ndarray:
+    return _worker["model"].predict_proba(X_block)
+
+
+def score_chunks(model, rows_input, n_rows: int, chunk_rows=50_000, n_jobs=1):
+    """
+    Class probabilities of model, block by block: yields (rows, probabilities of
+    rows) in row order. rows_input(rows) is the model input of a row slice (e.g.
+    functools.partial of matrix_rows or feature_rows).
+    n_jobs > 1: blocks are scored in n_jobs worker processes. Workers receive the
+    model once and each block's input, built here with at most 2 * n_jobs blocks
+    in flight, so memory depends on the block size, not on the number of customers
+    """
+    chunks = [
+        slice(start, min(start + chunk_rows, n_rows))
+        for start in range(0, n_rows, chunk_rows)
+    ]
+    if n_jobs == 1:
+        for rows in chunks:
+            yield rows, model.predict_proba(rows_input(rows))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(model,)
+        ) as pool:
+            pending = deque()
+            for rows in chunks:
+                pending.append((rows, pool.submit(_score_block, rows_input(rows))))
+                if len(pending) >= 2 * n_jobs:
+                    (done, job) = pending.popleft()
+                    yield done, job.result()
+            while pending:
+                (done, job) = pending.popleft()
+                yield done, job.result()
+
+
+################################################################################
+# # Scoring
+################################################################################
+
+
+def append_proba(out, customers, proba: np.ndarray, header: bool) -> None:
+    """Append Endkunde_NR, Prob_0, Prob_1 of a block of customers to CSV file out"""
+    pd.DataFrame(
+        {"Endkunde_NR": customers, "Prob_0": proba[:, 0], "Prob_1": proba[:, 1]}
+    ).to_csv(out, header=header, index=False)
+
+
+def write_proba(prob_file: str, customers, proba: np.ndarray, chunk_rows=50_000):
+    """
+    Write probabilities of all customers to CSV file prob_file (in the current
+    project directory), in blocks of chunk_rows
+    """
+    file_path = (Path(get_project_dir()) / prob_file).resolve()
+    info(f"Writing to file {file_path}")
+    with open(file_path, "w", newline="") as out:
+        for start in range(0, len(customers), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            append_proba(out, customers[rows], proba[rows], header=(start == 0))
+
+
+def predict_proba_chunked(model, X, chunk_rows=50_000, n_jobs=1) -> np.ndarray:
+    """model.predict_proba(X) for a model matrix X, scored in blocks of chunk_rows"""
+    proba = None
+    for (rows, chunk_proba) in score_chunks(
+        model, partial(matrix_rows, X), X.shape[0], chunk_rows, n_jobs
+    ):
+        if proba is None:
+            proba = np.empty((X.shape[0], chunk_proba.shape[1]))
+        proba[rows] = chunk_proba
+    return proba
+
+
+def score_features(
+    artifact: ModelArtifact,
+    features: FeatureMatrix,
+    prob_file: str = None,
+    chunk_rows=50_000,
+    n_jobs=1,
+) -> np.ndarray:
+    """
+    Class probabilities of the customers of an unscaled FeatureMatrix (scaled in
+    place) with a model artifact, scored in blocks of chunk_rows without building
+    the whole model matrix. prob_file: CSV file (in the current project directory)
+    to append each block's Endkunde_NR, Prob_0, Prob_1 to, as soon as it is scored
+    """
+    artifact.check_layout(features)
+    artifact.scaler.transform(features, chunk_rows=chunk_rows)
+    n_rows = len(features.customers)
+    proba = np.empty((n_rows, len(artifact.model.classes_)))
+    rows_input = partial(feature_rows, features, artifact.feature_mask)
+
+    out = None
+    if prob_file is not None:
+        file_path = (Path(get_project_dir()) / prob_file).resolve()
+        info(f"Writing to file {file_path}")
+        out = open(file_path, "w", newline="")
+    try:
+        with time_log(f"scoring {n_rows} customers in blocks of {chunk_rows}"):
+            for (rows, chunk_proba) in score_chunks(
+                artifact.model, rows_input, n_rows, chunk_rows, n_jobs
+            ):
+                proba[rows] = chunk_proba
+                if out is not None:
+                    append_proba(
+                        out, features.customers[rows], chunk_proba, rows.start == 0
+                    )
+    finally:
+        if out is not None:
+            out.close()
+    return proba
+
+
+################################################################################
+# TESTING CODE
+################################################################################
+if __name__ == "__main__":
+    import tracemalloc
+    from tempfile import TemporaryDirectory
+
+    from scipy import sparse
+    from sklearn.datasets import make_classification
+    from sklearn.ensemble import RandomForestClassifier
+
+    from pa_lib.file import project_dir
+    from pa_lib.util import format_size
+
+    (X, y) = make_classification(n_samples=60_000, n_features=40, random_state=42)
+    X_sparse = sparse.csr_matrix(np.where(np.abs(X) < 0.5, 0, X))
+    forest = RandomForestClassifier(n_estimators=50, max_depth=8, random_state=42)
+    forest.fit(X_sparse[:5_000], y[:5_000])
+
+    for chunk_rows in (60_000, 5_000):
+        tracemalloc.start()
+        proba = predict_proba_chunked(forest, X_sparse, chunk_rows=chunk_rows)
+        (_, peak_memory) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        info(f"Blocks of {chunk_rows} rows: peak memory {format_size(peak_memory)}")
+        assert np.allclose(proba, forest.predict_proba(X_sparse))
+    assert np.allclose(
+        predict_proba_chunked(forest, X_sparse, chunk_rows=7_000, n_jobs=2), proba
+    )
+
+    ## bookings (non-negative, log scaled) and dates blocks, scaled as in production
+    X[:, :20] = np.abs(X[:, :20])
+    layout = {
+        "bookings": [f"x{i}" for i in range(20)],
+        "dates": [f"x{i}" for i in range(20, 40)],
+    }
+    training = FeatureMatrix(np.arange(5_000), layout)
+    training.values[:] = X[:5_000]
+    artifact = ModelArtifact.fit(
+        RandomForestClassifier(n_estimators=50, max_depth=8, random_state=42),
+        training,
+        y[:5_000],
+    )
+    features = FeatureMatrix(np.arange(60_000), layout)
+    features.values[:] = X
+    with TemporaryDirectory() as tmp_dir:
+        with project_dir(tmp_dir):
+            proba = score_features(artifact, features, "proba.csv", chunk_rows=7_000)
+            written = pd.read_csv(Path(tmp_dir) / "proba.csv")
+    assert np.allclose(proba, artifact.model.predict_proba(features.matrix()))
+    assert (written["Endkunde_NR"] == np.arange(60_000)).all()
+    assert np.allclose(written[["Prob_0", "Prob_1"]], proba)
@@ -10,7 +10,9 @@ import datetime as dt
 
 # make imports from pa_lib possible (parent directory of file's directory)
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+from itertools import repeat
 from pathlib import Path
 from typing import Any
 
@@ -26,27 +28,47 @@ parent_dir = file_dir.parent
 sys.path.append(str(parent_dir))
 
 ## Libraries & Settings ##
-from pa_lib.file import load_bin
+from pa_lib.cache import cached
+from pa_lib.file import load_bin, get_project_dir
 from pa_lib.util import cap_words, iso_to_datetime, flat_list
 from pa_lib.log import info, warn
 
 from pa_lib.data import unfactorize, clean_up_categoricals
+import pa_lib.events
+import pa_lib.period
+from pa_lib.events import EventIndex
+from pa_lib.period import IsoPeriod, IsoPeriodArray
+import vkprog_analyse.vkprog_feature_scaling
+from vkprog_analyse.vkprog_feature_matrix import (
+    FeatureMatrix,
+    feature_cache,
+    feature_code_sources,
+)
+from vkprog_analyse.vkprog_feature_scaling import ColumnScaling
 
 ## Lazy Recursive Job Dependency Request:
 from pa_lib.job import request_job
 
 
-bd = pd.DataFrame()
-bd_aggr_2w = pd.DataFrame()
-
-################################################################################
-## Recursive Dependency Check:
-request_job(job_name="bd_prepare.py", current="Today")  # output: bd_data.feather
-################################################################################
-
 ###################
 ## Load raw data ##
 ###################
+def booking_sources():
+    """
+    Files the booking features depend on (for the feature cache): booking data,
+    requested first to make it current, and the feature code
+    """
+    request_job(job_name="bd_prepare.py", current="Today")  # output: bd_data.feather
+    return [
+        Path(get_project_dir()) / "vkprog/bd_data.feather",
+        __file__,
+        pa_lib.events.__file__,
+        pa_lib.period.__file__,
+        vkprog_analyse.vkprog_feature_scaling.__file__,
+        *feature_code_sources(),
+    ]
+
+
 def load_booking_data():
     bd_raw = load_bin("vkprog/bd_data.feather").rename(
         mapper=lambda name: cap_words(name, sep="_"), axis="columns"
@@ -128,16 +150,13 @@ def aggregate_bookings(df, period):
         .reset_index(drop=True)
     )
 
-    # Needed for data preparation
-    df_aggr.eval("YYYYKW_2 = Jahr * 100 + KW_2", inplace=True)
+    # Needed for data preparation: 2-week periods as ordinals, for year arithmetic
+    df_aggr = df_aggr.assign(
+        Period_2=IsoPeriodArray.from_year_period(df_aggr.Jahr, df_aggr.KW_2, rd=2)
+    )
     return df_aggr
 
 
-######################
-## Global Variables ##
-######################
-
-
 #############################
 ## Data Prep: Booking Data ##
 #############################
@@ -145,155 +164,109 @@ def aggregate_bookings(df, period):
 ## Functions ##
 
 
-def booking_yearly_totals(yyyykw, year_span):
+class BookingTensor:
     """
-    Computing yearly totals for Aushang and Reservation.
-    Warning: Yearly totals do not necessarily align with calendar years!
+    Aggregated bookings as dense array: customer × year × KW_2 period × {Res, Aus}.
+
+    Customers are indexed by their (sorted) categorical codes, years and periods by
+    the Period_2 ordinals of aggregate_bookings(). Built once, any reference week's
+    per-KW features, yearly totals and targets are slices and sums of this array.
     """
-    # info("Starting: booking_yearly_totals")
-    container_df = pd.DataFrame()
-    container_df.loc[:, "Endkunde_NR"] = pd.Series(
-        list(set(bd_aggr_2w.loc[:, "Endkunde_NR"]))
-    )
-    # bd_aggr_2w.eval("YYYYKW_2 = Jahr * 100 + KW_2", inplace=True)
-
-    # info("Computing: Yearly total sums")
-    for ry in list(range(year_span)):
-        # bd_aggr_2w.loc[:,"YYYYKW_2"] = bd_aggr_2w.Jahr.map(lambda x: x*100) + bd_aggr_2w.KW_2
-
-        bd_filtered = bd_aggr_2w.loc[
-            (
-                (bd_aggr_2w.loc[:, "YYYYKW_2"] < yyyykw - 100 * ry)
-                & (bd_aggr_2w.loc[:, "YYYYKW_2"] >= yyyykw - 100 * (1 + ry))
-            ),
-            :,
-        ].copy()
-
-        bd_filtered.loc[:, "Year_Total"] = "_RY_" + str(ry)
-
-        bd_pivot = bd_filtered.pivot_table(
-            # index=["Endkunde_NR", "Jahr"],
-            index=["Endkunde_NR"],
-            # columns="KW_2",
-            columns=["Year_Total"],
-            values=[
-                "Netto_Sum_Res",
-                "Netto_Sum_Aus",
-            ],  # Cash amount of Resevation placed per in weeks of YYYYKW and YYYY(KW+1)
-            aggfunc="sum",
-            fill_value=0,
-            # There's a difference between 0 and NaN. Consider 0 only when the customer has had a real booking or reservation prior.
-        )
 
-        # Flatten down dataframe:
-        bd_flattened = pd.DataFrame(bd_pivot.to_records(index=False))
+    measures = ("Res", "Aus")
+
+    def __init__(self, df_aggr):
+        (codes, self.customers) = pd.factorize(df_aggr["Endkunde_NR"], sort=True)
+        ordinals = df_aggr["Period_2"].array.ordinals.astype("int64")
+        self.per_year = df_aggr["Period_2"].dtype.periods_per_year
+        self.first_year = ordinals.min() // self.per_year
+        n_years = ordinals.max() // self.per_year - self.first_year + 1
+        self.n_periods = n_years * self.per_year
+
+        # sum up per (customer, period) cell, one measure at a time
+        cell = codes * self.n_periods + (ordinals - self.first_year * self.per_year)
+        self.values = np.stack(
+            [
+                np.bincount(
+                    cell,
+                    weights=df_aggr[f"Netto_Sum_{measure}"].to_numpy(dtype="float64"),
+                    minlength=len(self.customers) * self.n_periods,
+                ).reshape(len(self.customers), n_years, self.per_year)
+                for measure in self.measures
+            ],
+            axis=-1,
+        )
 
-        # Re-add column with Endkunde_NR
-        bd_flattened.loc[:, "Endkunde_NR"] = pd.Series(bd_pivot.index)
+    def _window(self, start, stop):
+        """Slice of periods [start, stop) by ordinal: customer × period × measure.
+        Periods outside the tensor are zero."""
+        flat = self.values.reshape(len(self.customers), self.n_periods, -1)
+        (start, stop) = (o - self.first_year * self.per_year for o in (start, stop))
+        (lo, hi) = (min(max(start, 0), self.n_periods), min(max(stop, 0), self.n_periods))
+        if (lo, hi) == (start, stop):
+            return flat[:, lo:hi]
+        window = np.zeros((len(self.customers), stop - start, flat.shape[-1]))
+        window[:, lo - start : hi - start] = flat[:, lo:hi]
+        return window
+
+    def _yearly_totals(self, ref, year_span, rows=slice(None)):
+        totals = {}
+        for ry in range(year_span):
+            sums = self._window(ref - self.per_year * (ry + 1), ref - self.per_year * ry)
+            sums = sums[rows].sum(axis=1)
+            for (nr, measure) in sorted(enumerate(self.measures), key=lambda m: m[1]):
+                totals[f"Netto_Sum_{measure}_RY_{ry}"] = sums[:, nr]
+        return totals
+
+    def yearly_totals(self, yyyykw, year_span):
+        """
+        Yearly totals for Aushang and Reservation, per customer.
+        Relative year ry covers the per_year periods before the reference period,
+        shifted back by ry years (not necessarily aligned with calendar years!)
+        """
+        ref = IsoPeriod.from_yyyykw(yyyykw, rd=2).ordinal
+        return pd.DataFrame(
+            {"Endkunde_NR": self.customers, **self._yearly_totals(ref, year_span)}
+        )
 
-        # Renaming column names:
-        bd_flattened.columns = [
-            x.replace("', '", "")
-            .replace("', ", "")
-            .replace("('", "")
-            .replace(")", "")
-            .replace("'", "")
-            for x in bd_flattened.columns
+    def snapshot(self, yyyykw, year_span):
+        """
+        Features per KW_2 period for year_span years back from yyyykw (included),
+        targets of period yyyykw, and yearly totals. KW_2 columns are named by their
+        lag in periods before yyyykw (LAG_001: the period just before), so snapshots
+        of any week share the same columns. Contains customers with any booking in
+        that time span.
+        """
+        ref = IsoPeriod.from_yyyykw(yyyykw, rd=2).ordinal
+        start = ref - year_span * self.per_year
+        window = self._window(start, ref + 1)
+        active = window.any(axis=(1, 2)).nonzero()[0]
+        window = window[active]
+
+        labels = [f"LAG_{lag:03}" for lag in range(ref - start, 0, -1)]
+        # the last period (lag 0) holds the targets
+        names = [
+            name
+            for measure in self.measures
+            for name in [f"Netto_Sum_{measure}_{label}" for label in labels]
+            + [f"Target_Sum_{measure}"]
         ]
-
-        # Left-Join to the container
-        # info("Merging: Left-Join to Container dataframe")
-        container_df = pd.merge(
-            container_df, bd_flattened, on="Endkunde_NR", how="left"
+        features = pd.DataFrame(
+            window.transpose(0, 2, 1).reshape(len(active), -1), columns=names
         )
+        flags = pd.DataFrame(
+            {
+                "Endkunde_NR": self.customers[active],
+                **{
+                    f"Target_{measure}_flg": window[:, -1, nr].astype("bool")
+                    for (nr, measure) in enumerate(self.measures)
+                },
+            }
+        )
+        features = pd.concat([features, flags], axis="columns").sort_index(axis="columns")
 
-    # Replace all NaN with Zero
-    container_df.fillna(0, inplace=True)
-
-    return container_df
-
-
-##
-
-
-def booking_data(yyyykw, year_span):
-    """
-    Creates pivot table for time span between YYYYKW and back the selected amount of years year_span
-    """
-    # Select the last four years based on new reference-column
-    row_select = (bd_aggr_2w.loc[:, "YYYYKW_2"] <= yyyykw) & (
-        bd_aggr_2w.loc[:, "YYYYKW_2"] >= yyyykw - year_span * 100
-    )
-    bd_filtered = bd_aggr_2w.loc[row_select, :].copy()
-
-    # Create new column containing names of the relative years:
-    # pd.options.mode.chained_assignment = None  # default='warn'
-    max_jahr = yyyykw // 100
-    bd_filtered.loc[:, "Jahr_relative"] = (
-        "_RY_"
-        + (max_jahr - bd_filtered.loc[:, "Jahr"]).astype("int8").astype("str")
-        + "_KW_"
-    )
-    # pd.options.mode.chained_assignment = 'warn'  # default='warn'
-
-    # Computing Sums for each kw and customer
-    # info("Computing: Pivot Table")
-    bd_pivot = bd_filtered.pivot_table(
-        index=["Endkunde_NR"],
-        columns=["Jahr_relative", "KW_2"],
-        values=[
-            "Netto_Sum_Res",
-            "Netto_Sum_Aus",
-        ],  # Cash amount of Resevation placed per in weeks of YYYYKW and YYYY(kw+1)
-        aggfunc="sum",
-        fill_value=0,
-        # There's a difference between 0 and NaN. Consider 0 only when the customer has had a real booking or reservation prior.
-    )
-
-    # Flatten down dataframe
-    bd_flattened = pd.DataFrame(bd_pivot.to_records(index=False))
-
-    # Read column with Endkunde
-    bd_flattened.loc[:, "Endkunde_NR"] = pd.Series(bd_pivot.index)
-
-    # Renaming column names:
-    bd_flattened.columns = [
-        x.replace("', '", "").replace("', ", "").replace("('", "").replace(")", "")
-        for x in bd_flattened.columns
-    ]
-
-    # Label target variables:
-    kw = "KW_" + str(int(yyyykw - (yyyykw // 100) * 100))
-    bd_flattened.rename(
-        columns={
-            "Netto_Sum_Res_RY_0_" + kw: "Target_Sum_Res_RY_0_" + kw,
-            "Netto_Sum_Aus_RY_0_" + kw: "Target_Sum_Aus_RY_0_" + kw,
-        },
-        inplace=True,
-    )
-
-    bd_flattened.loc[:, "Target_Res_flg"] = bd_flattened.loc[
-        :, "Target_Sum_Res_RY_0_" + kw
-    ].astype(
-        "bool"
-    )  # Reservation?: Yes/No - True/False
-
-    bd_flattened.loc[:, "Target_Aus_flg"] = bd_flattened.loc[
-        :, "Target_Sum_Aus_RY_0_" + kw
-    ].astype(
-        "bool"
-    )  # Aushang?: Yes/No - True/False
-
-    # Sort index
-    bd_flattened.sort_index(axis=1, inplace=True)
-
-    # Compute yearly totals
-    # info("Running: booking_yearly_totals(YYYYKW, year_span) ")
-    yearly_totals = booking_yearly_totals(yyyykw, year_span)
-
-    # Left join yearly totals, and return it
-    # info("Final merge")
-    return pd.merge(bd_flattened, yearly_totals, on="Endkunde_NR", how="left")
+        totals = pd.DataFrame(self._yearly_totals(ref, year_span, rows=active))
+        return pd.concat([features, totals], axis="columns")
 
 
 #######################
@@ -305,31 +278,27 @@ def booking_data(yyyykw, year_span):
 # 3. Muss Target Aussage haben. (Zur zeit Reservationen)
 
 
-def dates_bd(view_date):
+def dates_bd(view_date, campaigns: EventIndex):
     """
-    filter bd to campaigns before view_date, calculate deltas
+    first and last campaign before view_date per customer (from index campaigns, see
+    BookingFeatures), calculate deltas
     """
     sec_per_year = 60 * 60 * 24 * 365.25
-    min_max_erfass_dt = (
-        bd.loc[
-            bd["Kampagne_Erfassungsdatum"] < view_date,
-            ["Endkunde_NR", "Kampagne_Erfassungsdatum"],
-        ]
-        .groupby("Endkunde_NR", as_index=False)
-        .agg(["min", "max"])
-    ).reset_index()
-    min_max_erfass_dt = pd.DataFrame(min_max_erfass_dt.to_records(index=False))
-    min_max_erfass_dt.columns = [
-        "Endkunde_NR",
-        "Kampagne_Erfass_Datum_min",
-        "Kampagne_Erfass_Datum_max",
-    ]
-    min_max_erfass_dt.loc[:, "Erste_Buchung_Delta"] = min_max_erfass_dt.loc[
-        :, "Kampagne_Erfass_Datum_min"
-    ].apply(lambda x: ((view_date - x).total_seconds()) // sec_per_year)
-    min_max_erfass_dt.loc[:, "Letzte_Buchung_Delta"] = min_max_erfass_dt[
-        "Kampagne_Erfass_Datum_max"
-    ].apply(lambda x: (view_date - x).total_seconds() // sec_per_year)
+    view_date = pd.Timestamp(view_date)
+    erfass_dt = campaigns.as_of(view_date)
+    min_max_erfass_dt = pd.DataFrame(
+        {
+            "Endkunde_NR": erfass_dt.index,
+            "Kampagne_Erfass_Datum_min": erfass_dt["FIRST"].to_numpy(),
+            "Kampagne_Erfass_Datum_max": erfass_dt["LAST"].to_numpy(),
+        }
+    )
+    min_max_erfass_dt.loc[:, "Erste_Buchung_Delta"] = (
+        view_date - min_max_erfass_dt.loc[:, "Kampagne_Erfass_Datum_min"]
+    ).dt.total_seconds() // sec_per_year
+    min_max_erfass_dt.loc[:, "Letzte_Buchung_Delta"] = (
+        view_date - min_max_erfass_dt.loc[:, "Kampagne_Erfass_Datum_max"]
+    ).dt.total_seconds() // sec_per_year
 
     min_max_erfass_dt.loc[:, "Erste_Letzte_Buchung_Delta"] = (
         min_max_erfass_dt.loc[:, "Erste_Buchung_Delta"]
@@ -341,53 +310,42 @@ def dates_bd(view_date):
 ##############
 ## Branchen ##
 ##############
-def branchen_data(view_date: date):
-    # Prepare data
-    kunden_branchen_df = bd.loc[
-        :, ["Endkunde_NR", "Kampagne_Erfassungsdatum", "Endkunde_Branchengruppe_ID"]
-    ]
-    auftrag_branchen_df = bd.loc[
-        :, ["Endkunde_NR", "Kampagne_Erfassungsdatum", "Auftrag_Branchengruppe_ID"]
-    ]
-    kunden_branchen_df.columns = [
-        "Endkunde_NR",
-        "Kampagne_Erfassungsdatum",
-        "Branchen_ID",
-    ]
-    auftrag_branchen_df.columns = kunden_branchen_df.columns
-    branchen_df = (
-        kunden_branchen_df.append(auftrag_branchen_df).dropna().drop_duplicates()
+def branchen_events(bookings):
+    """Index of campaign dates per customer and Branchen_ID (of customer or order)"""
+    branchen_df = pd.concat(
+        [
+            bookings.loc[:, ["Endkunde_NR", "Kampagne_Erfassungsdatum", col]]
+            .astype({col: "object"})
+            .rename(columns={col: "Branchen_ID"})
+            for col in ["Endkunde_Branchengruppe_ID", "Auftrag_Branchengruppe_ID"]
+        ]
     )
-
-    # TODO: (pd.crosstab(index=df.nr, columns=df.br) > 0).astype("int")
-
-    # Keep past campaigns only, count Branchen_ID occurrences per customer:
-    branchen_df = branchen_df.loc[
-        bd["Kampagne_Erfassungsdatum"] < view_date
-    ].pivot_table(
-        index=["Endkunde_NR"],
-        columns=["Branchen_ID"],
-        values=["Branchen_ID"],
-        aggfunc="count",
-        fill_value=0,
+    return EventIndex(
+        branchen_df, by=["Endkunde_NR", "Branchen_ID"], date_col="Kampagne_Erfassungsdatum"
     )
 
-    # Flatten and rename:
-    branchen_df = pd.DataFrame(branchen_df.to_records(index=True))
-    new_col_names = [
-        x.replace("('Kampagne_Erfassungsdatum',", "B")
-        .replace(" '", "")
-        .replace("')", "")
-        for x in branchen_df.columns
-    ]
-    branchen_df.columns = new_col_names
 
-    # Decode into 0/1:
-    for branche in branchen_df.columns[1:]:
-        branchen_df.loc[:, branche] = branchen_df.loc[:, branche].apply(
-            lambda x: min(x, 1)
-        )
+def branchen_matrix(view_date: date, branchen: EventIndex):
+    """
+    0/1 indicators per customer and Branchen_ID, as sparse CSR matrix (int8):
+    did the customer have a campaign in this Branche before view_date?
+    Only customers and Branchen with campaigns before view_date are included.
+
+    Returns matrix, customers (row order), column names B<ID>
+    """
+    (counts, customers, branchen_ids) = branchen.count_matrix(view_date)
+    indicators = (counts > 0).astype("int8")
+    return indicators, np.asarray(customers), [f"B{branche}" for branche in branchen_ids]
+
 
+def branchen_data(view_date: date, branchen: EventIndex):
+    """
+    0/1 indicators per Branchen_ID (columns B<ID>, sparse): did the customer have
+    a campaign in this Branche before view_date? (branchen: see branchen_events)
+    """
+    (indicators, customers, colnames) = branchen_matrix(view_date, branchen)
+    branchen_df = pd.DataFrame.sparse.from_spmatrix(indicators, columns=colnames)
+    branchen_df.insert(0, "Endkunde_NR", customers)
     return branchen_df
 
 
@@ -401,32 +359,14 @@ def scaling_bd(dataset, col_bookings, col_dates):
     Booking columns are heavily right-skewed:
      1. log-transform all columns => achieving approx. gaussian distribution
      2. Standardise log-transformed values into interval [0,1]
+    Date columns are standardised into [0,1]. Fitted on dataset itself, for a
+    scaling fitted once on training data see vkprog_feature_scaling.FeatureScaler
 
     Return transformed dataframe
     """
-    # Scaling: booking
-    for x in col_bookings:
-        logtransformed = np.log(
-            dataset.loc[:, x] + 1
-        )  # bookings are heavily right-skewed. log-transform to get approx. gaussian distribution
-        min_ = np.min(logtransformed)
-        max_ = np.max(logtransformed)
-        if min_ != max_:
-            dataset[x] = (logtransformed - min_) / (
-                max_ - min_
-            )  # standardise into floats in [0,1]
-        else:
-            dataset[x] = 0
-
-    for x in col_dates:
-        transformed = dataset.loc[:, x]
-        min_ = np.min(transformed)
-        max_ = np.max(transformed)
-        if min_ != max_:
-            dataset[x] = (transformed - min_) / (max_ - min_)
-        else:
-            dataset[x] = 0
-
+    for (columns, log) in ((col_bookings, True), (col_dates, False)):
+        values = dataset.loc[:, columns].to_numpy(dtype="float64")
+        dataset[columns] = ColumnScaling.fit(values, log=log).apply(values)
     return dataset
 
 
@@ -448,21 +388,11 @@ def remove_list(input_list: list, to_remove: Any) -> list:
 ##
 
 
-def bd_train_scoring(
-    day: int,
-    month: int,
-    year_score: int,
-    year_train: int,
-    year_span: int,
-    sales_filter: bool,
-    scale_features: bool,
-):
+def train_scoring_dates(day: int, month: int, year_score: int, year_train: int):
     """
-    Creates scoring-dataset, training-dataset, feature columns name lists for bookings and booking-dates
+    View dates and reference weeks (yyyykw) of training and scoring:
+    ((date_training, training_yyyykw), (date_now, current_yyyykw))
     """
-    global bd, bd_aggr_2w
-
-    ## Load data, aggregate and filter according to parameters
     date_now = dt.datetime(
         year_score, month, day
     )  # only works for odd calendar weeks!!!
@@ -470,49 +400,195 @@ def bd_train_scoring(
     date_training = iso_to_datetime(year=year_train, kw=kw_now, day=1)
     current_yyyykw = year_score * 100 + kw_now
     training_yyyykw = year_train * 100 + kw_now
-    bd = load_booking_data()
-    if sales_filter:
-        bd = filter_dataset(bd)
-        info("True: Filters applied, defined by Sales")
-    else:
-        info("False: Filters applied, defined by Sales")
-    bd_aggr_2w = aggregate_bookings(bd, "KW_2")
-    info(f"(current_yyyykw / training_yyyykw): ({current_yyyykw} / {training_yyyykw})")
-    info(f"(date_now / date_training): ({date_now} / {date_training})")
-    scoring_bd = booking_data(current_yyyykw, year_span)
-    training_bd = booking_data(training_yyyykw, year_span)
-    feature_colnames_bd = remove_list(
-        input_list=list(training_bd.columns),
-        to_remove=["Endkunde_NR", "Target_Aus_flg", "Target_Res_flg"],
+    return (date_training, training_yyyykw), (date_now, current_yyyykw)
+
+
+def check_odd_kw(view_date, caller: str) -> None:
+    """
+    Raise ValueError for a view date in an even calendar week: its KW_2 target
+    period starts the week before, which the date features already see (target leakage)
+    """
+    view_date = pd.Timestamp(view_date)
+    kw = view_date.isocalendar()[1]
+    if kw % 2 == 0:
+        raise ValueError(f"{caller}: {view_date.date()} is in even KW {kw}")
+
+
+class BookingFeatures:
+    """
+    Booking data of one model run, loaded and indexed by prepare(): filtered bookings
+    (bd), KW_2 aggregates (bd_aggr_2w), booking tensor, campaign date indexes.
+    Holds no module state: builders for different filters can live side by side,
+    and only read their data after prepare(), so snapshots can run concurrently.
+    Pickles without bd and bd_aggr_2w (all snapshots need are tensor and indexes).
+    """
+
+    def __init__(self, sales_filter: bool):
+        self.sales_filter = sales_filter
+        self.bd = pd.DataFrame()
+        self.bd_aggr_2w = pd.DataFrame()
+        self.tensor = None
+        self.campaigns = None
+        self.branchen = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(bd=pd.DataFrame(), bd_aggr_2w=pd.DataFrame())
+        return state
+
+    def prepare(self, bookings: pd.DataFrame = None):
+        """
+        Load booking data (unless given), filter if requested, aggregate to KW_2
+        periods and build the booking tensor and campaign date indexes.
+        Returns self
+        """
+        if bookings is None:
+            ## Recursive Dependency Check:
+            request_job(job_name="bd_prepare.py", current="Today")  # bd_data.feather
+            bookings = load_booking_data()
+        if self.sales_filter:
+            bookings = filter_dataset(bookings)
+            info("True: Filters applied, defined by Sales")
+        else:
+            info("False: Filters applied, defined by Sales")
+        self.bd = bookings
+        self.bd_aggr_2w = aggregate_bookings(bookings, "KW_2")
+        self.tensor = BookingTensor(self.bd_aggr_2w)
+        self.campaigns = EventIndex(
+            bookings, by="Endkunde_NR", date_col="Kampagne_Erfassungsdatum"
+        )
+        self.branchen = branchen_events(bookings)
+        return self
+
+    def booking_yearly_totals(self, yyyykw, year_span):
+        """
+        Computing yearly totals for Aushang and Reservation.
+        Warning: Yearly totals do not necessarily align with calendar years!
+        """
+        return self.tensor.yearly_totals(yyyykw, year_span)
+
+    def booking_data(self, yyyykw, year_span):
+        """
+        Creates features per KW_2 for time span between YYYYKW and back the selected amount of years year_span,
+        target variables for YYYYKW, and yearly totals
+        """
+        return self.tensor.snapshot(yyyykw, year_span)
+
+    def dates_bd(self, view_date):
+        return dates_bd(view_date, self.campaigns)
+
+    def branchen_data(self, view_date):
+        return branchen_data(view_date, self.branchen)
+
+    def snapshot(self, view_date, yyyykw: int, year_span: int):
+        """Date, booking and Branchen features of one reference date / week"""
+        return (
+            self.dates_bd(view_date),
+            self.booking_data(yyyykw, year_span),
+            self.branchen_data(view_date),
+        )
+
+    def train_scoring_parts(
+        self, day: int, month: int, year_score: int, year_train: int, year_span: int
+    ):
+        """
+        Training and scoring snapshot, unmerged: (dates, bookings, Branchen) each.
+        Returns both snapshots and feature column name lists for bookings,
+        booking-dates and Branchen (present in both snapshots only)
+        """
+        (training_date, scoring_date) = train_scoring_dates(
+            day, month, year_score, year_train
+        )
+        info(f"(current_yyyykw / training_yyyykw): ({scoring_date[1]} / {training_date[1]})")
+        info(f"(date_now / date_training): ({scoring_date[0]} / {training_date[0]})")
+        ## Both snapshots come from the same booking tensor
+        training = self.snapshot(*training_date, year_span)
+        scoring = self.snapshot(*scoring_date, year_span)
+        (feature_colnames_bd, feature_colnames_dates, training_colnames_branchen) = (
+            _feature_colnames(*training)
+        )
+
+        ## Branchen: only those present in both snapshots
+        feature_colnames_branchen = sorted(
+            set(training_colnames_branchen) & set(_feature_colnames(*scoring)[2])
+        )
+        return (
+            training,
+            scoring,
+            feature_colnames_bd,
+            feature_colnames_dates,
+            feature_colnames_branchen,
+        )
+
+
+def _fill_branchen(df, branchen_cols):
+    """Customers without (known) Branche get 0 in all (sparse) Branchen columns"""
+    return df.fillna({col: 0 for col in branchen_cols})
+
+
+def _merge_snapshot(dates, bookings, branchen):
+    merged = pd.merge(dates, bookings, on="Endkunde_NR").merge(
+        branchen, on="Endkunde_NR", how="left"
     )
-    ## Relative Dates
-    training_dates = dates_bd(date_training)
-    scoring_dates = dates_bd(date_now)
-    feature_colnames_dates = remove_list(
-        input_list=list(training_dates.columns),
-        to_remove=[
-            "Endkunde_NR",
-            "Kampagne_Erfass_Datum_min",
-            "Kampagne_Erfass_Datum_max",
-        ],
+    return _fill_branchen(merged, branchen.columns[1:])
+
+
+def _feature_colnames(dates, bookings, branchen):
+    """Feature column names of bookings, dates and Branchen in a snapshot"""
+    return (
+        remove_list(
+            input_list=list(bookings.columns),
+            to_remove=["Endkunde_NR", "Target_Aus_flg", "Target_Res_flg"],
+        ),
+        remove_list(
+            input_list=list(dates.columns),
+            to_remove=[
+                "Endkunde_NR",
+                "Kampagne_Erfass_Datum_min",
+                "Kampagne_Erfass_Datum_max",
+            ],
+        ),
+        remove_list(input_list=list(branchen.columns), to_remove="Endkunde_NR"),
     )
 
-    ## Branchen:
-    training_branchen = branchen_data(date_training)
-    scoring_branchen = branchen_data(date_now)
-    feature_colnames_branchen = list(
-        set(training_branchen.columns) & set(scoring_branchen.columns)
+
+def bd_snapshot_parts(
+    day: int, month: int, year_score: int, year_train: int, year_span: int, sales_filter: bool
+):
+    """
+    Training and scoring snapshot, unmerged: (dates, bookings, Branchen) each.
+    Loads booking data, see BookingFeatures.train_scoring_parts
+    """
+    return BookingFeatures(sales_filter).prepare().train_scoring_parts(
+        day, month, year_score, year_train, year_span
     )
-    feature_colnames_branchen.sort()
-    feature_colnames_branchen.remove("Endkunde_NR")
+
+
+@cached(feature_cache, sources=booking_sources)
+def bd_train_scoring(
+    day: int,
+    month: int,
+    year_score: int,
+    year_train: int,
+    year_span: int,
+    sales_filter: bool,
+    scale_features: bool,
+):
+    """
+    Creates scoring-dataset, training-dataset, feature columns name lists for bookings and booking-dates.
+    Results are cached on disk (see booking_sources), use_cache=False recomputes them
+    """
+    (
+        training,
+        scoring,
+        feature_colnames_bd,
+        feature_colnames_dates,
+        feature_colnames_branchen,
+    ) = bd_snapshot_parts(day, month, year_score, year_train, year_span, sales_filter)
 
     ## Merge all data
-    training_all = pd.merge(training_dates, training_bd, on="Endkunde_NR")
-    training_all = pd.merge(
-        training_all, training_branchen, on="Endkunde_NR", how="left"
-    )
-    scoring_all = pd.merge(scoring_dates, scoring_bd, on="Endkunde_NR")
-    scoring_all = pd.merge(scoring_all, scoring_branchen, on="Endkunde_NR", how="left")
+    training_all = _merge_snapshot(*training)
+    scoring_all = _merge_snapshot(*scoring)
 
     ## Scale features, if requested
     if scale_features:
@@ -539,4 +615,124 @@ def bd_train_scoring(
     )
 
 
+def snapshot_matrix(
+    snapshot,
+    feature_colnames_bd,
+    feature_colnames_dates,
+    feature_colnames_branchen,
+    extra_blocks=None,
+):
+    """
+    FeatureMatrix of one snapshot (dates, bookings, Branchen, see bd_snapshot_parts),
+    written block by block instead of merged: customers with booking dates and
+    bookings (as the inner merge), blocks "bookings" (without Target columns),
+    "dates", "branchen" (sparse) and extra_blocks ({name: columns}, e.g. CRM
+    features), which are left empty for the caller to write. Unscaled.
+    """
+    (dates, bookings, branchen) = snapshot
+    customers = np.intersect1d(dates["Endkunde_NR"], bookings["Endkunde_NR"])
+    layout = {
+        "bookings": [col for col in feature_colnames_bd if not col.startswith("Target")],
+        "dates": feature_colnames_dates,
+        "branchen": feature_colnames_branchen,
+        **({} if extra_blocks is None else extra_blocks),
+    }
+    features = FeatureMatrix(customers, layout, sparse_blocks=["branchen"])
+    features.write_frame("bookings", bookings)
+    features.write_frame("dates", dates, fill_value=np.nan)
+    features.write_frame("branchen", branchen)
+    return features
+
+
+########################################################################################
+## Multiple snapshots (rolling backtests) ##
+########################################################################################
+
+
+_worker_features = None  # booking data of a snapshot worker process
+
+
+def _init_snapshot_worker(features: BookingFeatures):
+    """Worker process initializer: receives prepared data once, instead of per snapshot"""
+    global _worker_features
+    _worker_features = features
+
+
+def _view_date_snapshot(features: BookingFeatures, view_date, year_span: int):
+    """Merged (unscaled) features of one view date, and its feature column names"""
+    view_date = pd.Timestamp(view_date)
+    (iso_year, iso_kw, _) = view_date.isocalendar()
+    parts = features.snapshot(view_date, iso_year * 100 + iso_kw, year_span)
+    colnames = _feature_colnames(*parts)
+    snapshot = _merge_snapshot(*parts)
+    snapshot.insert(0, "View_Date", view_date)
+    return snapshot, colnames
+
+
+def _worker_snapshot(view_date, year_span: int):
+    return _view_date_snapshot(_worker_features, view_date, year_span)
+
+
+def bd_snapshots(
+    view_dates,
+    year_span: int,
+    sales_filter: bool,
+    scale_features: bool,
+    max_workers: int = None,
+):
+    """
+    Feature snapshots for many view dates (in odd KWs only, e.g. every odd KW of the
+    last two years, see pa_lib.period.iso_period_range), stacked into one dataframe with a column
+    View_Date. Booking data is loaded and aggregated once, the snapshots are computed
+    in parallel worker processes (max_workers=1: sequentially in this process).
+
+    Booking columns are named by lag from each view date's reference period, so all
+    snapshots share them and the stacked dataset is one training set. If requested,
+    features are scaled once on the stacked dataset (same scaling for all snapshots).
+
+    Returns stacked dataset, feature column name lists for bookings, booking-dates
+    and Branchen (present in all snapshots only)
+    """
+    view_dates = list(view_dates)
+    for view_date in view_dates:
+        check_odd_kw(view_date, "bd_snapshots")
+    features = BookingFeatures(sales_filter).prepare()
+    info(f"Computing {len(view_dates)} snapshots")
+    snapshot_args = (view_dates, repeat(year_span, len(view_dates)))
+    if max_workers == 1:
+        results = list(
+            map(_view_date_snapshot, repeat(features, len(view_dates)), *snapshot_args)
+        )
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_snapshot_worker,
+            initargs=(features,),
+        ) as pool:
+            results = list(pool.map(_worker_snapshot, *snapshot_args))
+
+    (snapshots, colnames) = zip(*results)
+    (feature_colnames_bd, feature_colnames_dates) = colnames[0][:2]
+    if any(bookings != feature_colnames_bd for (bookings, _, _) in colnames):
+        raise ValueError("bd_snapshots: booking columns differ between view dates")
+    feature_colnames_branchen = sorted(
+        set.intersection(*(set(branchen) for (_, _, branchen) in colnames))
+    )
+    all_colnames_branchen = set.union(*(set(branchen) for (_, _, branchen) in colnames))
+    stacked = _fill_branchen(
+        pd.concat(snapshots, ignore_index=True, sort=False), all_colnames_branchen
+    )
+    if scale_features:
+        info("Scaling features (on all snapshots)")
+        stacked = scaling_bd(
+            stacked, col_bookings=feature_colnames_bd, col_dates=feature_colnames_dates
+        )
+    return (
+        stacked,
+        feature_colnames_bd,
+        feature_colnames_dates,
+        feature_colnames_branchen,
+    )
+
+
 #####################################################################
@@ -21,30 +21,45 @@ pd.options.display.max_columns = None
 
 
 ## Libraries & Settings ##
-from pa_lib.file import load_bin
+from pa_lib.cache import cached
+from pa_lib.file import load_bin, get_project_dir
 from pa_lib.util import cap_words, iso_to_datetime
 
 from pa_lib.log import info
+import pa_lib.events
+from pa_lib.events import EventIndex
+from vkprog_analyse.vkprog_feature_matrix import feature_cache, feature_code_sources
 
 import datetime as dt
 from dateutil.relativedelta import relativedelta
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 ## Lazy Recursive Job Dependency Request:
 from pa_lib.job import request_job
 
-################################################################################
-## Recursive Dependency Check:
-request_job(job_name="crm_prepare.py", current="Today")  # output: bd_data.feather
-
 ################################################################################
 ###################
 ## Load CRM data ##
 ###################
 
 
+def crm_sources():
+    """
+    Files the CRM features depend on (for the feature cache): CRM data,
+    requested first to make it current, and the feature code
+    """
+    request_job(job_name="crm_prepare.py", current="Today")
+    return [
+        Path(get_project_dir()) / "vkprog/crm_data_vkprog.feather",
+        __file__,
+        pa_lib.events.__file__,
+        *feature_code_sources(),
+    ]
+
+
 def load_crm_data():
     raw_data = load_bin("vkprog/crm_data_vkprog.feather").rename(
         mapper=lambda name: cap_words(name, sep="_"), axis="columns"
@@ -53,47 +68,77 @@ def load_crm_data():
     return raw_data.astype({"Year": "int64", "KW_2": "int64"})
 
 
+def kanal_groups(kanal, kanal_grps):
+    """
+    Kanal group of each contact, via the Kanal categories: categorical with the
+    group names of kanal_grps (in their order), missing for Kanal not in any group
+    """
+    kanal = pd.Series(kanal).astype("category")
+    group_names = list(kanal_grps.keys())
+    group_of_kanal = {
+        kanal: nr for (nr, kanals) in enumerate(kanal_grps.values()) for kanal in kanals
+    }
+    category_group = np.array(
+        [group_of_kanal.get(category, -1) for category in kanal.cat.categories] + [-1]
+    )
+    # code -1 (missing Kanal) picks the trailing -1
+    return pd.Categorical.from_codes(
+        category_group[kanal.cat.codes.to_numpy()], categories=group_names
+    )
+
+
 ####################################################
 ## Yearly aggregation per ``Kanal`` group element ##
 ####################################################
 
 
-def contacts_grouped_yrly(date_view, kanal_grps, year_span):
-    ####
-    def yrl_kanal_contacts(_date_view_, group_name, rel_year):
-        return (
-            raw_crm_data.loc[
-                (
-                    raw_crm_data.loc[:, "Kanal"].isin(kanal_grps[group_name])
-                    & (  # adjust to key
-                        raw_crm_data.loc[:, "Datum"]
-                        < _date_view_ - relativedelta(years=rel_year)
-                    )
-                    & (
-                        raw_crm_data.loc[:, "Datum"]
-                        >= _date_view_ - relativedelta(years=rel_year + 1)
-                    )  # adjust years
-                ),
-                :,
-            ]
-            .groupby("Endkunde_NR")
-            .count()
-            .reset_index(inplace=False)
-            .loc[:, ["Endkunde_NR", "Kanal"]]
-            .rename(
-                columns={"Kanal": f"RY_{rel_year}_Anz_{group_name}"}
-            )  # adjust "Anzahl"
-            # .sort_values("Anzahl", ascending=False)
-        )
+def contacts_grouped_yrly(crm_data, date_view, kanal_grps, year_span, how="inner"):
+    """
+    Number of contacts (in crm_data) per customer, Kanal group and relative year
+    before date_view (RY_0: the year before date_view), in columns RY_{i}_Anz_{group}.
+
+    how="inner": only customers with contacts in every group and relative year
+    how="outer": all customers with any contact in that time, 0 for no contacts
+    """
+    if how not in ("inner", "outer"):
+        raise ValueError(f"how must be 'inner' or 'outer', got '{how}'")
+
+    # relative year of each contact: year_edges[i] <= Datum < year_edges[i+1]
+    # is relative year (year_span - 1 - i)
+    year_edges = np.array(
+        [date_view - relativedelta(years=ry) for ry in range(year_span, -1, -1)],
+        dtype="datetime64[ns]",
+    )
+    contact_dates = crm_data["Datum"].to_numpy(dtype="datetime64[ns]")
+    rel_year = year_span - np.searchsorted(year_edges, contact_dates, side="right")
+    group = kanal_groups(crm_data["Kanal"], kanal_grps).codes
+    in_scope = (
+        (contact_dates >= year_edges[0])
+        & (contact_dates < year_edges[-1])
+        & (group >= 0)
+        & crm_data["Endkunde_NR"].notna().to_numpy()
+    )
 
-    #####
-    container_df = yrl_kanal_contacts(
-        _date_view_=date_view, group_name=list(kanal_grps.keys())[1], rel_year=0
-    ).loc[:, "Endkunde_NR"]
-    for name in kanal_grps.keys():
-        for i in range(year_span):
-            rel = yrl_kanal_contacts(_date_view_=date_view, group_name=name, rel_year=i)
-            container_df = pd.merge(container_df, rel, on="Endkunde_NR", how="inner")
+    # count matrix: customer × group × relative year
+    (customer, customers) = pd.factorize(
+        crm_data.loc[in_scope, "Endkunde_NR"], sort=True
+    )
+    n_cells = len(kanal_grps) * year_span
+    counts = np.bincount(
+        customer * n_cells + group[in_scope] * year_span + rel_year[in_scope],
+        minlength=len(customers) * n_cells,
+    ).reshape(len(customers), n_cells)
+
+    keep = (counts > 0).all(axis=1) if how == "inner" else slice(None)
+    container_df = pd.DataFrame(
+        counts[keep],
+        columns=[
+            f"RY_{rel_year}_Anz_{name}"
+            for name in kanal_grps.keys()
+            for rel_year in range(year_span)
+        ],
+    )
+    container_df.insert(0, "Endkunde_NR", np.asarray(customers)[keep])
     return container_df
 
 
@@ -102,70 +147,33 @@ def contacts_grouped_yrly(date_view, kanal_grps, year_span):
 ####################################
 
 
-def delta_contact(date_view, kanal_grps):
-    for name in kanal_grps.keys():
-        raw_crm_data.loc[raw_crm_data.Kanal.isin(kanal_grps[name]), "Kanal_Grps"] = name
-
-    max_vertical_df = (
-        raw_crm_data.loc[(raw_crm_data.loc[:, "Datum"] < date_view), :]  # adjust years
-        .groupby(["Endkunde_NR", "Kanal_Grps"])
-        .agg({"Datum": np.max})
-        .reset_index(inplace=False)
+def contact_events(crm_data, kanal_grps):
+    """Index of contact dates per customer and Kanal group"""
+    return EventIndex(
+        crm_data.assign(Kanal_Grps=kanal_groups(crm_data["Kanal"], kanal_grps)),
+        by=["Endkunde_NR", "Kanal_Grps"],
+        date_col="Datum",
     )
-    max_vertical_df["delta_days"] = (date_view - max_vertical_df.loc[:, "Datum"]).apply(
-        lambda x: x.total_seconds()
-    ) / 86400  # delta in days
-
-    flatten_df = max_vertical_df.pivot_table(
-        index="Endkunde_NR",
-        columns=["Kanal_Grps"],
-        values=["delta_days"],
-        aggfunc="min",
-        # fill_value = np.inf # Do not fill them!
-    ).reset_index(inplace=False)
-
-    flatten_df = pd.DataFrame(flatten_df.to_records(index=False))
-    flatten_df.columns = ["Endkunde_NR"] + [
-        "Letzter_Kontakt_Delta_"
-        + x.replace("'", "")
-        .replace("(", "")
-        .replace("delta_days, ", "")
-        .replace(",", "")
-        .replace(" ", "")
-        .replace(")", "")
-        for x in flatten_df.columns[1:]
-    ]
 
-    flatten_df["Letzter_Kontakt_Delta_global"] = flatten_df.iloc[:, 1:].min(
-        axis=1, skipna=True
-    )
 
-    # Letzte_Buchung_Delta
+def delta_contact(date_view, contacts):
+    """
+    Days since the last contact before date_view, per customer and Kanal group
+    (columns Letzter_Kontakt_Delta_{group}, missing if no contact in that group)
+    and over all groups (Letzter_Kontakt_Delta_global).
+    Pure function of the contact index (see contact_events), it changes no data.
+    """
+    last_contact = contacts.last_per(date_view, level="Kanal_Grps")
+    flatten_df = (pd.Timestamp(date_view) - last_contact) / pd.Timedelta(days=1)
+    flatten_df.columns = [f"Letzter_Kontakt_Delta_{grp}" for grp in flatten_df.columns]
 
-    return flatten_df
+    flatten_df["Letzter_Kontakt_Delta_global"] = flatten_df.min(axis=1, skipna=True)
 
+    return flatten_df.rename_axis("Endkunde_NR").reset_index()
 
-#######################################################
-## Wrapper Function, that does everything in one go! ##
-#######################################################
 
-raw_crm_data = pd.DataFrame()
-
-def crm_train_scoring(day, month, year_score, year_train, year_span):
-    info("Start.")
-    date_now = dt.datetime(
-        year_score, month, day
-    )  # only works for odd calendar weeks!!!
-
-    date_training = iso_to_datetime(
-        year=year_train, kw=date_now.isocalendar()[1], day=1
-    )
-
-    global raw_crm_data
-    raw_crm_data = load_crm_data()
-
-    ## Define groups for Kanal ##
-    all_kanal = set(raw_crm_data.loc[:, "Kanal"])
+def default_kanal_groups(all_kanal):
+    """Kanal groups of the model, all other Kanal go into group Anderes"""
     kanal_grps = {
         "Besprechung": {"Besprechung"},
         "Besuch": {"Besuch"},
@@ -176,21 +184,79 @@ def crm_train_scoring(day, month, year_score, year_train, year_span):
     }
 
     # Stuff all the rest into "Anderes":
-    kanal_grps["Anderes"] = all_kanal - reduce(set.union, kanal_grps.values())
-    ## End of definition
-
-    def crm_prep(date_view, _year_span_):
-        last_contacts_df = delta_contact(date_view=date_view, kanal_grps=kanal_grps)
+    kanal_grps["Anderes"] = set(all_kanal) - reduce(set.union, kanal_grps.values())
+    return kanal_grps
+
+
+class CrmFeatures:
+    """
+    CRM data of one model run, loaded and indexed by prepare(): contacts, Kanal groups
+    and contact index. Holds no module state, and only reads its data after prepare():
+    snapshots of several view dates can run concurrently.
+    how: customers in the yearly contact counts, see contacts_grouped_yrly
+    """
+
+    def __init__(self, how="inner"):
+        self.how = how
+        self.crm_data = pd.DataFrame()
+        self.kanal_grps = {}
+        self.contacts = None
+
+    def prepare(self, crm_data: pd.DataFrame = None):
+        """Load CRM data (unless given), define Kanal groups, index contacts. Returns self"""
+        if crm_data is None:
+            ## Recursive Dependency Check:
+            request_job(job_name="crm_prepare.py", current="Today")
+            crm_data = load_crm_data()
+        self.crm_data = crm_data
+        self.kanal_grps = default_kanal_groups(crm_data.loc[:, "Kanal"])
+        self.contacts = contact_events(crm_data, self.kanal_grps)
+        return self
+
+    def snapshot(self, date_view, year_span):
+        """CRM features of customers with contacts before date_view"""
+        last_contacts_df = delta_contact(date_view=date_view, contacts=self.contacts)
         grpd_yrly_contacts_df = contacts_grouped_yrly(
-            date_view=date_view, kanal_grps=kanal_grps, year_span=_year_span_
+            self.crm_data,
+            date_view=date_view,
+            kanal_grps=self.kanal_grps,
+            year_span=year_span,
+            how=self.how,
         )
 
         return pd.merge(
             grpd_yrly_contacts_df, last_contacts_df, on="Endkunde_NR", how="inner"
         ).astype({"Endkunde_NR": "int64"})
 
-    crm_train_df = crm_prep(date_view=date_training, _year_span_=year_span)
-    crm_score_df = crm_prep(date_view=date_now, _year_span_=year_span)
+
+#######################################################
+## Wrapper Function, that does everything in one go! ##
+#######################################################
+
+
+@cached(feature_cache, sources=crm_sources)
+def crm_train_scoring(day, month, year_score, year_train, year_span, how="inner"):
+    """
+    CRM features for training and scoring. how: customers in the yearly contact
+    counts, see contacts_grouped_yrly.
+    Results are cached on disk (see crm_sources), use_cache=False recomputes them
+    """
+    info("Start.")
+    date_now = dt.datetime(
+        year_score, month, day
+    )  # only works for odd calendar weeks!!!
+
+    date_training = iso_to_datetime(
+        year=year_train, kw=date_now.isocalendar()[1], day=1
+    )
+
+    crm = CrmFeatures(how).prepare()
+
+    # snapshots only read shared data: training and scoring run concurrently
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        crm_train = pool.submit(crm.snapshot, date_view=date_training, year_span=year_span)
+        crm_score = pool.submit(crm.snapshot, date_view=date_now, year_span=year_span)
+        (crm_train_df, crm_score_df) = (crm_train.result(), crm_score.result())
 
     feature_colnames_crm = list(crm_train_df.columns[1:])
 
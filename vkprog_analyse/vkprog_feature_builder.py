@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+
+import datetime as dt
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+
+from pa_lib.cache import cached
+from pa_lib.log import info
+
+from vkprog_analyse.vkprog_dataprep_booking import (
+    BookingFeatures,
+    booking_sources,
+    snapshot_matrix,
+    train_scoring_dates,
+)
+from vkprog_analyse.vkprog_dataprep_crm import CrmFeatures, crm_sources
+from vkprog_analyse.vkprog_feature_matrix import feature_cache
+
+################################################################################
+# # Feature builder
+################################################################################
+
+
+class FeatureBuilder:
+    """
+    All features of one model configuration (year_span, sales_filter, how), built
+    from its own loaded data: booking features (see BookingFeatures) and CRM features
+    (see CrmFeatures). No module state is involved, so several builders (other
+    filters, other dates) can be prepared and used side by side, in threads or
+    in worker processes (see train_scoring_many).
+
+    prepare() loads and indexes the data (requesting the prepare jobs), after that
+    all snapshot methods only read it.
+    """
+
+    def __init__(self, year_span: int = 4, sales_filter: bool = True, how="inner"):
+        self.year_span = year_span
+        self.bookings = BookingFeatures(sales_filter)
+        self.crm = CrmFeatures(how)
+
+    def prepare(self, bookings=None, crm_data=None):
+        """Load (unless given) and index booking and CRM data. Returns self"""
+        self.bookings.prepare(bookings)
+        self.crm.prepare(crm_data)
+        return self
+
+    def snapshot(self, view_date, yyyykw: int):
+        """
+        Unmerged features of one view date / reference week:
+        (dates, bookings, Branchen), CRM features
+        """
+        return (
+            self.bookings.snapshot(view_date, yyyykw, self.year_span),
+            self.crm.snapshot(view_date, self.year_span),
+        )
+
+    def feature_matrix(self, snapshot, crm_df, colnames: dict):
+        """
+        Unscaled FeatureMatrix of a snapshot, with CRM features written into block
+        "crm". colnames: block name -> columns, as returned by train_scoring.
+        Raises ValueError if the snapshot lacks booking columns of colnames (e.g. a
+        layout of another year_span)
+        """
+        missing = set(colnames["bookings"]) - set(snapshot[1].columns)
+        if missing:
+            raise ValueError(
+                f"FeatureBuilder: {len(missing)} booking columns of the layout missing"
+                f" in the snapshot, e.g. {sorted(missing)[0]}"
+            )
+        features = snapshot_matrix(
+            snapshot,
+            colnames["bookings"],
+            colnames["dates"],
+            colnames["branchen"],
+            extra_blocks={"crm": colnames["crm"]},
+        )
+        features.write_frame("crm", crm_df, fill_value=np.nan)
+        return features
+
+    def train_scoring(self, day: int, month: int, year_score: int, year_train: int):
+        """
+        Unscaled feature matrices of training and scoring date, and target of training
+        (Target_Res_flg): training matrix, training target, scoring matrix
+        """
+        (
+            training,
+            scoring,
+            colnames_bd,
+            colnames_dates,
+            colnames_branchen,
+        ) = self.bookings.train_scoring_parts(
+            day, month, year_score, year_train, self.year_span
+        )
+        ((date_training, _), (date_now, _)) = train_scoring_dates(
+            day, month, year_score, year_train
+        )
+        crm_training = self.crm.snapshot(date_training, self.year_span)
+        crm_scoring = self.crm.snapshot(date_now, self.year_span)
+        colnames = {
+            "bookings": colnames_bd,
+            "dates": colnames_dates,
+            "branchen": colnames_branchen,
+            "crm": list(crm_training.columns[1:]),
+        }
+        training_matrix = self.feature_matrix(training, crm_training, colnames)
+        training_target = training_matrix.align(training[1], "Target_Res_flg")
+        scoring_matrix = self.feature_matrix(scoring, crm_scoring, colnames)
+        return training_matrix, training_target, scoring_matrix
+
+    def training_matrix(
+        self, day: int, month: int, year_score: int, year_train: int, colnames: dict
+    ):
+        """
+        Unscaled feature matrix and target (Target_Res_flg) of the training date only,
+        in the layout colnames (e.g. of a stored model, see vkprog_retrain.py)
+        """
+        ((date_training, training_yyyykw), _) = train_scoring_dates(
+            day, month, year_score, year_train
+        )
+        (training, crm_training) = self.snapshot(date_training, training_yyyykw)
+        training_matrix = self.feature_matrix(training, crm_training, colnames)
+        return training_matrix, training_matrix.align(training[1], "Target_Res_flg")
+
+    def scoring_matrix(self, day: int, month: int, year_score: int, colnames: dict):
+        """
+        Unscaled feature matrix of the scoring date only, in the layout colnames
+        (block name -> columns, e.g. of a stored model, see ModelArtifact)
+        """
+        date_now = dt.datetime(year_score, month, day)  # only works for odd calendar weeks!!!
+        current_yyyykw = year_score * 100 + date_now.isocalendar()[1]
+        (scoring, crm_scoring) = self.snapshot(date_now, current_yyyykw)
+        return self.feature_matrix(scoring, crm_scoring, colnames)
+
+
+def _feature_sources():
+    return booking_sources() + crm_sources() + [__file__]
+
+
+@cached(feature_cache, sources=_feature_sources)
+def train_scoring_features(
+    day: int,
+    month: int,
+    year_score: int,
+    year_train: int,
+    year_span: int = 4,
+    sales_filter: bool = True,
+    how="inner",
+):
+    """
+    Training matrix, training target and scoring matrix of FeatureBuilder.train_scoring,
+    cached on disk: unchanged parameters and source data load them instead of
+    preparing a builder. use_cache=False recomputes them
+    """
+    builder = FeatureBuilder(year_span, sales_filter, how).prepare()
+    return builder.train_scoring(day, month, year_score, year_train)
+
+
+def _prepared_train_scoring(builder: FeatureBuilder, dates):
+    return builder.prepare().train_scoring(*dates)
+
+
+def train_scoring_many(builders, day, month, year_score, year_train, max_workers=None):
+    """
+    Prepare several (unprepared) builders, e.g. with and without sales filter, and
+    build their training / scoring matrices (see FeatureBuilder.train_scoring),
+    each in its own worker process. Returns their results, in order of builders
+    """
+    builders = list(builders)
+    info(f"Building features of {len(builders)} configurations")
+    dates = (day, month, year_score, year_train)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(
+            pool.map(_prepared_train_scoring, builders, repeat(dates, len(builders)))
+        )
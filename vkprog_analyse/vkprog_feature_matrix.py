@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+
+import sys
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import pa_lib.cache
+import pa_lib.data
+import pa_lib.util
+from pa_lib.cache import DiskCache
+
+# Feature sets of the data prep functions, by parameters and source files (see pa_lib.cache)
+feature_cache = DiskCache("vkprog/feature_cache", max_entries=16, max_bytes=8 * 1024 ** 3)
+
+
+def feature_code_sources() -> list:
+    """
+    Code files all cached feature sets depend on (for the feature cache): this
+    module (FeatureMatrix, model_matrix), the cache itself and shared helpers
+    """
+    return [__file__, pa_lib.cache.__file__, pa_lib.data.__file__, pa_lib.util.__file__]
+
+################################################################################
+# # Model matrix
+################################################################################
+
+
+def is_sparse_col(col: pd.Series) -> bool:
+    return isinstance(col.dtype, pd.SparseDtype)
+
+
+def model_matrix(df: pd.DataFrame, columns, dtype="float64"):
+    """
+    Feature matrix of df's columns (in this order), for model training / scoring.
+    If any of the columns is sparse (e.g. Branchen indicators), the result is a
+    scipy CSR matrix, assembled block by block without densifying the sparse
+    columns. Otherwise a dense numpy array.
+    """
+    columns = list(columns)
+    sparse_cols = [col for col in columns if is_sparse_col(df[col])]
+    if len(sparse_cols) == 0:
+        return df.loc[:, columns].to_numpy(dtype=dtype)
+
+    # consecutive runs of sparse / dense columns become one block each
+    blocks = []
+    start = 0
+    for end in range(1, len(columns) + 1):
+        if end == len(columns) or (columns[end] in sparse_cols) != (
+            columns[start] in sparse_cols
+        ):
+            block_cols = columns[start:end]
+            if block_cols[0] in sparse_cols:
+                block = df.loc[:, block_cols].sparse.to_coo()
+            else:
+                block = sparse.csr_matrix(df.loc[:, block_cols].to_numpy(dtype=dtype))
+            blocks.append(block)
+            start = end
+    return sparse.hstack(blocks, format="csr", dtype=dtype)
+
+
+def dense(matrix) -> np.ndarray:
+    """Dense array of a (possibly sparse) model matrix"""
+    return matrix.toarray() if sparse.issparse(matrix) else np.asarray(matrix)
+
+
+################################################################################
+# # Feature matrix builder
+################################################################################
+
+
+class FeatureMatrix:
+    """
+    Feature matrix for a fixed customer index, assembled block by block.
+
+    The layout (block name -> column names) is fixed up front: all dense blocks share
+    one preallocated array (rows: customers, C order), each writing into its own
+    column range. Sparse blocks (e.g. Branchen indicators) are kept as CSR matrices,
+    and written densely into the model matrix (see matrix).
+    Feature blocks write their values directly, aligned on the customer index:
+    no merged DataFrames, no copies beyond the final matrix.
+    """
+
+    def __init__(self, customers, layout: dict, sparse_blocks=(), dtype="float32"):
+        self.customers = pd.Index(np.asarray(customers), name="Endkunde_NR")
+        if not self.customers.is_unique:
+            raise ValueError("FeatureMatrix: customer index must be unique")
+        self.layout = {block: list(columns) for (block, columns) in layout.items()}
+        self.sparse_blocks = set(sparse_blocks)
+        self.dtype = np.dtype(dtype)
+
+        self._slices = {}
+        width = 0
+        for (block, columns) in self.layout.items():
+            if block not in self.sparse_blocks:
+                self._slices[block] = slice(width, width + len(columns))
+                width += len(columns)
+        self.values = np.zeros((len(self.customers), width), dtype=self.dtype)
+        self._sparse = {
+            block: sparse.csr_matrix(
+                (len(self.customers), len(self.layout[block])), dtype=self.dtype
+            )
+            for block in self.sparse_blocks
+        }
+
+    @property
+    def shape(self):
+        return (len(self.customers), sum(map(len, self.layout.values())))
+
+    def columns(self, blocks=None) -> list:
+        """Column names of blocks (default: all), in layout order"""
+        return [col for block in self._blocks(blocks) for col in self.layout[block]]
+
+    def column_info(self) -> pd.DataFrame:
+        """Column metadata: name, block, sparse or not, position in matrix()"""
+        return pd.DataFrame(
+            [
+                (col, block, block in self.sparse_blocks)
+                for block in self.layout
+                for col in self.layout[block]
+            ],
+            columns=["Column", "Block", "Sparse"],
+        )
+
+    def _blocks(self, blocks):
+        blocks = list(self.layout) if blocks is None else list(blocks)
+        unknown = set(blocks) - set(self.layout)
+        if unknown:
+            raise KeyError(f"FeatureMatrix: unknown blocks {sorted(unknown)}")
+        return blocks
+
+    def _rows(self, customers):
+        """Matrix row of each customer (-1: not in index)"""
+        return self.customers.get_indexer(np.asarray(customers))
+
+    def block(self, name):
+        """Values of one block: view into the dense array, or the CSR matrix"""
+        if name in self.sparse_blocks:
+            return self._sparse[name]
+        return self.values[:, self._slices[name]]
+
+    def write(self, name, values, customers, fill_value=0.0):
+        """
+        Write a dense block: values (rows of customers, block columns in layout order).
+        Customers not in the index are ignored, index customers missing from
+        customers get fill_value.
+        """
+        if name in self.sparse_blocks:
+            raise ValueError(f"FeatureMatrix: block {name} is sparse, use write_sparse")
+        rows = self._rows(customers)
+        found = rows >= 0
+        target = self.block(name)
+        target[:] = fill_value
+        target[rows[found]] = np.asarray(values)[found]
+
+    def write_sparse(self, name, matrix, customers, columns):
+        """
+        Write a sparse block: matrix (rows of customers, given columns).
+        Only customers and columns of the layout are kept, all others are 0.
+        """
+        matrix = sparse.coo_matrix(matrix)
+        rows = self._rows(customers)[matrix.row]
+        cols = pd.Index(self.layout[name]).get_indexer(np.asarray(columns))[matrix.col]
+        keep = (rows >= 0) & (cols >= 0)
+        self._sparse[name] = sparse.csr_matrix(
+            (matrix.data[keep].astype(self.dtype), (rows[keep], cols[keep])),
+            shape=(len(self.customers), len(self.layout[name])),
+        )
+
+    def write_frame(self, name, df: pd.DataFrame, fill_value=0.0, on="Endkunde_NR"):
+        """
+        Write a block from a dataframe with customer column `on` and the block's
+        columns (sparse or dense). Block columns missing in df get fill_value
+        (0 for sparse blocks).
+        """
+        columns = self.layout[name]
+        present = [col for col in columns if col in df.columns]
+        if name in self.sparse_blocks:
+            self.write_sparse(name, model_matrix(df, present), df[on], present)
+        else:
+            values = np.full((df.shape[0], len(columns)), fill_value, dtype=self.dtype)
+            positions = pd.Index(columns).get_indexer(present)
+            values[:, positions] = dense(model_matrix(df, present, dtype=self.dtype))
+            self.write(name, values, df[on], fill_value)
+
+    def align(self, df: pd.DataFrame, col, fill_value=0, on="Endkunde_NR"):
+        """Values of df's column col (e.g. a target), in customer index order"""
+        rows = self._rows(df[on])
+        found = rows >= 0
+        values = np.full(len(self.customers), fill_value, dtype=df[col].dtype)
+        values[rows[found]] = df[col].to_numpy()[found]
+        return values
+
+    def matrix(self, blocks=None, rows=slice(None)):
+        """
+        Model matrix of blocks (default: all), in layout order, as dense array: the
+        dense array itself (or a column subset of it) if there are no sparse blocks
+        among them, else one preallocated array with the sparse blocks (small, e.g.
+        Branchen indicators) written in densely. CSR only if all blocks are sparse.
+        rows: row slice or row index array (e.g. a block of rows, for scoring in chunks)
+        """
+        blocks = self._blocks(blocks)
+        if all(block in self.sparse_blocks for block in blocks):
+            return sparse.hstack(
+                [self.block(block)[rows] for block in blocks],
+                format="csr",
+                dtype=self.dtype,
+            )
+        if not any(block in self.sparse_blocks for block in blocks):
+            slices = [self._slices[block] for block in blocks]
+            if all(a.stop == b.start for (a, b) in zip(slices, slices[1:])):
+                # adjacent blocks: a view, all dense blocks: the array itself
+                return self.values[rows, slices[0].start : slices[-1].stop]
+        n_rows = self.values[rows, :0].shape[0]
+        matrix = np.empty((n_rows, len(self.columns(blocks))), dtype=self.dtype)
+        start = 0
+        for block in blocks:
+            width = len(self.layout[block])
+            values = self.block(block)[rows]
+            matrix[:, start : start + width] = dense(values)
+            start += width
+        return matrix
+
+
+########################################################################################
+# TESTING CODE
+########################################################################################
+if __name__ == "__main__":
+    test_df = pd.DataFrame(
+        {
+            "A": [1.0, 2.0, 3.0],
+            "B1": pd.arrays.SparseArray([0, 1, 0], dtype="int8"),
+            "B2": pd.arrays.SparseArray([1, 0, 0], dtype="int8"),
+            "C": [0.5, 0.0, 0.25],
+        }
+    )
+    X = model_matrix(test_df, ["A", "B1", "B2", "C"])
+    print(type(X), X.shape, X.nnz)
+    expected = np.column_stack([np.asarray(test_df[col], dtype="float64") for col in test_df])
+    assert (dense(X) == expected).all()
+    assert isinstance(model_matrix(test_df, ["A", "C"]), np.ndarray)
+
+    test_df.insert(0, "Endkunde_NR", [10, 20, 30])
+    fm = FeatureMatrix(
+        customers=[30, 10, 40],
+        layout={"numbers": ["C", "A", "X"], "flags": ["B2", "B1"]},
+        sparse_blocks=["flags"],
+    )
+    fm.write_frame("numbers", test_df, fill_value=np.nan)
+    fm.write_frame("flags", test_df)
+    print(fm.column_info())
+    print(dense(fm.matrix()))
+    assert np.allclose(
+        dense(fm.matrix()),
+        [[0.25, 3, np.nan, 0, 0], [0.5, 1, np.nan, 1, 0], [np.nan] * 3 + [0, 0]],
+        equal_nan=True,
+    )
+    assert fm.matrix(["numbers"]).base is fm.values
+    assert isinstance(fm.matrix(), np.ndarray) and fm.matrix().flags.c_contiguous
+    assert sparse.issparse(fm.matrix(["flags"]))
+    assert np.array_equal(
+        fm.matrix(rows=[2, 0]), dense(fm.matrix())[[2, 0]], equal_nan=True
+    )
+    assert np.array_equal(
+        dense(fm.matrix(rows=slice(1, 3))), dense(fm.matrix())[1:3], equal_nan=True
+    )
+    assert (fm.align(test_df, "A") == [3, 1, 0]).all()
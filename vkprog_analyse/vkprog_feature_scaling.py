@@ -17,45 +17,166 @@ print(parent_dir)
 sys.path.append(str(parent_dir))
 
 
+import warnings
+from dataclasses import dataclass
+
 import pandas as pd
 import numpy as np
 
+from pa_lib.file import store_pickle, load_pickle
+
 ################################################################################
+# # Column scaling parameters
+################################################################################
+
+
+@dataclass
+class ColumnScaling:
+    """
+    Scaling of the columns of an array: missing values -> fill, log(x+1) if log,
+    then (x - offset) / scale. One parameter per column.
+    """
+
+    fill: np.ndarray
+    offset: np.ndarray
+    scale: np.ndarray
+    log: bool = False
+
+    @classmethod
+    def fit(cls, values, log=False, fill=np.nan, by_max=False):
+        """
+        Parameters fitted on values. fill: number, or "max" (column max).
+        by_max=False: min-max into [0,1], constant columns -> 0
+        by_max=True: divide by column max, constant columns -> 1
+        """
+        values = np.asarray(values, dtype="float64")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN columns
+            if isinstance(fill, str) and fill == "max":
+                # all missing: constant 0 column, so by_max scales it to 1
+                fill = np.nan_to_num(np.nanmax(values, axis=0), nan=0)
+            fill = np.broadcast_to(np.asarray(fill, dtype="float64"), values.shape[1:])
+            filled = cls._filled(values, fill, log)
+            (min_, max_) = (np.nanmin(filled, axis=0), np.nanmax(filled, axis=0))
+        if by_max:
+            constant = max_ == min_
+            (offset, scale) = (np.where(constant, max_ - 1, 0), np.where(constant, 1, max_))
+        else:
+            (offset, scale) = (min_, np.where(max_ > min_, max_ - min_, 1))
+        return cls(fill=fill.copy(), offset=offset, scale=scale, log=log)
+
+    @staticmethod
+    def _filled(values, fill, log):
+        values = np.where(np.isnan(values), fill, values)
+        return np.log1p(values) if log else values
+
+    @classmethod
+    def concat(cls, parts, positions, width):
+        """Combine scalings of column subsets (at positions) into one of width columns"""
+        if len({part.log for part in parts}) > 1:
+            raise ValueError("ColumnScaling.concat: cannot mix log and linear columns")
+        (fill, offset, scale) = (np.full(width, np.nan), np.zeros(width), np.ones(width))
+        for (part, pos) in zip(parts, positions):
+            (fill[pos], offset[pos], scale[pos]) = (part.fill, part.offset, part.scale)
+        return cls(fill=fill, offset=offset, scale=scale, log=parts[0].log)
+
+    def apply(self, values, out=None):
+        """Scaled values, as one array operation (into out, if given)"""
+        result = (self._filled(values, self.fill, self.log) - self.offset) / self.scale
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+
+def crm_scaling(values, columns) -> ColumnScaling:
+    """
+    CRM feature scaling, fitted on values:
+    RY_* counts: missing -> 0, then min-max;
+    Letzter_* deltas: missing (never contacted) -> column max, then divided by max
+    """
+    columns = pd.Index(columns)
+    counts = np.flatnonzero(columns.str.startswith("RY"))
+    deltas = np.flatnonzero(columns.str.startswith("Letzter"))
+    return ColumnScaling.concat(
+        [
+            ColumnScaling.fit(values[:, counts], fill=0),
+            ColumnScaling.fit(values[:, deltas], fill="max", by_max=True),
+        ],
+        positions=[counts, deltas],
+        width=len(columns),
+    )
+
 
+################################################################################
 def scaling_crm_add2master(master_df, crm_df, features_crm):
+    """Merge CRM features into master_df, scaled on master_df's customers"""
     container_df = pd.merge(master_df, crm_df, how="left", on="Endkunde_NR")
+    values = container_df.loc[:, features_crm].to_numpy(dtype="float64")
+    container_df.loc[:, features_crm] = crm_scaling(values, features_crm).apply(values)
+    return container_df
 
-    for col_name in list(
-        np.compress(["RY" == x[0:2] for x in features_crm], features_crm)
-    ):
-        container_df.loc[:, col_name] = container_df.loc[:, col_name].fillna(0)
-        max_ = np.nanmax(container_df.loc[:, col_name])
-        min_ = np.nanmin(container_df.loc[:, col_name])
 
-        if min_ == max_:
-            container_df.loc[:, col_name] = 0
-        else:
-            container_df.loc[:, col_name] = (container_df.loc[:, col_name] - min_) / (
-                max_ - min_
+################################################################################
+# # Fit-once scaler for FeatureMatrix blocks
+################################################################################
+
+
+class FeatureScaler:
+    """
+    Scaling of a FeatureMatrix (see vkprog_dataprep_booking.snapshot_matrix),
+    fitted once on the training matrix and applied unchanged to any other matrix
+    with the same layout (scoring, weekly re-scoring after loading it from disk):
+        bookings: log(x+1), then min-max
+        dates:    min-max
+        crm:      see crm_scaling
+    Sparse blocks (Branchen indicators) are left as they are.
+    """
+
+    def __init__(self):
+        self.scalings = {}  # block name -> ColumnScaling
+        self.columns = {}  # block name -> fitted column names
+
+    def fit(self, features):
+        self.scalings = {
+            "bookings": ColumnScaling.fit(features.block("bookings"), log=True),
+            "dates": ColumnScaling.fit(features.block("dates")),
+        }
+        if "crm" in features.layout:
+            self.scalings["crm"] = crm_scaling(
+                features.block("crm"), features.layout["crm"]
             )
+        self.columns = {block: features.layout[block] for block in self.scalings}
+        return self
 
-    for col_name in list(
-        np.compress(["Letzter" == x[0:7] for x in features_crm], features_crm)
-    ):
-        max_ = np.nanmax(container_df.loc[:, col_name])
-        # -> those who have never been contacted
-        #    will be put together with the max-ones.
-        container_df.loc[:, col_name] = container_df.loc[:, col_name].fillna(
-            max_
-        )  # No more NaNs!
-        min_ = np.nanmin(container_df.loc[:, col_name])
-
-        if max_ == min_:
-            container_df.loc[:, col_name] = 1
-        else:
-            container_df.loc[:, col_name] = container_df.loc[:, col_name] / max_
-            # scaling, doesn't need 0
-    return container_df
+    def transform(self, features, chunk_rows: int = 100_000, blocks=None):
+        """
+        Scale features' blocks (default: all fitted blocks) in place, returns
+        features. Scaled in blocks of chunk_rows rows, so temporary arrays stay
+        small for any number of customers
+        """
+        if not self.scalings:
+            raise ValueError("FeatureScaler: fit before transform")
+        for block in self.scalings if blocks is None else blocks:
+            scaling = self.scalings[block]
+            if features.layout.get(block) != self.columns[block]:
+                raise ValueError(f"FeatureScaler: columns of block {block} differ from fit")
+            block_values = features.block(block)
+            for start in range(0, block_values.shape[0], chunk_rows):
+                chunk = block_values[start : start + chunk_rows]
+                scaling.apply(chunk, out=chunk)
+        return features
+
+    def fit_transform(self, features):
+        return self.fit(features).transform(features)
+
+    def store(self, file_name):
+        """Store as pickle file in the current project directory (e.g. next to the model)"""
+        store_pickle(self, file_name)
+
+    @staticmethod
+    def load(file_name) -> "FeatureScaler":
+        return load_pickle(file_name)
 
 
 ################################################################################
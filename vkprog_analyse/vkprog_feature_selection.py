@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_selection import mutual_info_classif
+from sklearn.model_selection import train_test_split
+
+from pa_lib.cache import DiskCache, data_fingerprint
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_feature_matrix import dense
+
+# Mutual information scores, by training data fingerprint and parameters
+selection_cache = DiskCache("vkprog/selection_cache", max_entries=32)
+
+################################################################################
+# # Mutual information feature scores
+################################################################################
+
+
+def _chunk_scores(X_chunk, y, n_neighbors: int, random_state: int) -> np.ndarray:
+    # dense values: all features continuous, as for SelectKBest on dense(X)
+    return mutual_info_classif(
+        dense(X_chunk),
+        y,
+        discrete_features=False,
+        n_neighbors=n_neighbors,
+        random_state=random_state,
+    )
+
+
+def mutual_info_scores(
+    X,
+    y,
+    chunk_size: int = 16,
+    n_jobs: int = 1,
+    subsample=None,
+    n_neighbors: int = 3,
+    random_state: int = 42,
+    use_cache: bool = True,
+) -> np.ndarray:
+    """
+    Mutual information of each feature (column of X, dense or sparse) with target y,
+    as mutual_info_classif on dense(X), computed per chunk of chunk_size columns in
+    this process (default), or in n_jobs worker processes (None: one per CPU; only
+    from code under if __name__ == "__main__", workers re-import the main script on
+    Windows). Only one chunk is made dense at a time. Chunk i uses random_state + i
+    for its jitter, so scores depend on chunk_size (within noise).
+    subsample: fraction or number of rows of a stratified sample to score on.
+    Scores are cached by the fingerprint of (X, y) and the parameters, so an
+    unchanged training set reuses them (use_cache=False recomputes them).
+    Use as score_func of SelectKBest, e.g. with functools.partial
+    """
+    y = np.asarray(y)
+    key = selection_cache.key(
+        "mutual_info_scores",
+        params={
+            "data": data_fingerprint(X, y),
+            "chunk_size": chunk_size,
+            "subsample": subsample,
+            "n_neighbors": n_neighbors,
+            "random_state": random_state,
+        },
+    )
+    if use_cache:
+        scores = selection_cache.get(key)
+        if scores is not None:
+            return scores
+
+    if subsample is not None:
+        (rows, _) = train_test_split(
+            np.arange(X.shape[0]),
+            train_size=subsample,
+            stratify=y,
+            random_state=random_state,
+        )
+        (X, y) = (X[np.sort(rows)], y[np.sort(rows)])
+    if sparse.issparse(X):
+        X = X.tocsc()  # fast column slicing
+    starts = range(0, X.shape[1], chunk_size)
+    chunks = [X[:, start : start + chunk_size] for start in starts]
+    seeds = [random_state + i for i in range(len(chunks))]
+    args = (chunks, [y] * len(chunks), [n_neighbors] * len(chunks), seeds)
+    with time_log(f"scoring {X.shape[1]} features on {X.shape[0]} rows"):
+        if n_jobs == 1:
+            scores = np.concatenate(list(map(_chunk_scores, *args)))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                scores = np.concatenate(list(pool.map(_chunk_scores, *args)))
+    if use_cache:
+        selection_cache.put(key, scores)
+    return scores
+
+
+def top_k_mask(scores: np.ndarray, k: int) -> np.ndarray:
+    """Boolean mask of the k best scores (ties as SelectKBest)"""
+    mask = np.zeros(len(scores), dtype=bool)
+    mask[np.argsort(scores, kind="mergesort")[-k:]] = True
+    return mask
+
+
+################################################################################
+# TESTING CODE
+################################################################################
+if __name__ == "__main__":
+    from functools import partial
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+
+    from sklearn.datasets import make_classification
+    from sklearn.feature_selection import SelectKBest
+
+    (X, y) = make_classification(
+        n_samples=5000, n_features=64, n_informative=10, weights=[0.9], random_state=1
+    )
+    X_sparse = sparse.csr_matrix(np.where(np.abs(X) < 1, 0, X))
+
+    with TemporaryDirectory() as tmp_dir:
+        selection_cache.path = Path(tmp_dir)
+        start = perf_counter()
+        reference = mutual_info_classif(dense(X_sparse), y, random_state=42)
+        info(f"mutual_info_classif: {perf_counter() - start:.2f}s")
+        for (use_cache, n_jobs) in ((True, 1), (True, 1), (False, 2)):
+            start = perf_counter()
+            scores = mutual_info_scores(X_sparse, y, n_jobs=n_jobs, use_cache=use_cache)
+            info(f"mutual_info_scores ({n_jobs} jobs): {perf_counter() - start:.2f}s")
+        assert np.array_equal(scores, mutual_info_scores(X_sparse, y))
+        # different jitter, as with another random_state: equal within noise
+        assert np.corrcoef(scores, reference)[0, 1] > 0.9
+        select = SelectKBest(partial(mutual_info_scores, subsample=0.5), k=10)
+        select.fit(X_sparse, y)
+        assert (select.get_support() == top_k_mask(select.scores_, 10)).all()
+        common = select.get_support() & top_k_mask(scores, 10)
+        info(f"Common top 10 features (all rows / half sample): {common.sum()}")
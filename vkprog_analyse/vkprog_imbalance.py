@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Class imbalance strategies
+# Few customers book (Target_Res_flg = 1). Strategies to balance training:
+#   * "smote": oversample the minority class with SMOTE (synthetic rows: the training
+#     matrix grows by the difference between the classes, made dense by imblearn)
+#   * "class_weight": weight classes inversely to their frequency in the forest
+#   * "balanced_bootstrap": class weights recomputed on each tree's bootstrap sample
+#   * "undersample": random sample of the majority class, of the minority's size
+#   * "none": train on the data as is
+# Only SMOTE needs imblearn, and only SMOTE copies the training matrix into a larger one.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+from pa_lib.log import info, time_log
+from pa_lib.util import format_size
+
+from vkprog_analyse.vkprog_model_validation import ValidationPredictions
+
+IMBALANCE_STRATEGIES = (
+    "smote",
+    "class_weight",
+    "balanced_bootstrap",
+    "undersample",
+    "none",
+)
+
+################################################################################
+# # Balancing
+################################################################################
+
+
+def undersample(X, y, random_state=42):
+    """Rows of all minority class rows and as many random majority class rows"""
+    y = np.asarray(y)
+    (classes, counts) = np.unique(y, return_counts=True)
+    n_rows = counts.min()
+    rng = np.random.default_rng(random_state)
+    rows = np.sort(
+        np.concatenate(
+            [
+                rng.choice(np.flatnonzero(y == cls), size=n_rows, replace=False)
+                for cls in classes
+            ]
+        )
+    )
+    return X[rows], y[rows]
+
+
+def balance(strategy: str, X, y, random_state=42):
+    """
+    Training data and forest parameters of an imbalance strategy (see above):
+    (X_balanced, y_balanced, forest_params), forest_params for RandomForestClassifier
+    """
+    if strategy == "smote":
+        from imblearn.over_sampling import SMOTE
+
+        with time_log("calculating SMOTE"):
+            (X_balanced, y_balanced) = SMOTE(random_state=random_state).fit_resample(
+                X, y
+            )
+        return X_balanced, y_balanced, {}
+    if strategy == "class_weight":
+        return X, y, {"class_weight": "balanced"}
+    if strategy == "balanced_bootstrap":
+        return X, y, {"class_weight": "balanced_subsample"}
+    if strategy == "undersample":
+        return (*undersample(X, y, random_state), {})
+    if strategy == "none":
+        return X, y, {}
+    raise ValueError(
+        f"Unknown imbalance strategy '{strategy}', use one of {IMBALANCE_STRATEGIES}"
+    )
+
+
+################################################################################
+# # Benchmark
+################################################################################
+
+
+def benchmark(
+    X_train, y_train, X_test, y_test, strategies=IMBALANCE_STRATEGIES, **forest_params
+):
+    """
+    Balance and fit a forest (forest_params) for each strategy, and validate it on
+    the test set. Returns a DataFrame per strategy: training rows, fit time (balancing
+    included), peak memory of numpy / Python allocations during balancing and fit
+    (tracemalloc: balanced copies and fit temporaries, not the C-level tree nodes)
+    and average precision
+    """
+    results = []
+    for strategy in strategies:
+        info(f"Imbalance strategy: {strategy}")
+        tracemalloc.start()
+        start = perf_counter()
+        (X_balanced, y_balanced, strategy_params) = balance(strategy, X_train, y_train)
+        forest = RandomForestClassifier(**forest_params, **strategy_params)
+        forest.fit(X_balanced, y_balanced)
+        fit_time = perf_counter() - start
+        (_, peak_memory) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(
+            {
+                "strategy": strategy,
+                "n_training": X_balanced.shape[0],
+                "fit_time": fit_time,
+                "peak_memory": peak_memory,
+                "avg_precision": ValidationPredictions(
+                    forest, X_test, y_test, name=strategy
+                ).average_precision(),
+            }
+        )
+        del X_balanced, y_balanced, forest
+    return pd.DataFrame.from_records(results).set_index("strategy")
+
+
+################################################################################
+if __name__ == "__main__":
+    from sklearn.model_selection import train_test_split
+
+    from vkprog_analyse.vkprog_feature_builder import train_scoring_features
+    from vkprog_analyse.vkprog_feature_scaling import FeatureScaler
+
+    info("vkprog_imbalance.py: START")
+
+    # Features as in vkprog_master_script.py (cached on disk):
+    (training_matrix, training_target, _) = train_scoring_features(
+        day=1, month=6, year_score=2020, year_train=2019, year_span=4, sales_filter=True
+    )
+    FeatureScaler().fit_transform(training_matrix)
+    (X_train, X_test, y_train, y_test) = train_test_split(
+        training_matrix.matrix(), training_target, train_size=0.75, random_state=42
+    )
+
+    result = benchmark(
+        X_train,
+        y_train,
+        X_test,
+        y_test,
+        n_estimators=500,
+        max_depth=10,
+        random_state=42,
+        n_jobs=-1,
+    )
+    result["peak_memory"] = result["peak_memory"].map(format_size)
+    info(f"Imbalance strategies:\n{result}")
+    info("vkprog_imbalance.py: END")
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Incremental rescoring
+# Between two scoring runs, most customers' features do not change. Each run keeps a
+# fingerprint of every customer's (unscaled) feature row with its probabilities;
+# the next run with the same model only rescores customers that are new or whose
+# row changed (new bookings, CRM contacts, date-relative features moving on), and
+# takes the previous probabilities for all others. Scoring is deterministic, so the
+# result is the same as rescoring everyone.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+
+from pa_lib.file import get_project_dir, load_pickle
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_batch_scoring import feature_rows, score_chunks
+from vkprog_analyse.vkprog_feature_matrix import FeatureMatrix
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
+
+################################################################################
+# # Row fingerprints
+################################################################################
+
+
+def row_fingerprints(features: FeatureMatrix) -> np.ndarray:
+    """
+    64 bit hash of each customer's feature row (all blocks, dense and sparse).
+    Take them before scaling: scaling is the same for all rows of a model
+    """
+    fingerprints = pd.util.hash_pandas_object(
+        pd.DataFrame(features.values), index=False
+    ).to_numpy()
+    for (offset, block) in enumerate(sorted(features.sparse_blocks), start=1):
+        matrix = features.block(block).tocsr()
+        # order independent sum of (column, value) hashes per row, modulo 2^64
+        entries = pd.util.hash_array(matrix.indices.astype("int64") * 7919 + offset)
+        entries = entries ^ pd.util.hash_array(matrix.data)
+        cumulative = np.zeros(len(entries) + 1, dtype="uint64")
+        np.cumsum(entries, dtype="uint64", out=cumulative[1:])
+        row_sums = cumulative[matrix.indptr[1:]] - cumulative[matrix.indptr[:-1]]
+        fingerprints = fingerprints * np.uint64(1_000_003) + row_sums
+    return fingerprints
+
+
+@dataclass
+class ScoreState:
+    """Customers, row fingerprints and probabilities of a scoring run with model_key"""
+
+    model_key: str
+    customers: np.ndarray
+    fingerprints: np.ndarray
+    proba: np.ndarray
+
+    def unchanged_rows(self, customers, fingerprints) -> tuple:
+        """
+        Rows of customers (with their fingerprints) unchanged since this state, and
+        their positions in this state
+        """
+        positions = pd.Index(self.customers).get_indexer(np.asarray(customers))
+        known = positions >= 0
+        unchanged = np.zeros(len(positions), dtype=bool)
+        unchanged[known] = self.fingerprints[positions[known]] == fingerprints[known]
+        rows = np.flatnonzero(unchanged)
+        return rows, positions[rows]
+
+
+def load_state(file_name: str):
+    """ScoreState stored in the current project directory, or None"""
+    if not (Path(get_project_dir()) / file_name).exists():
+        return None
+    return load_pickle(file_name)
+
+
+################################################################################
+# # Rescoring
+################################################################################
+
+
+def _selected_rows(features: FeatureMatrix, feature_mask, row_index, rows: slice):
+    return feature_rows(features, feature_mask, row_index[rows])
+
+
+def rescore_changed(
+    artifact: ModelArtifact,
+    model_key: str,
+    features: FeatureMatrix,
+    state: ScoreState = None,
+    chunk_rows=50_000,
+    n_jobs=1,
+):
+    """
+    Class probabilities of all customers of an unscaled FeatureMatrix (scaled in
+    place), rescoring only customers new or changed since state (a ScoreState of
+    the same model_key; None or another model: all customers).
+    Returns the probabilities and the new ScoreState
+    """
+    artifact.check_layout(features)
+    fingerprints = row_fingerprints(features)
+    proba = np.empty((len(features.customers), len(artifact.model.classes_)))
+    rescore = np.ones(len(features.customers), dtype=bool)
+    if state is not None and state.model_key == model_key:
+        (rows, positions) = state.unchanged_rows(features.customers, fingerprints)
+        proba[rows] = state.proba[positions]
+        rescore[rows] = False
+    else:
+        info(f"No previous scores of model {model_key}: scoring all customers")
+
+    row_index = np.flatnonzero(rescore)
+    info(f"Rescoring {len(row_index)} of {len(rescore)} customers")
+    artifact.scaler.transform(features, chunk_rows=chunk_rows)
+    rows_input = partial(_selected_rows, features, artifact.feature_mask, row_index)
+    with time_log(f"rescoring {len(row_index)} customers"):
+        for (rows, chunk_proba) in score_chunks(
+            artifact.scorer(), rows_input, len(row_index), chunk_rows, n_jobs
+        ):
+            proba[row_index[rows]] = chunk_proba
+    new_state = ScoreState(
+        model_key=model_key,
+        customers=np.asarray(features.customers),
+        fingerprints=fingerprints,
+        proba=proba.copy(),
+    )
+    return proba, new_state
+
+
+################################################################################
+# TESTING CODE
+################################################################################
+if __name__ == "__main__":
+    from sklearn.ensemble import RandomForestClassifier
+
+    rng = np.random.default_rng(42)
+    layout = {
+        "bookings": [f"x{i}" for i in range(6)],
+        "dates": [f"x{i}" for i in range(6, 10)],
+        "flags": ["f1", "f2", "f3"],
+    }
+
+    def test_features(customers, values, flags):
+        features = FeatureMatrix(customers, layout, sparse_blocks=["flags"])
+        features.values[:] = values
+        features.write_sparse("flags", flags, customers, layout["flags"])
+        return features
+
+    values = np.abs(rng.normal(size=(1000, 10)))
+    flags = (rng.random((1000, 3)) < 0.2).astype("int8")
+    customers = np.arange(1000)
+    forest = RandomForestClassifier(n_estimators=20, max_depth=5, random_state=42)
+    artifact = ModelArtifact.fit(
+        forest, test_features(customers, values, flags), rng.integers(0, 2, 1000)
+    )
+
+    (proba, state) = rescore_changed(
+        artifact, "m1", test_features(customers, values, flags)
+    )
+    ## next run: 5 changed values, 3 changed flags, 10 new customers, 10 dropped
+    (values_2, flags_2) = (values.copy(), flags.copy())
+    values_2[[11, 12, 13, 14, 15], 0] += 1
+    flags_2[[16, 17, 18], 1] = 1 - flags_2[[16, 17, 18], 1]
+    customers_2 = np.r_[customers[10:], np.arange(1000, 1010)]
+    rows_2 = np.r_[np.arange(10, 1000), np.arange(10)]
+    features_2 = test_features(customers_2, values_2[rows_2], flags_2[rows_2])
+    (proba_2, state_2) = rescore_changed(artifact, "m1", features_2, state)
+    expected = forest.predict_proba(features_2.matrix())  # scaled in place
+    assert np.allclose(proba_2, expected)
+    (unchanged, _) = state.unchanged_rows(customers_2, state_2.fingerprints)
+    assert len(unchanged) == 990 - 8
@@ -8,6 +8,7 @@
 
 # make imports from pa_lib possible (parent directory of file's directory)
 import sys
+from functools import partial
 from pathlib import Path
 
 file_dir = Path.cwd()
@@ -17,21 +18,21 @@ sys.path.append(str(parent_dir))
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from scipy import stats
-from imblearn.over_sampling import SMOTE
-from sklearn.feature_selection import SelectKBest, mutual_info_classif
+from sklearn.feature_selection import SelectKBest
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import classification_report, average_precision_score
 
 # Utilities:
 from pa_lib.file import project_dir, store_bin
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
 from pa_lib.job import request_job
-from pa_lib.log import info, time_log
+from pa_lib.log import info
 
 # Special libs:
-from vkprog_analyse.vkprog_dataprep_booking import bd_train_scoring
-from vkprog_analyse.vkprog_dataprep_crm import crm_train_scoring
-from vkprog_analyse.vkprog_feature_scaling import scaling_crm_add2master
+from vkprog_analyse.vkprog_feature_builder import train_scoring_features
+from vkprog_analyse.vkprog_feature_scaling import FeatureScaler
+from vkprog_analyse.vkprog_imbalance import balance
 from vkprog_analyse.vkprog_model_validation import (
+    ValidationPredictions,
     rforest_features_report,
     roc_auc,
     prec_rec_curve,
@@ -39,6 +40,8 @@ from vkprog_analyse.vkprog_model_validation import (
     roc_curve_graph,
 )
 from vkprog_analyse.vkprog_dataprep_ek_list import add_ek_info
+from vkprog_analyse.vkprog_batch_scoring import predict_proba_chunked
+from vkprog_analyse.vkprog_feature_selection import mutual_info_scores
 
 info("vkprog_master_script.py: START")
 
@@ -55,6 +58,9 @@ request_job(job_name="ek_info_prepare.py", current="Today")
 
 # Output: Name of scored list (saved in data/vkprog/predictions)
 ek_list_name = "20200601_ek_list.feather"
+# Output: Model artifact (forest, feature selection, scaler; saved in data/vkprog/models),
+# for scoring further dates without retraining (see vkprog_score.py):
+model_name = "20200601_vkprog_model.joblib"
 
 # date for prediction:
 day_predict = 1  # Make sure it's a Monday
@@ -64,69 +70,57 @@ year_predict = 2020
 # Year for training the model (Random Forest) on:
 year_training = 2019
 
+year_span = 4  # we take the last four years into account
+sales_filter = True
+# Sales Filter: Keine Langzeitverträge, Eigenwerbung,
+#              Logistik für Dritte, politisch... etc.
+
+# Class imbalance: "smote", "class_weight", "balanced_bootstrap", "undersample" or
+# "none" (see vkprog_imbalance.py, which also benchmarks them):
+imbalance_strategy = "smote"
+
+# Feature selection: mutual information on a stratified sample of the balanced
+# training set (fraction, None: all rows), cached on disk. Computed in this process:
+# this script runs at top level, and worker processes would re-run it on Windows
+mi_subsample = None
+mi_n_jobs = 1
+
 info(f"ek_list_name: {ek_list_name}")
 ########################################################################################
 # Data Preparation
 ########################################################################################
 
-## IT21 Data (booking data):
-(
-    training_all,
-    scoring_all,
-    feature_colnames_bd,
-    feature_colnames_dates,
-    feature_colnames_branchen,
-) = bd_train_scoring(
+## Feature Matrices of booking data (IT21), Branchen and CRM data: booking customers,
+# blocks for bookings, dates, Branchen and CRM (customer-vkber interactions) written
+# in place (no merges). Cached on disk: as long as parameters and source data stay
+# the same, reruns skip straight to training.
+# Then scaled with a scaler fitted on training data only:
+(training_matrix, training_target, scoring_matrix) = train_scoring_features(
     day=day_predict,  # a Monday
     month=month_predict,
     year_score=year_predict,
     year_train=year_training,
-    year_span=4,  # we take the last four years into account
-    scale_features=True,
-    sales_filter=True
-    # Sales Filter: Keine Langzeitverträge, Eigenwerbung,
-    #              Logistik für Dritte, politisch... etc.
-)
-
-## CRM Data:
-(crm_train_df, crm_score_df, feature_colnames_crm) = crm_train_scoring(
-    day=day_predict,
-    month=month_predict,
-    year_score=year_predict,
-    year_train=year_training,
-    year_span=4,  # we take the last four years into account
-)
-
-## Feature Scaling:
-training_all = scaling_crm_add2master(
-    master_df=training_all, crm_df=crm_train_df, features_crm=feature_colnames_crm
-)
-scoring_all = scaling_crm_add2master(
-    master_df=scoring_all, crm_df=crm_score_df, features_crm=feature_colnames_crm
+    year_span=year_span,
+    sales_filter=sales_filter,
 )
+scaler = FeatureScaler().fit(training_matrix)
+scaler.transform(training_matrix)
+scaler.transform(scoring_matrix)
 
 ## Define Columns: Features versus Targets:
-features = (
-    feature_colnames_bd  # Booking data
-    + feature_colnames_dates  # Dates related to bookings
-    + feature_colnames_branchen  # Branches
-    + feature_colnames_crm  # CRM (customer-vkber interactions)
-)
-feature_columns_boolean = pd.Series(features).str.match("^Target")
-feature_columns = pd.Series(features).loc[~feature_columns_boolean]
-feature_columns_boolean = pd.Series(training_all.columns).str.match("^Target")
-target_columns = pd.Series(training_all.columns).loc[feature_columns_boolean]
+feature_columns = pd.Series(training_matrix.columns())
 
 info(f"Number of features: {len(feature_columns)}\n")
-info(f"Target columns: {target_columns}")
+info("Target column: Target_Res_flg")
 
 ########################################################################################
 # Modeling
 ########################################################################################
 
-df_features = training_all.loc[:, feature_columns].to_numpy()
-df_target = training_all.loc[:, "Target_Res_flg"].to_numpy()
-df_scoring_features = scoring_all.loc[:, feature_columns].to_numpy()
+# Dense float32 matrices, with the sparse Branchen indicators written in
+df_features = training_matrix.matrix()
+df_target = training_target
+df_scoring_features = scoring_matrix.matrix()
 info(f"df_features.shape: {df_features.shape}")
 info(f"df_target.shape:   {df_target.shape}")
 info(f"df_scoring_features.shape: {df_scoring_features.shape}")
@@ -146,10 +140,10 @@ info("\ny_test:")
 info(pd.DataFrame(y_test).groupby(0)[0].count())
 info(list(stats.describe(y_test)))
 
-## Balance Training Dataset:
-with time_log("calculating SMOTE"):
-    sm = SMOTE(random_state=42)
-    (X_train_balanced, y_train_balanced) = sm.fit_resample(X_train, y_train)
+## Balance Training Dataset (or let the forest weight classes, see imbalance_strategy):
+(X_train_balanced, y_train_balanced, imbalance_params) = balance(
+    imbalance_strategy, X_train, y_train, random_state=42
+)
 info("y_train_balanced:")
 info(pd.DataFrame(y_train_balanced).groupby(0)[0].count())
 info(stats.describe(y_train_balanced))
@@ -157,8 +151,10 @@ info(stats.describe(y_train_balanced))
 ## Feature selection:
 info("Feature selection")
 select = SelectKBest(
-    score_func=mutual_info_classif, k=150  # How many features? (currently 219 is max)
+    score_func=partial(mutual_info_scores, n_jobs=mi_n_jobs, subsample=mi_subsample),
+    k=150,  # How many features? (currently 219 is max)
 )
+# scored as continuous (dense) features, chunk by chunk; unchanged data reuses the scores
 select.fit(X_train_balanced, y_train_balanced)
 mask = select.get_support()  # boolean array.
 info(f"X_train_balanced.shape: {X_train_balanced.shape}")
@@ -182,6 +178,7 @@ forest_01 = RandomForestClassifier(
     criterion="gini",  # criterion='gini',
     random_state=42,
     n_jobs=-1,
+    **imbalance_params,
 )
 
 forest_01.fit(X_train_balanced, y_train_balanced)
@@ -192,7 +189,10 @@ info(
     ]
 )
 info(f"Accuracy on unbalanced training set: {forest_01.score(X_train, y_train)}"[:42])
-info(f"Accuracy on test set (validation):   {forest_01.score(X_test, y_test)}"[:42])
+
+# Test set predictions, computed once for all validation reports below:
+test_predictions = ValidationPredictions(forest_01, X_test, y_test, name="forest_01")
+info(f"Accuracy on test set (validation):   {test_predictions.accuracy()}"[:42])
 
 ## Plot features ranked by importance:
 
@@ -205,44 +205,67 @@ info("Model Validation")
 
 ## Confusion Matrix:
 
-confusion_matrices(x_test=X_test, y_test=y_test, model=forest_01)
+confusion_matrices(test_predictions)
 
 ## Classification Report:
 
 info("Calssification Report:")
 print(
-    classification_report(
-        y_test,
-        forest_01.predict(X_test),
-        target_names=["not booking = 0", "booking = 1"],
+    test_predictions.classification_report(
+        target_names=["not booking = 0", "booking = 1"]
     )
 )
 
 ## Precision-Recall Curve:
-#prec_rec_curve(x_train=X_test, y_train=y_test, model=forest_01)
+#prec_rec_curve(test_predictions)
 
 
 ## Average Precision:
 
-avg_precision_forest_01 = average_precision_score(
-    y_test, forest_01.predict_proba(X_test)[:, 1]
-)
+avg_precision_forest_01 = test_predictions.average_precision()
 info(f"Average Precision of forest_01: {avg_precision_forest_01}"[:37])
 
 ## Receiver Operating Characteristics (ROC) and AUC:
 
-roc_curve_graph(X_test, y_test, model=forest_01)
-roc_auc(X_test, y_test, forest_01)
+roc_curve_graph(test_predictions)
+roc_auc(test_predictions)
+
+########################################################################################
+# Model Artifact: for scoring without retraining (vkprog_score.py)
+########################################################################################
+
+model_artifact = ModelArtifact(
+    model=forest_01,
+    layout=training_matrix.layout,
+    scaler=scaler,
+    feature_mask=mask,
+    feature_names=list(feature_columns),
+    metadata={
+        "year_training": year_training,
+        "date_scoring": f"{year_predict}-{month_predict:02}-{day_predict:02}",
+        "year_span": year_span,
+        "sales_filter": sales_filter,
+        "imbalance_strategy": imbalance_strategy,
+        "n_training": X_train.shape[0],
+        "avg_precision": avg_precision_forest_01,
+    },
+)
+with project_dir("vkprog/models"):
+    model_artifact.store(model_name)
 
 ########################################################################################
 # Scoring:
 ########################################################################################
 # Score Class Probabilities (Booking: No/Yes)
 
-scoring_prob = forest_01.predict_proba(X_scoring)
-scoring_prob_df = pd.DataFrame(scoring_prob, columns=["Prob_0", "Prob_1"])
-scoring_all_prob = pd.merge(
-    scoring_all, scoring_prob_df, left_index=True, right_index=True
+# in blocks of rows: memory for model temporaries independent of the number of customers
+scoring_prob = predict_proba_chunked(forest_01, X_scoring, chunk_rows=50_000)
+scoring_all_prob = pd.DataFrame(
+    {
+        "Endkunde_NR": scoring_matrix.customers,
+        "Prob_0": scoring_prob[:, 0],
+        "Prob_1": scoring_prob[:, 1],
+    }
 ).sort_values("Prob_1", ascending=False)
 
 info(f"scoring_all_prob.shape: {scoring_all_prob.shape}")
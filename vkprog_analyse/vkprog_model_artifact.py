@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime as dtt
+from pathlib import Path
+from typing import Any
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import joblib
+import numpy as np
+import sklearn
+
+from pa_lib.file import get_project_dir
+from pa_lib.forest import ForestArrays
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_feature_matrix import FeatureMatrix
+from vkprog_analyse.vkprog_feature_scaling import FeatureScaler
+
+################################################################################
+# # Model artifact
+################################################################################
+
+
+@dataclass
+class ModelArtifact:
+    """
+    Everything needed to score with a trained model, without retraining:
+    the fitted classifier, the FeatureMatrix layout it was trained on, the scaler
+    fitted on the training matrix, the feature selection mask (over all layout
+    columns) and the selected feature names, plus metadata (dates, parameters,
+    validation scores, library versions).
+    """
+
+    model: Any
+    layout: dict
+    scaler: FeatureScaler
+    feature_mask: np.ndarray
+    feature_names: list
+    metadata: dict = field(default_factory=dict)
+
+    @classmethod
+    def fit(
+        cls, model, features: FeatureMatrix, target, metadata=None
+    ) -> "ModelArtifact":
+        """
+        Fit a FeatureScaler and model on all columns of an unscaled training
+        FeatureMatrix (scaled in place), e.g. for tests without feature selection
+        """
+        scaler = FeatureScaler().fit(features)
+        scaler.transform(features)
+        model.fit(features.matrix(), target)
+        columns = features.columns()
+        return cls(
+            model=model,
+            layout=features.layout,
+            scaler=scaler,
+            feature_mask=np.ones(len(columns), dtype=bool),
+            feature_names=list(columns),
+            metadata={} if metadata is None else metadata,
+        )
+
+    def check_layout(self, features: FeatureMatrix) -> None:
+        if features.layout != self.layout:
+            raise ValueError("ModelArtifact: feature layout differs from training")
+
+    def model_input(self, features: FeatureMatrix):
+        """Scaled (in place) and selected model input of an unscaled FeatureMatrix"""
+        self.check_layout(features)
+        self.scaler.transform(features)
+        return features.matrix()[:, self.feature_mask]
+
+    def scorer(self):
+        """
+        Fast scorer of the model for small batches (scoring service, incremental
+        scoring): ForestArrays for depth limited forests, otherwise the model itself.
+        Large batches score about as fast with the model itself
+        """
+        try:
+            return ForestArrays.from_model(self.model)
+        except (AttributeError, ValueError):
+            return self.model
+
+    def predict_proba(self, features: FeatureMatrix, n_jobs: int = 1) -> np.ndarray:
+        """Class probabilities, n_jobs > 1 scores row blocks in worker processes"""
+        scorer = self.scorer()
+        if isinstance(scorer, ForestArrays):
+            return scorer.predict_proba(self.model_input(features), n_jobs=n_jobs)
+        return scorer.predict_proba(self.model_input(features))
+
+    def store(self, file_name: str, compress=3) -> None:
+        """
+        Store as joblib file in the current project directory (compressed by default).
+        compress=0 stores uncompressed, which allows memory-mapping on load (see load)
+        """
+        self.metadata.setdefault("stored", dtt.now().isoformat(timespec="seconds"))
+        self.metadata.setdefault("sklearn_version", sklearn.__version__)
+        file_path = (Path(get_project_dir()) / file_name).resolve()
+        with time_log("storing model artifact"):
+            info(f"Writing to file {file_path}")
+            joblib.dump(self, file_path, compress=compress)
+
+    @staticmethod
+    def load(file_name: str, mmap_mode=None) -> "ModelArtifact":
+        """
+        Load from the current project directory. mmap_mode="r" memory-maps the
+        stored arrays instead of reading them (uncompressed artifacts only).
+        Note that sklearn trees copy their node arrays when unpickled.
+        """
+        file_path = (Path(get_project_dir()) / file_name).resolve()
+        with time_log("loading model artifact"):
+            info(f"Reading from file {file_path}")
+            artifact = joblib.load(file_path, mmap_mode=mmap_mode)
+        if artifact.metadata.get("sklearn_version", sklearn.__version__) != (
+            sklearn.__version__
+        ):
+            info(
+                f"Model artifact stored with sklearn {artifact.metadata['sklearn_version']}"
+                f", running {sklearn.__version__}"
+            )
+        return artifact
@@ -8,6 +8,7 @@
 # make imports from pa_lib possible (parent directory of file's directory)
 
 import sys
+from functools import cached_property
 from pathlib import Path
 
 file_dir = Path.cwd()
@@ -16,12 +17,14 @@ parent_dir = file_dir.parent
 print(parent_dir)
 sys.path.append(str(parent_dir))
 
-from pa_lib.log import info
+from pa_lib.log import info, time_log
 
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from sklearn.metrics import (
+    average_precision_score,
+    classification_report,
     confusion_matrix,
     precision_recall_curve,
     roc_curve,
@@ -52,86 +55,118 @@ def rforest_features_report(model, features_col):
 
 
 ################################################################################
-# ## Confusion Matrix
-
+# ## Predictions (computed once, for all reports)
+
+
+class ValidationPredictions:
+    """
+    Predictions of a fitted classifier on one dataset (x, y), e.g. the test set.
+    The class probabilities are computed once, on first use: all reports, curves and
+    threshold searches below use them, instead of predicting again each.
+    model: anything with predict_proba and classes_ (a forest, ForestArrays, ...)
+    """
+
+    def __init__(self, model, x, y, name="forest_01"):
+        self.model = model
+        self.x = x
+        self.y = np.asarray(y)
+        self.name = name
+
+    @cached_property
+    def proba(self) -> np.ndarray:
+        with time_log(f"predicting {self.name} on {self.x.shape[0]} rows"):
+            return self.model.predict_proba(self.x)
+
+    @property
+    def prob_1(self) -> np.ndarray:
+        return self.proba[:, 1]
+
+    @cached_property
+    def predicted(self) -> np.ndarray:
+        """Predicted classes, as model.predict"""
+        return np.asarray(self.model.classes_)[self.proba.argmax(axis=1)]
+
+    def accuracy(self) -> float:
+        return (self.predicted == self.y).mean()
+
+    def confusion_matrix(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            confusion_matrix(self.y, self.predicted),
+            index=["Fact 0", "Fact 1"],
+            columns=["Pred 0", "Pred 1"],
+        )
 
-def confusion_matrices(x_test, y_test, model):
+    def classification_report(self, **kwargs) -> str:
+        return classification_report(self.y, self.predicted, **kwargs)
 
-    pred_forest_01 = model.predict(x_test)
+    def average_precision(self) -> float:
+        return average_precision_score(self.y, self.prob_1)
 
-    confusion_forest_01 = confusion_matrix(y_test, pred_forest_01)
+    def auc(self) -> float:
+        return roc_auc_score(self.y, self.prob_1)
 
-    df_confusion_forest_01 = pd.DataFrame(
-        confusion_forest_01, index=["Fact 0", "Fact 1"], columns=["Pred 0", "Pred 1"]
-    )
+    @cached_property
+    def prec_rec_values(self):
+        """Precision, recall, thresholds"""
+        return precision_recall_curve(self.y, self.prob_1)
 
-    print("Test set balance:")
-    print(pd.Series(y_test).value_counts())
+    @cached_property
+    def roc_values(self):
+        """False positive rate, true positive rate, thresholds"""
+        return roc_curve(self.y, self.prob_1)
 
-    print("\nConfusion Matrices:")
+    def prec_rec_optimum(self) -> int:
+        """Index of the precision-recall point closest to (1, 1)"""
+        (precision, recall, _) = self.prec_rec_values
+        return np.argmin(np.power(1 - precision, 2) + np.power(1 - recall, 2))
 
-    print("\nRandom Forest (forest_01):")
-    print(df_confusion_forest_01)
+    def roc_optimum(self) -> int:
+        """Index of the ROC point closest to (0, 1)"""
+        (fpr, tpr, _) = self.roc_values
+        return np.argmin(np.power(1 - tpr, 2) + np.power(fpr, 2))
 
 
 ################################################################################
-# ## Values: Precision, Recall, Threshold
+# ## Confusion Matrix
+
+
+def confusion_matrices(predictions: ValidationPredictions):
 
+    print("Test set balance:")
+    print(pd.Series(predictions.y).value_counts())
 
-def prec_rec_values(x_test, y_test, model):
+    print("\nConfusion Matrices:")
 
-    # RandomForestClassifier has predict_proba, but not decision_function
-    (
-        precision_forest_01,
-        recall_forest_01,
-        thresholds_forest_01,
-    ) = precision_recall_curve(y_test, model.predict_proba(x_test)[:, 1])
-    return precision_forest_01, recall_forest_01, thresholds_forest_01
+    print(f"\nRandom Forest ({predictions.name}):")
+    print(predictions.confusion_matrix())
 
 
 ################################################################################
 # ## Precision-Recall Curve
 
 
-def prec_rec_curve(x_train, y_train, model):
+def prec_rec_curve(predictions: ValidationPredictions):
 
-    (precision_forest_01, recall_forest_01, thresholds_forest_01) = prec_rec_values(
-        x_train, y_train, model
-    )
+    (precision, recall, thresholds) = predictions.prec_rec_values
+    optimum_idx = predictions.prec_rec_optimum()
 
     plt.figure(figsize=(15, 12))
     plt.grid()
 
-    def optimum_point(precision_model, recall_model, thresholds_model, name, dot):
-        optimum_idx = pd.Series.idxmin(
-            pd.Series(precision_model).apply(lambda x: np.power(1 - x, 2))
-            + pd.Series(recall_model).apply(lambda x: np.power(1 - x, 2))
-        )
-
-        return plt.plot(
-            precision_model[optimum_idx],
-            recall_model[optimum_idx],
-            dot,
-            markersize=10,
-            label=f"{name}: threshold {thresholds_model[optimum_idx]}",
-            fillstyle="none",
-            c="k",
-            mew=2,
-        )
-
-    ## Apply optium_point():
-
     # Optimum: Forest
-    optimum_point(
-        precision_forest_01,
-        recall_forest_01,
-        thresholds_forest_01,
-        name="forest_01",
-        dot="o",
+    plt.plot(
+        precision[optimum_idx],
+        recall[optimum_idx],
+        "o",
+        markersize=10,
+        label=f"{predictions.name}: threshold {thresholds[optimum_idx]}",
+        fillstyle="none",
+        c="k",
+        mew=2,
     )
 
     # Prec-Rec Curve: Forest
-    plt.plot(precision_forest_01, recall_forest_01, label="Random Forest")
+    plt.plot(precision, recall, label="Random Forest")
 
     plt.xlabel("Precision")
     plt.ylabel("Recall")
@@ -144,42 +179,31 @@ def prec_rec_curve(x_train, y_train, model):
 # ## Receiver Operating Characteristics (ROC) and AUC
 
 
-def roc_curve_graph(x_test, y_test, model):
+def roc_curve_graph(predictions: ValidationPredictions):
 
-    (fpr_forest_01, tpr_forest_01, thresholds_forest_01) = roc_curve(
-        y_test, model.predict_proba(x_test)[:, 1]
-    )
-
-    def threshold_dot_50perc(fpr_model, tpr_model, thresholds_model, name, dot):
-        close_default_index_forest_01 = pd.Series.idxmin(
-            pd.Series(tpr_model).apply(lambda x: np.power(1 - x, 2))
-            + np.power(pd.Series(fpr_model), 2)
-        )
-
-        return plt.plot(
-            fpr_model[close_default_index_forest_01],
-            tpr_model[close_default_index_forest_01],
-            dot,
-            markersize=10,
-            label=f"{name} threshold: {thresholds_model[close_default_index_forest_01]}",
-            fillstyle="none",
-            c="k",
-            mew=2,
-        )
+    (fpr, tpr, thresholds) = predictions.roc_values
+    close_default_index = predictions.roc_optimum()
 
     plt.figure(figsize=(15, 12))
     plt.grid()
 
-    plt.plot(fpr_forest_01, fpr_forest_01, linestyle="dotted", label="base line")
+    plt.plot(fpr, fpr, linestyle="dotted", label="base line")
 
-    plt.plot(fpr_forest_01, tpr_forest_01, label="forest_01")
+    plt.plot(fpr, tpr, label=predictions.name)
 
     plt.xlabel("False-Postive Rate (FPR)")
     plt.ylabel("True-Positive Rate (TPR) aka. Recall")
 
     # find threshold closest to zero
-    threshold_dot_50perc(
-        fpr_forest_01, tpr_forest_01, thresholds_forest_01, "forest_01", dot="^"
+    plt.plot(
+        fpr[close_default_index],
+        tpr[close_default_index],
+        "^",
+        markersize=10,
+        label=f"{predictions.name} threshold: {thresholds[close_default_index]}",
+        fillstyle="none",
+        c="k",
+        mew=2,
     )
 
     plt.legend(loc=4)
@@ -189,10 +213,8 @@ def roc_curve_graph(x_test, y_test, model):
 ################################################################################
 # ## Value: Area Under the Curve
 
-def roc_auc(x_test, y_test, model):
-    forest_01_auc = roc_auc_score(y_test, model.predict_proba(x_test)[:, 1])
-
-    info("AUC for forest_01:    {:.3f}".format(forest_01_auc))
+def roc_auc(predictions: ValidationPredictions):
+    info(f"AUC for {predictions.name}:    {predictions.auc():.3f}")
 
 
 ################################################################################
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Incremental retraining of a stored model
+# Adds trees trained on a new training snapshot to the forest of a model artifact
+# (warm start), optionally retiring its oldest trees, instead of rebuilding the whole
+# forest in vkprog_master_script.py. Layout, scaler and feature selection of the
+# artifact are kept, so the retrained model scores with vkprog_score.py as before.
+# Booking features are named by lag from the reference week, so trees trained on
+# snapshots of different weeks see the same features in the same columns.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+from datetime import datetime as dtt
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+from sklearn.model_selection import train_test_split
+
+from pa_lib.file import project_dir
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_feature_builder import FeatureBuilder
+from vkprog_analyse.vkprog_imbalance import balance
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
+from vkprog_analyse.vkprog_model_validation import ValidationPredictions
+
+################################################################################
+# # Retraining
+################################################################################
+
+
+def retrain(
+    previous_name,
+    model_name,
+    day,
+    month,
+    year_score,
+    year_train,
+    n_new_trees=500,
+    n_retired=0,
+    random_state=None,
+):
+    """
+    Warm-start retraining of model artifact previous_name (in vkprog/models):
+    retire its n_retired oldest trees and add n_new_trees trees, trained on the
+    training snapshot of date (year_score, month, day) in year_train. The new
+    trees get their own random_state (default: previous seed + generation).
+    Stores the artifact as model_name, with the lineage of all retrainings in
+    metadata["lineage"], and returns it. Raises ValueError for artifacts whose
+    layout does not fit the snapshot (e.g. booking columns named by calendar KW)
+    """
+    with project_dir("vkprog/models"):
+        artifact = ModelArtifact.load(previous_name)
+    forest = artifact.model
+    lineage = artifact.metadata.get("lineage", [])
+    if n_retired >= len(forest.estimators_):
+        raise ValueError(
+            f"retrain: cannot retire {n_retired} of {len(forest.estimators_)} trees"
+        )
+
+    builder = FeatureBuilder(
+        year_span=artifact.metadata["year_span"],
+        sales_filter=artifact.metadata["sales_filter"],
+    ).prepare()
+    (training_matrix, training_target) = builder.training_matrix(
+        day, month, year_score, year_train, artifact.layout
+    )
+    (X_train, X_test, y_train, y_test) = train_test_split(
+        artifact.model_input(training_matrix),
+        training_target,
+        train_size=0.75,
+        random_state=42,
+    )
+    ## Same imbalance strategy as the stored forest (class weights are forest parameters)
+    (X_train_balanced, y_train_balanced, _) = balance(
+        artifact.metadata.get("imbalance_strategy", "smote"),
+        X_train,
+        y_train,
+        random_state=42,
+    )
+
+    ## Warm start: fit only grows the forest to n_estimators, keeping existing trees
+    if random_state is None and isinstance(forest.random_state, int):
+        random_state = forest.random_state + len(lineage) + 1
+    forest.estimators_ = forest.estimators_[n_retired:]
+    forest.set_params(
+        warm_start=True,
+        n_estimators=len(forest.estimators_) + n_new_trees,
+        random_state=random_state,
+    )
+    with time_log(f"training {n_new_trees} new trees"):
+        forest.fit(X_train_balanced, y_train_balanced)
+    forest.set_params(warm_start=False)
+
+    avg_precision = ValidationPredictions(
+        forest, X_test, y_test, name=model_name
+    ).average_precision()
+    info(f"Average Precision of {model_name}: {avg_precision}"[:60])
+
+    previous = artifact.metadata
+    artifact.metadata = {
+        key: value
+        for (key, value) in previous.items()
+        if key not in ("stored", "sklearn_version")
+    }
+    artifact.metadata.update(
+        year_training=year_train,
+        date_scoring=f"{year_score}-{month:02}-{day:02}",
+        n_training=X_train.shape[0],
+        avg_precision=avg_precision,
+        lineage=lineage
+        + [
+            {
+                "previous": previous_name,
+                "previous_stored": previous.get("stored"),
+                "retrained": dtt.now().isoformat(timespec="seconds"),
+                "year_training": year_train,
+                "date_scoring": f"{year_score}-{month:02}-{day:02}",
+                "n_trees_retired": n_retired,
+                "n_trees_added": n_new_trees,
+                "n_trees": len(forest.estimators_),
+                "random_state": random_state,
+                "n_training": X_train.shape[0],
+                "avg_precision": avg_precision,
+            }
+        ],
+    )
+    with project_dir("vkprog/models"):
+        artifact.store(model_name)
+    return artifact
+
+
+################################################################################
+if __name__ == "__main__":
+    info("vkprog_retrain.py: START")
+
+    # Stored model to start from, and name of the retrained model (in data/vkprog/models):
+    previous_name = "20200601_vkprog_model.joblib"
+    model_name = "20200615_vkprog_model.joblib"
+
+    # date for prediction, training snapshot in the same week of year_training:
+    day_predict = 15  # Make sure it's a Monday
+    month_predict = 6
+    year_predict = 2020
+    year_training = 2019
+
+    # Trees to add (trained on the new snapshot) and to retire (oldest first):
+    n_new_trees = 500
+    n_retired = 500
+
+    retrain(
+        previous_name,
+        model_name,
+        day_predict,
+        month_predict,
+        year_predict,
+        year_training,
+        n_new_trees=n_new_trees,
+        n_retired=n_retired,
+    )
+
+    info("Continue with: vkprog_score.py")
+    info("vkprog_retrain.py: END")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Scoring with a stored model
+# Scores customers for a new date with the model artifact of vkprog_master_script.py:
+# no retraining, only the scoring features are built.
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+from pathlib import Path
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import pandas as pd
+
+from pa_lib.file import project_dir, store_bin, store_pickle
+from pa_lib.log import info
+
+from vkprog_analyse.vkprog_batch_scoring import write_proba
+from vkprog_analyse.vkprog_feature_builder import FeatureBuilder
+from vkprog_analyse.vkprog_incremental_scoring import load_state, rescore_changed
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
+from vkprog_analyse.vkprog_dataprep_ek_list import add_ek_info
+
+################################################################################
+# # Scoring
+################################################################################
+
+
+# Fingerprints and scores of the last run (in vkprog/predictions), see rescore_changed
+score_state_name = "vkprog_score_state.pkl"
+
+
+def score(
+    model_name,
+    day,
+    month,
+    year_score,
+    ek_list_name=None,
+    prob_file=None,
+    chunk_rows=50_000,
+    n_jobs=1,
+    incremental=True,
+):
+    """
+    Score all customers at date (year_score, month, day) with the stored model
+    model_name (in vkprog/models). Outputs (in vkprog/predictions):
+    prob_file: CSV of Endkunde_NR, Prob_0, Prob_1, written in blocks of chunk_rows
+    without a dataframe of all customers.
+    ek_list_name: scored list with customer info for vkprog_deployment.py, sorted
+    by Prob_1 (built in memory, merged with the whole ek_info). Returned, if given.
+    Customers are scored in blocks of chunk_rows, in n_jobs processes.
+    incremental: only rescore customers whose features changed since the last run
+    with this model, take the last run's scores for all others
+    """
+    with project_dir("vkprog/models"):
+        artifact = ModelArtifact.load(model_name)
+    info(f"Model metadata: {artifact.metadata}")
+
+    builder = FeatureBuilder(
+        year_span=artifact.metadata["year_span"],
+        sales_filter=artifact.metadata["sales_filter"],
+    ).prepare()
+    scoring_matrix = builder.scoring_matrix(day, month, year_score, artifact.layout)
+    model_key = f"{model_name}@{artifact.metadata.get('stored')}"
+    with project_dir("vkprog/predictions"):
+        state = load_state(score_state_name) if incremental else None
+    (scoring_prob, state) = rescore_changed(
+        artifact, model_key, scoring_matrix, state, chunk_rows=chunk_rows, n_jobs=n_jobs
+    )
+    with project_dir("vkprog/predictions"):
+        store_pickle(state, score_state_name)
+        if prob_file is not None:
+            write_proba(prob_file, scoring_matrix.customers, scoring_prob, chunk_rows)
+    if ek_list_name is None:
+        return None
+
+    scoring_all_prob = pd.DataFrame(
+        {
+            "Endkunde_NR": scoring_matrix.customers,
+            "Prob_0": scoring_prob[:, 0],
+            "Prob_1": scoring_prob[:, 1],
+        }
+    ).sort_values("Prob_1", ascending=False)
+    info(f"scoring_all_prob.shape: {scoring_all_prob.shape}")
+
+    ek_list = add_ek_info(scored_dataframe=scoring_all_prob)
+    info(f"ek_list.shape: {ek_list.shape}")
+    with project_dir("vkprog/predictions"):
+        store_bin(ek_list, ek_list_name)
+    return ek_list
+
+
+################################################################################
+if __name__ == "__main__":
+    info("vkprog_score.py: START")
+
+    # Stored model (from vkprog_master_script.py, in data/vkprog/models):
+    model_name = "20200601_vkprog_model.joblib"
+
+    # date for prediction:
+    day_predict = 15  # Make sure it's a Monday
+    month_predict = 6
+    year_predict = 2020
+
+    # Output: Name of scored list and probability file (saved in data/vkprog/predictions)
+    ek_list_name = "20200615_ek_list.feather"
+    prob_file = "20200615_prob.csv"
+
+    score(
+        model_name,
+        day_predict,
+        month_predict,
+        year_predict,
+        ek_list_name=ek_list_name,
+        prob_file=prob_file,
+    )
+
+    info("Continue with: vkprog_deployment.py")
+    info("vkprog_score.py: END")
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Verkaufsprognose: Scoring service
+# Long-running local HTTP/JSON service for fresh probabilities of single customers,
+# e.g. after a CRM contact, without rerunning the pipeline. Model artifact, scaler and
+# the scaled features of all customers at the as-of date stay in memory; a request
+# only scores its customers' rows (with ForestArrays, see ModelArtifact.scorer).
+#
+#   GET  /score/<Endkunde_NR>              -> {"Endkunde_NR": ..., "Prob_1": ...}
+#   POST /score  {"Endkunde_NR": [...]}    -> {"scores": [...], "unknown": [...]}
+#   POST /refresh                          -> reload CRM data, CRM features as of now
+#   GET  /health                           -> as-of dates, customers, model metadata
+
+################################################################################
+# # Tools & Libraries
+################################################################################
+
+# make imports from pa_lib possible (parent directory of file's directory)
+import sys
+import datetime as dt
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from urllib.request import Request, urlopen
+
+file_dir = Path.cwd()
+parent_dir = file_dir.parent
+sys.path.append(str(parent_dir))
+
+import numpy as np
+import pandas as pd
+
+from pa_lib.file import project_dir
+from pa_lib.log import info, time_log
+
+from vkprog_analyse.vkprog_feature_builder import FeatureBuilder
+from vkprog_analyse.vkprog_model_artifact import ModelArtifact
+
+################################################################################
+# # Scoring state
+################################################################################
+
+
+class ScoringService:
+    """
+    In-memory scoring of single customers or small batches with a model artifact,
+    on the features of all customers at date (year_score, month, day), built by a
+    prepared FeatureBuilder. refresh_crm() reloads CRM data and rebuilds the CRM
+    features as of now (crm_date), so contacts after date count; all other
+    features stay as of the date.
+    """
+
+    def __init__(self, artifact: ModelArtifact, builder: FeatureBuilder, day, month, year_score):
+        self.artifact = artifact
+        self.builder = builder
+        self.date = dt.datetime(year_score, month, day)
+        self.crm_date = self.date
+        self.scorer = artifact.scorer()
+        self.refreshed = None
+        self._lock = threading.Lock()
+        with time_log("building scoring features"):
+            self.features = builder.scoring_matrix(day, month, year_score, artifact.layout)
+            artifact.check_layout(self.features)
+            artifact.scaler.transform(self.features)
+            self._update_input()
+
+    def _update_input(self) -> None:
+        """Model input of all customers (dense, CSR if only sparse blocks are used)"""
+        model_input = self.features.matrix()[:, self.artifact.feature_mask]
+        self.model_input = model_input.tocsr() if hasattr(model_input, "tocsr") else model_input
+        self.refreshed = dt.datetime.now().isoformat(timespec="seconds")
+
+    def refresh_crm(self, crm_date: dt.datetime = None) -> None:
+        """
+        Reload CRM data (requesting its prepare job) and rebuild the CRM features
+        with all contacts before crm_date (default: until today, i.e. tomorrow 00:00)
+        """
+        if crm_date is None:
+            crm_date = dt.datetime.combine(dt.date.today(), dt.time()) + dt.timedelta(days=1)
+        with time_log(f"refreshing CRM features as of {crm_date}"):
+            crm = self.builder.crm.prepare()
+            crm_df = crm.snapshot(crm_date, self.builder.year_span)
+            with self._lock:
+                self.features.write_frame("crm", crm_df, fill_value=np.nan)
+                self.artifact.scaler.transform(self.features, blocks=["crm"])
+                self._update_input()
+                self.crm_date = crm_date
+
+    def score(self, customers) -> tuple:
+        """Booking probabilities of known customers, and the unknown customers"""
+        rows = self.features.customers.get_indexer(np.asarray(customers))
+        known = rows >= 0
+        with self._lock:
+            proba = self.scorer.predict_proba(self.model_input[rows[known]])[:, 1]
+        scores = [
+            {"Endkunde_NR": customer, "Prob_1": float(prob)}
+            for (customer, prob) in zip(np.asarray(customers)[known].tolist(), proba)
+        ]
+        return scores, np.asarray(customers)[~known].tolist()
+
+    def health(self) -> dict:
+        return {
+            "date": self.date.date().isoformat(),
+            "crm_date": self.crm_date.isoformat(timespec="minutes"),
+            "customers": len(self.features.customers),
+            "refreshed": self.refreshed,
+            "model": {key: str(value) for (key, value) in self.artifact.metadata.items()},
+        }
+
+
+################################################################################
+# # HTTP server
+################################################################################
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """JSON endpoints of the ScoringService in self.server.service"""
+
+    def _send(self, status: int, body: dict) -> None:
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _customer_nr(self, value):
+        return float(value) if "." in str(value) else int(value)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send(200, service.health())
+        elif self.path.startswith("/score/"):
+            try:
+                customer = self._customer_nr(self.path[len("/score/") :])
+            except ValueError:
+                self._send(400, {"error": f"Invalid Endkunde_NR: {self.path}"})
+                return
+            (scores, _) = service.score([customer])
+            if scores:
+                self._send(200, scores[0])
+            else:
+                self._send(404, {"error": f"Unknown Endkunde_NR {customer}"})
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path == "/refresh":
+            service.refresh_crm()
+            self._send(
+                200,
+                {
+                    "refreshed": service.refreshed,
+                    "crm_date": service.crm_date.isoformat(timespec="minutes"),
+                },
+            )
+        elif self.path == "/score":
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                customers = json.loads(self.rfile.read(length))["Endkunde_NR"]
+                customers = [self._customer_nr(customer) for customer in customers]
+            except (ValueError, KeyError, TypeError):
+                self._send(400, {"error": 'Expected JSON {"Endkunde_NR": [...]}'})
+                return
+            (scores, unknown) = service.score(customers)
+            self._send(200, {"scores": scores, "unknown": unknown})
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        pass  # no line per request
+
+
+def make_server(service: ScoringService, host="127.0.0.1", port=8050):
+    """HTTP server of service (port 0: any free port), call serve_forever() to run"""
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.service = service
+    return server
+
+
+################################################################################
+# # Latency benchmark
+################################################################################
+
+
+def _request(url: str, body: dict = None) -> dict:
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    request = Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def latency_benchmark(service: ScoringService, n_requests=200, batch_size=100):
+    """
+    Request latencies (ms) of single customer and batch requests against service,
+    served in a background thread on a free local port
+    """
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    customers = service.features.customers.to_numpy()
+    rng = np.random.default_rng(42)
+    latencies = {"single": [], f"batch of {batch_size}": []}
+    try:
+        for _ in range(n_requests):
+            customer = rng.choice(customers).item()
+            start = perf_counter()
+            _request(f"{url}/score/{customer}")
+            latencies["single"].append((perf_counter() - start) * 1000)
+
+            batch = rng.choice(customers, size=batch_size).tolist()
+            start = perf_counter()
+            _request(f"{url}/score", {"Endkunde_NR": batch})
+            latencies[f"batch of {batch_size}"].append((perf_counter() - start) * 1000)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return pd.DataFrame(latencies).describe(percentiles=[0.5, 0.95, 0.99]).T
+
+
+################################################################################
+if __name__ == "__main__":
+    info("vkprog_scoring_service.py: START")
+
+    # Stored model (from vkprog_master_script.py / vkprog_retrain.py, in data/vkprog/models):
+    model_name = "20200601_vkprog_model.joblib"
+
+    # As-of date of the features:
+    day_predict = 1  # Make sure it's a Monday
+    month_predict = 6
+    year_predict = 2020
+
+    port = 8050
+    run_benchmark = False  # measure request latencies instead of serving
+
+    with project_dir("vkprog/models"):
+        model_artifact = ModelArtifact.load(model_name)
+    feature_builder = FeatureBuilder(
+        year_span=model_artifact.metadata["year_span"],
+        sales_filter=model_artifact.metadata["sales_filter"],
+    ).prepare()
+    scoring_service = ScoringService(
+        model_artifact, feature_builder, day_predict, month_predict, year_predict
+    )
+
+    if run_benchmark:
+        info(f"Latencies (ms):\n{latency_benchmark(scoring_service)}")
+    else:
+        info(f"Serving on http://127.0.0.1:{port} (Ctrl-C to stop)")
+        with make_server(scoring_service, port=port) as http_server:
+            try:
+                http_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    info("vkprog_scoring_service.py: END")
@@ -11,7 +11,9 @@ import numpy as np
 import copy
 
 from pa_lib.file import load_bin, store_bin, load_xlsx, project_dir
-from pa_lib.data import clean_up_categoricals
+from pa_lib.data import clean_up_categoricals, last_valid, collect_unique
+from pa_lib.geo import gdenr_index, vkgeb_index
+from pa_lib.period import IsoPeriodArray
 from pa_lib.util import cap_words
 from pa_lib.log import err, info
 
@@ -51,62 +53,47 @@ def load_crm():
         crm_data = crm_data.loc[_only_directly_contacted_,:]
     return crm_data
 
-########################################################################################
-def collect(s, sep=","):
-        return sep.join(map(str, s[s.notna()].unique()))
-
-########################################################################################
-def last_notna(s):
-    try:
-        return s.loc[s.notnull()].iat[-1]
-    except IndexError:
-        return np.NaN
-
 ########################################################################################
 def aggregate_per_customer(bookings):
-    """def last_notna(s):
-        try:
-            return s.loc[s.notnull()].iat[-1]
-        except IndexError:
-            return np.NaN
-
-    def collect(s, sep=","):
-        return sep.join(map(str, s[s.notna()].unique()))"""
-
-    # this takes around 90 seconds
-    customer_info = (
-        bookings.sort_values(["Endkunde_NR", "Kampagne_Erfassungsdatum"])
-        .astype({"Endkunde_NR": "int64", "Kamp_Erfass_Jahr": "int16"})
-        .groupby("Endkunde_NR", as_index=False)
-        .agg(
-            {
-                "Endkunde": last_notna,
-                "EK_Aktiv": last_notna,
-                "EK_Kam_Betreut": last_notna,
-                "EK_Land": last_notna,
-                "EK_Plz": last_notna,
-                "EK_Ort": last_notna,
-                "Agentur": last_notna,
-                "Endkunde_Branchengruppe": last_notna,
-                "Endkunde_Branchengruppe_ID": last_notna,
-                "Auftrag_Branchengruppe_ID": [collect, "nunique"],
-                "Kampagne_Erfassungsdatum": "max",
-                "Kamp_Erfass_Jahr": ["min", "max"],
-                "Kampagne_Beginn": "max",
-                "EK_HB_Apg_Kurzz":  last_notna, # added by STC
-                "AG_Hauptbetreuer": last_notna, # added by STC
-            }
-        )
+    """One row per customer: latest not-null customer data, booking dates and Branchen.
+       Bookings are sorted only once, by customer and Kampagne_Erfassungsdatum."""
+    bookings = bookings.astype({"Endkunde_NR": "int64", "Kamp_Erfass_Jahr": "int16"})
+    by, order_by = "Endkunde_NR", "Kampagne_Erfassungsdatum"
+
+    latest = last_valid(
+        bookings,
+        by=by,
+        order_by=order_by,
+        cols="""Endkunde EK_Aktiv EK_Kam_Betreut EK_Land EK_Plz EK_Ort Agentur
+                Endkunde_Branchengruppe Endkunde_Branchengruppe_ID
+                EK_HB_Apg_Kurzz AG_Hauptbetreuer""".split(),  # last two added by STC
     )
+    per_customer = bookings.groupby(by, observed=True)
 
-    customer_info.set_axis(
-        labels="""Endkunde_NR Endkunde EK_Aktiv EK_Kam_Betreut EK_Land EK_Plz EK_Ort Agentur EK_BG 
-                  EK_BG_ID Auftrag_BG_ID Auftrag_BG_Anz Last_Res_Date First_Res_Year 
-                  Last_Res_Year Last_Aus_Date EK_HB_Apg_Kurzz AG_Hauptbetreuer""".split(),
-        axis="columns",
-        inplace=True,
+    customer_info = pd.DataFrame(
+        {
+            "Endkunde": latest["Endkunde"],
+            "EK_Aktiv": latest["EK_Aktiv"],
+            "EK_Kam_Betreut": latest["EK_Kam_Betreut"],
+            "EK_Land": latest["EK_Land"],
+            "EK_Plz": latest["EK_Plz"],
+            "EK_Ort": latest["EK_Ort"],
+            "Agentur": latest["Agentur"],
+            "EK_BG": latest["Endkunde_Branchengruppe"],
+            "EK_BG_ID": latest["Endkunde_Branchengruppe_ID"],
+            "Auftrag_BG_ID": collect_unique(
+                bookings, by=by, col="Auftrag_Branchengruppe_ID", order_by=order_by
+            ),
+            "Auftrag_BG_Anz": per_customer["Auftrag_Branchengruppe_ID"].nunique(),
+            "Last_Res_Date": per_customer["Kampagne_Erfassungsdatum"].max(),
+            "First_Res_Year": per_customer["Kamp_Erfass_Jahr"].min(),
+            "Last_Res_Year": per_customer["Kamp_Erfass_Jahr"].max(),
+            "Last_Aus_Date": per_customer["Kampagne_Beginn"].max(),
+            "EK_HB_Apg_Kurzz": latest["EK_HB_Apg_Kurzz"],
+            "AG_Hauptbetreuer": latest["AG_Hauptbetreuer"],
+        }
     )
-    return customer_info
+    return customer_info.rename_axis("Endkunde_NR").reset_index()
 
 
 ########################################################################################
@@ -182,10 +169,6 @@ def match_regions(df_cust, df_plz_names, df_plz, df_names, df_regions):
     cust_data = df_cust.copy()
     cust_data.rename(columns={"EK_Plz": "PLZ", "EK_Ort": "GEMEINDE"}, inplace=True)
 
-    def first_words(s):
-        s = s.fillna("")
-        return s.str.partition(expand=False).apply(lambda x: x[0])
-
     # Make PLZ numeric, replace (non-Swiss) non-numerics by -1
     cust_data["PLZ"] = (
         pd.to_numeric(cust_data["PLZ"], errors="coerce").fillna(-1).astype("int64")
@@ -222,52 +205,14 @@ def match_regions(df_cust, df_plz_names, df_plz, df_names, df_regions):
             "Wil AG": "Mettauertal",
         }
     )
-    # prepare a column with the first word of the NAME
-    cust_data["FIRST_NAME"] = first_words(cust_data["GEMEINDE"])
-
     swiss = cust_data.EK_Land == "SCHWEIZ"
 
-    # Find a GDENR for each Swiss customer:
-    #
-    # First, match by PLZ and town name
-    cust_data.loc[swiss, "GDENR"] = (
-        cust_data.loc[swiss, ["PLZ", "GEMEINDE"]]
-        .merge(df_plz_names, on=["PLZ", "GEMEINDE"], how="left")["GDENR"]
-        .values
-    )
-
-    # Try to fill missing by matching on PLZ
-    missing = cust_data.GDENR.isnull() & swiss
-    cust_data.loc[missing, "GDENR"] = (
-        cust_data.loc[missing, ["PLZ"]]
-        .merge(df_plz, on="PLZ", how="left")["GDENR"]
-        .values
-    )
-
-    # Then, match by town name
-    missing = cust_data.GDENR.isnull() & swiss
-    cust_data.loc[missing, "GDENR"] = (
-        cust_data.loc[missing, ["GEMEINDE"]]
-        .merge(df_names, on="GEMEINDE", how="left")["GDENR"]
-        .values
-    )
-
-    # Then, match by first word of town name only
-    missing = cust_data.GDENR.isnull() & swiss
-    cust_data.loc[missing, "GDENR"] = (
-        cust_data.loc[missing, ["FIRST_NAME"]]
-        .merge(
-            pd.DataFrame(
-                {
-                    "FIRST_NAME": first_words(df_names["GEMEINDE"]),
-                    "GDENR": df_names["GDENR"],
-                }
-            ).drop_duplicates(),
-            on="FIRST_NAME",
-            how="left",
-        )["GDENR"]
-        .values
-    )
+    # Find a GDENR for each Swiss customer, in one pass over all precedence rules:
+    # PLZ and town name, PLZ, town name, first word of town name
+    gdenr = gdenr_index(plz_names=df_plz_names, plz=df_plz, names=df_names)
+    matched = gdenr.resolve(cust_data.loc[swiss])
+    cust_data.loc[swiss, "GDENR"] = matched["GDENR"]
+    info(f"GDENR match rates:\n{gdenr.match_rates(matched)}")
 
     # Check that we matched every swiss (PLZ, Ort) to a GDENR
     not_matched = cust_data.loc[cust_data.GDENR.isnull() & swiss, ["PLZ", "GEMEINDE"]]
@@ -279,21 +224,13 @@ def match_regions(df_cust, df_plz_names, df_plz, df_names, df_regions):
         raise AssertionError(f"{not_matched_count} unmatched records")
 
     cust_data = cust_data.merge(df_regions, on="GDENR", how="left").drop(
-        columns=["GDENR", "FIRST_NAME"]
+        columns=["GDENR"]
     )
     return cust_data
 
 ########################################################################################
 ## VERKAUFGEBIETE
 
-########################################################################################
-def plz_data_olap_counter(column):
-    agg_counter = (plz_data.groupby(column)
-                        .agg({"VERKAUFS_GEBIETS_CODE": "count"})
-                        .reset_index()
-                        .rename(columns={"VERKAUFS_GEBIETS_CODE": "CNT"})) # COUNT
-    return agg_counter
-
 ########################################################################################
 def endkunde2vkgeb():
     ## Our basis table with our customers
@@ -305,141 +242,26 @@ def endkunde2vkgeb():
 
     cust_current = ek_info.loc[:,col_list]
 
-    ## International customers get mapped to MAT, INTERNATIONAL
+    ## International customers get mapped to (MAT, INTERNATIONAL)
+    international = (cust_current.loc[:,"EK_Land"] != "SCHWEIZ")
 
-    # find the internationl customers
-    row_select = (cust_current.loc[:,"EK_Land"] != "SCHWEIZ")
-    cust_matched_international = cust_current.loc[row_select,:]
+    ## Swiss customers: resolve by FRAKTION, PLZ, ORT, most specific key first
+    vkgeb = vkgeb_index(plz_data)
+    cust_swiss = vkgeb.resolve(cust_current.loc[~international,:])
+    info(f"Verkaufsgebiete match rates:\n{vkgeb.match_rates(cust_swiss)}")
 
-    # map international customers to (MAT, INTERNATIONAL)
-    cust_matched_international.loc[:,"VERKAUFS_GEBIETS_CODE"] = "INTERNATIONAL"
-    cust_matched_international.loc[:,"VB_VKGEB"] = "MAT"
-
-    # matched, cleanup
-    col_list     = """Endkunde_NR VERKAUFS_GEBIETS_CODE VB_VKGEB""".split()
-    cust_matched = cust_matched_international.loc[:,col_list].copy()
-
-    # unmatched, cleanup
-    row_select = (pd.merge(cust_current,
-                          cust_matched_international,
-                          on="Endkunde_NR",
-                          how="left")
-                  .loc[:,"VERKAUFS_GEBIETS_CODE"]
-                  .isna()
-                 )
-    cust_unmatched = cust_current.loc[row_select,:]
-
-    #print("INTERNATIONAL")
-    #report_success()
-
-    ## Taking care of all the Swiss Customers:
-
-    fraktion_cnt = plz_data_olap_counter("FRAKTION")
-    plz_cnt      = plz_data_olap_counter("PLZ")
-    ort_cnt      = plz_data_olap_counter("ORT")
-
-    max_iters = max(fraktion_cnt.loc[:,"CNT"]
-                    .append(plz_cnt.loc[:,"CNT"])
-                    .append(ort_cnt.loc[:,"CNT"])
-                   )+1
-
-    for unique_by in range(1,max_iters):
-
-        ## Match by FRAKTION
-        plz_unique_fraktion = (pd.merge(plz_data,
-                                        fraktion_cnt,
-                                        left_on="FRAKTION",
-                                        right_on="FRAKTION",
-                                        how="left"
-                                       )
-                                 .query(f"CNT =={unique_by}") # only unique ones
-                                 .groupby("FRAKTION")
-                                 .agg(
-                                     {"VERKAUFS_GEBIETS_CODE": collect,
-                                      "VB_VKGEB": collect,
-                                     }
-                                 )
-                                 .reset_index()
-                              )
-
-        cust_container_fraktion = (pd.merge(cust_unmatched,
-                                          plz_unique_fraktion.loc[:,"""FRAKTION VERKAUFS_GEBIETS_CODE  VB_VKGEB""".split()],
-                                          left_on="GEMEINDE",
-                                          right_on="FRAKTION",
-                                          how="left"
-                                         )
-                                 )
-
-        row_select = cust_container_fraktion.loc[:,"VERKAUFS_GEBIETS_CODE"].isna() # unmatched rows!
-        cust_matched_fraktion = cust_container_fraktion.loc[~row_select,"""Endkunde_NR VERKAUFS_GEBIETS_CODE VB_VKGEB""".split()]
-
-        cust_matched          = cust_matched.append(cust_matched_fraktion).drop_duplicates()
-        cust_unmatched        = cust_container_fraktion.loc[ row_select,"""Endkunde_NR PLZ GEMEINDE KANTON EK_Land""".split()]
-
-        ## Match by PLZ
-        plz_unique_plz = (pd.merge(plz_data,
-                                        plz_cnt,
-                                        left_on="PLZ",
-                                        right_on="PLZ",
-                                        how="left"
-                                       )
-                                 .query(f"CNT == {unique_by}") # only unique ones
-                                 .groupby("PLZ")
-                                 .agg(
-                                     {"VERKAUFS_GEBIETS_CODE": collect,
-                                      "VB_VKGEB": collect,
-                                     }
-                                 )
-                                 .reset_index()
-                              )
-
-        cust_container_plz = (pd.merge(cust_unmatched,
-                                       plz_unique_plz.loc[:,"""PLZ VERKAUFS_GEBIETS_CODE  VB_VKGEB""".split()],
-                                       left_on="PLZ",
-                                       right_on="PLZ",
-                                       how="left"
-                                      )
-                             )
-
-        row_select = cust_container_plz.loc[:,"VERKAUFS_GEBIETS_CODE"].isna() # unmatched rows!
-        cust_matched_plz = cust_container_plz.loc[~row_select,"""Endkunde_NR VERKAUFS_GEBIETS_CODE VB_VKGEB""".split()]
-
-        cust_matched     = cust_matched.append(cust_matched_plz).drop_duplicates()
-        cust_unmatched   = cust_container_plz.loc[ row_select,"""Endkunde_NR PLZ GEMEINDE KANTON EK_Land""".split()]
-
-        ## Match by ORT
-        plz_unique_ort = (pd.merge(plz_data,
-                                        ort_cnt,
-                                        left_on="ORT",
-                                        right_on="ORT",
-                                        how="left"
-                                       )
-                                 .query(f"CNT == {unique_by}") # only unique ones
-                                 .groupby("ORT")
-                                 .agg(
-                                     {"VERKAUFS_GEBIETS_CODE": collect,
-                                      "VB_VKGEB": collect,
-                                     }
-                                 )
-                                 .reset_index()
-                              )
-
-        cust_container_ort = (pd.merge(cust_unmatched,
-                                       plz_unique_ort.loc[:,"""ORT VERKAUFS_GEBIETS_CODE  VB_VKGEB""".split()],
-                                       left_on="GEMEINDE",
-                                       right_on="ORT",
-                                       how="left"
-                                      )
-                             )
-
-        row_select = cust_container_ort.loc[:,"VERKAUFS_GEBIETS_CODE"].isna()
-        cust_matched_ort = cust_container_ort.loc[~row_select,"""Endkunde_NR VERKAUFS_GEBIETS_CODE VB_VKGEB""".split()]
-
-        cust_matched     = cust_matched.append(cust_matched_plz).drop_duplicates()
-        cust_unmatched   = cust_container_ort.loc[ row_select,"""Endkunde_NR PLZ GEMEINDE KANTON EK_Land""".split()]
-
-        # End of one iteration
+    cust_vkgeb = pd.concat(
+        [cust_swiss,
+         pd.DataFrame({"VERKAUFS_GEBIETS_CODE": "INTERNATIONAL", "VB_VKGEB": "MAT"},
+                      index=cust_current.index[international])
+        ]
+    ).reindex(cust_current.index)
 
+    cust_matched = (cust_vkgeb.assign(Endkunde_NR=cust_current.loc[:,"Endkunde_NR"])
+                              .dropna(subset=["VERKAUFS_GEBIETS_CODE"])
+                              .loc[:,"""Endkunde_NR VERKAUFS_GEBIETS_CODE VB_VKGEB""".split()]
+                              .reset_index(drop=True)
+                   )
 
     info(f"Verkaufsgebiete Matched: {cust_matched.shape[0]/cust_current.shape[0]}")
     return cust_matched
@@ -450,18 +272,18 @@ def crm_info():
 
     ## Information about last contact: Kanal, VB, Betreff
     row_select = (crm_data.loc[:,"STARTTERMIN"] <= today)
-    container_crm = (crm_data.loc[row_select,:]
-                             .sort_values(["ENDKUNDE_NR","STARTTERMIN"])
-                             .groupby("ENDKUNDE_NR", as_index=False)
-                             .agg(
-                                 {"KUERZEL": last_notna,
-                                  "KANAL": last_notna,
-                                  "BETREFF": last_notna,
-                                  "STARTTERMIN": last_notna,
-                                  "VB_FILTER_VON": np.nanmax,
-                                  "VB_FILTER_BIS": np.nanmax,
-                                 }
-                             )
+    crm_past = crm_data.loc[row_select,:]
+    container_crm = (last_valid(crm_past,
+                                by="ENDKUNDE_NR",
+                                cols=["KUERZEL", "KANAL", "BETREFF", "STARTTERMIN"],
+                                order_by="STARTTERMIN")
+                             .join(crm_past.groupby("ENDKUNDE_NR")
+                                           .agg({"VB_FILTER_VON": "max",
+                                                 "VB_FILTER_BIS": "max",
+                                                })
+                                  )
+                             .rename_axis("ENDKUNDE_NR")
+                             .reset_index()
                              .rename(columns={
                                  "KUERZEL": "Letzter_Kontakt",
                                  "KANAL": "Kanal",
@@ -472,25 +294,21 @@ def crm_info():
                     )
 
     # Letzte CRM-Kontakte (alle der letzten zwei Kalendarjahre)
-    row_select = (crm_data.loc[:,"STARTTERMIN"]
-                          .apply(lambda x: 2 >= today.isocalendar()[0] - x.isocalendar()[0])
+    start_years = IsoPeriodArray.from_dates(crm_data.loc[:,"STARTTERMIN"], rd=1).year
+    row_select = ((2 >= today.isocalendar()[0] - start_years.to_numpy(dtype="float", na_value=np.nan))
                   & (crm_data.loc[:,"STARTTERMIN"] <= today)
                  )
+    crm_recent = crm_data.loc[row_select,:]
 
-    crm_letzte_vbs = (crm_data.loc[row_select,:]
-                              .groupby("ENDKUNDE_NR", as_index=False)
-                              .agg(
-                                  {"KUERZEL": collect,
-                                  }
-                              )
-                              .rename(columns={
-                                  "KUERZEL": "Letzte_CRM_Ktkts",
-                                  "ENDKUNDE_NR": "Endkunde_NR",})
+    crm_letzte_vbs = (collect_unique(crm_recent, by="ENDKUNDE_NR", col="KUERZEL")
+                              .rename("Letzte_CRM_Ktkts")
+                              .rename_axis("Endkunde_NR")
+                              .reset_index()
                      )
-    crm_letzte_datum_vbs = (crm_data.loc[row_select,:]
+    crm_letzte_datum_vbs = (crm_recent
                               .groupby("ENDKUNDE_NR", as_index=False)
                               .agg(
-                                  {"STARTTERMIN": np.nanmax,
+                                  {"STARTTERMIN": "max",
                                   }
                               )
                               .rename(columns={
@@ -535,11 +353,12 @@ def booking_nettos_vbs(booking_raw):
                   (booking_raw.loc[:,"Kamp_Erfass_Jahr"] >= (today.isocalendar()[0])-2)
                  )
 
-    booking_letzte_vbs = (booking_raw
-        .loc[row_select,:]
-        .groupby("Endkunde_NR", as_index=False)
-        .agg({"Verkaufsberater": collect})
-        .rename(columns={"Verkaufsberater": "letzte_VBs"})
+    booking_letzte_vbs = (collect_unique(booking_raw.loc[row_select,:],
+                                         by="Endkunde_NR",
+                                         col="Verkaufsberater")
+        .rename("letzte_VBs")
+        .rename_axis("Endkunde_NR")
+        .reset_index()
         )
 
     ## merge